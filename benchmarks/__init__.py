@@ -0,0 +1,20 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark suite, for `airspeed velocity <https://asv.readthedocs.io>`_.
+
+Every hot path is timed (``time_*``) and its peak memory is recorded
+(``peakmem_*``), over a sweep of number of samples (100 to 1,000,000),
+dimensions, number of stratify rules and k. Combinations which don't fit in
+a reasonable time or memory, like full ranking of 1,000,000 control samples,
+are skipped.
+
+Usage::
+
+    $ pip install asv
+    $ asv run                         # benchmark latest commit of master
+    $ asv continuous master HEAD      # compare, fail on regression
+    $ asv run --quick --bench psm     # one pass of end-to-end psm only
+    $ asv publish && asv preview      # browse results
+"""
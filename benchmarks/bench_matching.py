@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Neighbor search: full ranking (the legacy component functions) and top-k
+search engines.
+"""
+
+from ctmatching.core import (
+    normalize, stratified_matching, non_stratified_matching,
+    KNNSearcher, StratifiedSearcher,
+)
+
+from .common import SIZES, make_data, make_stratify_order, skip_if
+
+
+class FullRanking(object):
+    """Rank the entire control group, result is M1 x M2.
+    """
+    params = [[100, 1000, 10000], [6, 20], [2, 4]]
+    param_names = ["n_control", "n_features", "n_strata"]
+
+    def setup(self, n_control, n_features, n_strata):
+        self.control, self.treatment = make_data(n_control, n_features)
+        self.stratify_order = make_stratify_order(n_features, n_strata)
+
+    def time_stratified_matching(self, n_control, n_features, n_strata):
+        stratified_matching(self.control, self.treatment, self.stratify_order)
+
+    def peakmem_stratified_matching(self, n_control, n_features, n_strata):
+        stratified_matching(self.control, self.treatment, self.stratify_order)
+
+    def time_non_stratified_matching(self, n_control, n_features, n_strata):
+        non_stratified_matching(self.control, self.treatment)
+
+    def peakmem_non_stratified_matching(self, n_control, n_features, n_strata):
+        non_stratified_matching(self.control, self.treatment)
+
+
+class TopK(object):
+    """Top-k search, result is M1 x k.
+    """
+    params = [SIZES, [6, 20], [0, 2, 4], [1, 5]]
+    param_names = ["n_control", "n_features", "n_strata", "k"]
+
+    def setup(self, n_control, n_features, n_strata, k):
+        # stratified search computes M1 x M2 first distances
+        skip_if(n_strata and n_control > 100000)
+        control, treatment = make_data(n_control, n_features)
+        self.treatment_std, control_std = normalize(treatment, control)
+        if n_strata:
+            self.searcher = StratifiedSearcher(
+                control_std, make_stratify_order(n_features, n_strata))
+        else:
+            self.searcher = KNNSearcher(control_std)
+
+    def time_query(self, n_control, n_features, n_strata, k):
+        self.searcher.query(self.treatment_std, k)
+
+    def peakmem_query(self, n_control, n_features, n_strata, k):
+        self.searcher.query(self.treatment_std, k)
@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from ctmatching.core import normalize, column_stats, standardize
+
+from .common import SIZES, make_data
+
+
+class Normalize(object):
+    params = [SIZES, [6, 20]]
+    param_names = ["n_control", "n_features"]
+
+    def setup(self, n_control, n_features):
+        self.control, self.treatment = make_data(n_control, n_features)
+
+    def time_normalize(self, n_control, n_features):
+        normalize(self.treatment, self.control)
+
+    def peakmem_normalize(self, n_control, n_features):
+        normalize(self.treatment, self.control)
+
+    def time_standardize(self, n_control, n_features):
+        mean, scale = column_stats(self.treatment)
+        standardize(self.treatment, mean, scale)
+        standardize(self.control, mean, scale)
+
+    def peakmem_standardize(self, n_control, n_features):
+        mean, scale = column_stats(self.treatment)
+        standardize(self.treatment, mean, scale)
+        standardize(self.control, mean, scale)
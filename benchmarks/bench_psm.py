@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+End-to-end :func:`~ctmatching.core.psm`.
+"""
+
+from ctmatching.core import psm
+
+from .common import SIZES, make_data, make_stratify_order, skip_if
+
+
+class PSM(object):
+    params = [SIZES, [6, 20], [0, 3], [1, 5], [True, False]]
+    param_names = ["n_control", "n_features", "n_strata", "k", "independent"]
+
+    def setup(self, n_control, n_features, n_strata, k, independent):
+        skip_if(n_strata and n_control > 100000)
+        self.control, self.treatment = make_data(n_control, n_features)
+        if n_strata:
+            self.stratify_order = make_stratify_order(n_features, n_strata)
+        else:
+            self.stratify_order = None
+
+    def time_psm(self, n_control, n_features, n_strata, k, independent):
+        psm(self.control, self.treatment, stratify_order=self.stratify_order,
+            independent=independent, k=k)
+
+    def peakmem_psm(self, n_control, n_features, n_strata, k, independent):
+        psm(self.control, self.treatment, stratify_order=self.stratify_order,
+            independent=independent, k=k)
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Selection of control samples from ranked neighbors.
+"""
+
+from ctmatching.core import (
+    normalize, KNNSearcher,
+    non_repeat_index_matching, independent_index_matching,
+    lazy_non_repeat_index_matching, global_greedy_index_matching,
+)
+
+from .common import SIZES, make_data, skip_if
+
+
+class FullRankingSelection(object):
+    """Selection from the full ranking, M1 x M2 input.
+    """
+    params = [[100, 1000, 10000], [1, 5]]
+    param_names = ["n_control", "k"]
+
+    def setup(self, n_control, k):
+        control, treatment = make_data(n_control, 6)
+        treatment_std, control_std = normalize(treatment, control)
+        _, self.nn_indices = KNNSearcher(control_std).query(
+            treatment_std, n_control)
+
+    def time_non_repeat_index_matching(self, n_control, k):
+        non_repeat_index_matching(self.nn_indices, k)
+
+    def peakmem_non_repeat_index_matching(self, n_control, k):
+        non_repeat_index_matching(self.nn_indices, k)
+
+    def time_independent_index_matching(self, n_control, k):
+        independent_index_matching(self.nn_indices, k)
+
+
+class LazySelection(object):
+    """Selection with a search engine, fetching neighbors on demand.
+    """
+    params = [SIZES, [1, 5]]
+    param_names = ["n_control", "k"]
+
+    def setup(self, n_control, k):
+        control, treatment = make_data(n_control, 6)
+        self.treatment_std, control_std = normalize(treatment, control)
+        self.searcher = KNNSearcher(control_std)
+
+    def time_lazy_non_repeat_index_matching(self, n_control, k):
+        lazy_non_repeat_index_matching(self.searcher, self.treatment_std, k)
+
+    def peakmem_lazy_non_repeat_index_matching(self, n_control, k):
+        lazy_non_repeat_index_matching(self.searcher, self.treatment_std, k)
+
+
+class GlobalGreedySelection(object):
+    """Global greedy selection, a heap over all treatment samples.
+    """
+    params = [SIZES, [1, 5]]
+    param_names = ["n_control", "k"]
+
+    def setup(self, n_control, k):
+        # a Python heap operation per candidate is too slow at 1e6
+        skip_if(n_control > 100000)
+        control, treatment = make_data(n_control, 6)
+        self.treatment_std, control_std = normalize(treatment, control)
+        self.searcher = KNNSearcher(control_std)
+
+    def time_global_greedy_index_matching(self, n_control, k):
+        global_greedy_index_matching(self.searcher, self.treatment_std, k)
+
+    def peakmem_global_greedy_index_matching(self, n_control, k):
+        global_greedy_index_matching(self.searcher, self.treatment_std, k)
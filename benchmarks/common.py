@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Shared test data of benchmarks.
+"""
+
+import numpy as np
+
+from ctmatching.dataset import make_synthetic
+
+#: number of control samples of the sweep
+SIZES = [100, 1000, 10000, 100000, 1000000]
+
+
+def make_data(n_control, n_features, seed=0):
+    """Synthetic control and treatment group, with 10 control samples per
+    treatment sample, see :func:`~ctmatching.dataset.make_synthetic`. A third
+    of the columns are binary and a third are integer counts, so stratified
+    matching has ties to break, like re78.
+    """
+    n_treatment = max(10, n_control // 10)
+    return make_synthetic(n_control, n_treatment, n_features,
+                          n_binary=n_features // 3, seed=seed)
+
+
+def make_stratify_order(n_features, n_strata):
+    """Split columns into ``n_strata`` stratify rules, first rules are the
+    binary and integer columns.
+    """
+    return [list(chunk) for chunk in
+            np.array_split(np.arange(n_features), n_strata)]
+
+
+def skip_if(condition):
+    """asv skips a benchmark, if its setup raises NotImplementedError.
+    """
+    if condition:
+        raise NotImplementedError
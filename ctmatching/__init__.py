@@ -1,8 +1,11 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from .core import psm, grouper
-from .dataset import load_re78
+from .core import psm, grouper, batch_grouper
+from .index import ControlIndex, psm_iter
+from .result import MatchResult
+from .balance import balance
+from .dataset import load_re78, make_synthetic
 
 __version__ = "0.0.6"
 __short_description__ = ("Treatment group, control group matching algorithm "
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Covariate balance diagnostics, before and after matching.
+
+For each used column, :func:`balance` computes the standardized mean
+difference, the variance ratio and eCDF statistics of the treatment group
+against the control group, before matching (all samples, equal weights) and
+after matching (matching weights)::
+
+    >>> from ctmatching.balance import balance
+    >>> result = psm(control, treatment, use_col=use_col, k=3)
+    >>> balance(control, treatment, result, use_col=use_col)
+       smd_before  smd_after  variance_ratio_before  ...
+    2   -0.797...   0.00...               0.442...   ...
+
+Matching weights: a treatment sample with at least one match has weight 1,
+otherwise 0. Each match of treatment sample i gives its control sample a
+weight of ``1 / n_matched[i]``, so a control sample matched more than once
+(independent matching) counts more than once.
+
+All statistics come from weighted accumulators, updated chunk by chunk in one
+pass over the control group, and two passes over the treatment group (the
+first one for the eCDF grid), see :func:`~ctmatching.core.iter_chunks`.
+Memory is one chunk plus the match result, so data can be memory mapped and
+of any size.
+"""
+
+try:
+    from .exc import InputError
+    from .core import load_array, iter_chunks, exam_input
+    from .result import MatchResult
+except:
+    from ctmatching.exc import InputError
+    from ctmatching.core import load_array, iter_chunks, exam_input
+    from ctmatching.result import MatchResult
+
+import pandas as pd
+import numpy as np
+
+
+class _WeightedStats(object):
+    """Weighted mean, variance and binned eCDF of each column, updated chunk
+    by chunk.
+
+    :param edges: list of 1-d array, eCDF grid of each column.
+    """
+
+    def __init__(self, edges):
+        self.edges = edges
+        self.weight = 0.0
+        self.mean = np.zeros(len(edges))
+        self.m2 = np.zeros(len(edges))
+        # bin i counts edges[i - 1] < x <= edges[i], last bin is x > edges[-1]
+        self.histogram = [np.zeros(len(edge) + 1) for edge in edges]
+
+    def update(self, chunk, weight=None):
+        """Add a chunk of samples.
+
+        :param chunk: C x N float array.
+        :param weight: (default None, all 1) 1-d array, C weight.
+        """
+        if weight is None:
+            weight = np.ones(len(chunk))
+        chunk_weight = weight.sum()
+        if chunk_weight <= 0:
+            return
+        # combine with the chunk's weighted mean and sum of squared deviation
+        chunk_mean = weight.dot(chunk) / chunk_weight
+        chunk_m2 = weight.dot((chunk - chunk_mean) ** 2)
+        delta = chunk_mean - self.mean
+        total = self.weight + chunk_weight
+        self.mean = self.mean + delta * chunk_weight / total
+        self.m2 = self.m2 + chunk_m2 + \
+            delta ** 2 * self.weight * chunk_weight / total
+        self.weight = total
+
+        for histogram, edge, column in zip(self.histogram, self.edges,
+                                           chunk.T):
+            histogram += np.bincount(
+                np.searchsorted(edge, column, side="left"),
+                weights=weight, minlength=len(histogram))
+
+    @property
+    def variance(self):
+        if self.weight == 0:  # no sample, e.g. nothing matched
+            return np.full(len(self.m2), np.nan)
+        return self.m2 / self.weight
+
+    def ecdf(self):
+        """list of 1-d array, eCDF of each column at its grid.
+        """
+        if self.weight == 0:
+            return [np.full(len(edge), np.nan) for edge in self.edges]
+        return [np.cumsum(histogram)[:-1] / self.weight
+                for histogram in self.histogram]
+
+
+def matching_weights(result, n_control):
+    """Matching weights of control and treatment samples, see module
+    documentation.
+
+    :param result: :class:`~ctmatching.result.MatchResult`.
+    :param n_control: M2, number of control samples.
+
+    :returns control_id: 1-d array, sorted index of matched control samples.
+    :returns control_weight: 1-d array, weight of each ``control_id``.
+    :returns treatment_weight: 1-d array, M1 weight.
+    """
+    n_matched = result.n_matched
+    treatment_weight = (n_matched > 0).astype(float)
+    with np.errstate(divide="ignore"):
+        match_weight = np.repeat(1.0 / n_matched, n_matched)
+    # sparse, only matched control samples have weight
+    control_id, inverse = np.unique(result.indices, return_inverse=True)
+    if len(control_id) and (control_id[0] < 0 or control_id[-1] >= n_control):
+        raise InputError("matched control sample index out of range!")
+    control_weight = np.bincount(
+        inverse.ravel(), weights=match_weight, minlength=len(control_id))
+    return control_id, control_weight, treatment_weight
+
+
+def balance(control, treatment, result, use_col=None, n_bins=256,
+            chunk_size=None):
+    """Balance statistics of each used column, before and after matching.
+
+    - ``smd``: standardized mean difference, ``(mean_t - mean_c) / s``,
+      where ``s = sqrt((var_t + var_c) / 2)`` is the pooled standard
+      deviation before matching, for both before and after matching.
+    - ``variance_ratio``: ``var_t / var_c``.
+    - ``ecdf_mean``, ``ecdf_max``: mean and max absolute difference between
+      the eCDF of both groups, on a grid of ``n_bins`` equal width bins over
+      the range of the treatment group. A column with no more than
+      ``n_bins + 1`` distinct evenly spaced values (like a binary column) is
+      exact, others are approximated at the grid resolution.
+
+    :param control: control group sample data, see
+      :func:`~ctmatching.core.psm`.
+    :param treatment: treatment group sample data, see
+      :func:`~ctmatching.core.psm`.
+    :param result: :class:`~ctmatching.result.MatchResult` of
+      :func:`~ctmatching.core.psm`, or M1 x k matrix padded with -1.
+    :param use_col: (default None, use all) list of column index.
+    :param n_bins: (default 256) number of eCDF grid bins of each column.
+    :param chunk_size: see :func:`~ctmatching.core.psm`.
+
+    :returns: ``pandas.DataFrame``, one row per used column (indexed by
+      column index), with columns ``smd_before``, ``smd_after``,
+      ``variance_ratio_before``, ``variance_ratio_after``,
+      ``ecdf_mean_before``, ``ecdf_mean_after``, ``ecdf_max_before``,
+      ``ecdf_max_after``.
+    """
+    control = load_array(control)
+    treatment = load_array(treatment)
+    if use_col:
+        use_col = [int(i) for i in use_col]
+        exam_input(control[:1, use_col], treatment[:1, use_col])
+    else:
+        exam_input(control[:1], treatment[:1])
+    if not isinstance(result, MatchResult):
+        nn_index = np.asarray(result)
+        result = MatchResult.from_padded(nn_index, np.zeros(nn_index.shape))
+    if result.n_treatment != len(treatment):
+        raise InputError("result has to have one row per treatment sample!")
+    control_id, control_weight, treatment_weight = matching_weights(
+        result, len(control))
+
+    # eCDF grid over the range of treatment group
+    lower, upper = np.inf, -np.inf
+    for chunk in iter_chunks(treatment, use_col, chunk_size):
+        lower = np.minimum(lower, chunk.min(axis=0))
+        upper = np.maximum(upper, chunk.max(axis=0))
+    edges = [np.linspace(low, up, n_bins + 1)
+             for low, up in zip(lower, upper)]
+
+    stats = dict(
+        (key, _WeightedStats(edges)) for key in [
+            "treatment_before", "treatment_after",
+            "control_before", "control_after",
+        ]
+    )
+    chunk_lower = 0
+    for chunk in iter_chunks(treatment, use_col, chunk_size):
+        chunk_upper = chunk_lower + len(chunk)
+        stats["treatment_before"].update(chunk)
+        stats["treatment_after"].update(
+            chunk, treatment_weight[chunk_lower:chunk_upper])
+        chunk_lower = chunk_upper
+
+    chunk_lower = 0
+    for chunk in iter_chunks(control, use_col, chunk_size):
+        chunk_upper = chunk_lower + len(chunk)
+        stats["control_before"].update(chunk)
+        # matched control samples in this chunk
+        first, last = np.searchsorted(control_id, [chunk_lower, chunk_upper])
+        stats["control_after"].update(
+            chunk[control_id[first:last] - chunk_lower],
+            control_weight[first:last])
+        chunk_lower = chunk_upper
+
+    scale = np.sqrt((stats["treatment_before"].variance +
+                     stats["control_before"].variance) / 2)
+    scale[scale == 0] = 1.0
+
+    table = dict()
+    for when in ["before", "after"]:
+        treatment_stats = stats["treatment_" + when]
+        control_stats = stats["control_" + when]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            table["smd_" + when] = (
+                treatment_stats.mean - control_stats.mean) / scale
+            table["variance_ratio_" + when] = \
+                treatment_stats.variance / control_stats.variance
+        difference = [
+            np.abs(treatment_ecdf - control_ecdf)
+            for treatment_ecdf, control_ecdf in zip(
+                treatment_stats.ecdf(), control_stats.ecdf())
+        ]
+        table["ecdf_mean_" + when] = [d.mean() for d in difference]
+        table["ecdf_max_" + when] = [d.max() for d in difference]
+
+    columns = [
+        "smd_before", "smd_after",
+        "variance_ratio_before", "variance_ratio_after",
+        "ecdf_mean_before", "ecdf_mean_after",
+        "ecdf_max_before", "ecdf_max_after",
+    ]
+    index = use_col if use_col else list(range(len(scale)))
+    return pd.DataFrame(table, index=index, columns=columns)
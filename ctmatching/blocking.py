@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Exact match blocking.
+
+Columns like ``black``, ``married`` or ``nodegree`` in re78 often have to
+match exactly. Instead of putting them first in ``stratify_order``, control
+and treatment samples are partitioned into blocks by the values of those
+columns, and each block is matched on its own, with its own (much smaller)
+search engine. No distance is ever computed on the exact match columns, and
+a control sample can only be matched to treatment samples of its own block.
+
+Blocks share no control sample, so non repeat matching of each block is
+independent of the others, and blocks can be matched in parallel.
+"""
+
+import os
+
+try:
+    from .exc import InputError
+    from .core import (
+        KNNSearcher, StratifiedSearcher, select_matching, index_dtype,
+    )
+    from .parallel import SharedArray
+    from .result import MatchResult
+except:
+    from ctmatching.exc import InputError
+    from ctmatching.core import (
+        KNNSearcher, StratifiedSearcher, select_matching, index_dtype,
+    )
+    from ctmatching.parallel import SharedArray
+    from ctmatching.result import MatchResult
+
+import numpy as np
+
+
+def exact_blocks(control_key, treatment_key):
+    """Partition samples into blocks by their exact match key.
+
+    :param control_key: M2 x E matrix, exact match columns of control group.
+    :param treatment_key: M1 x E matrix, exact match columns of treatment
+      group.
+
+    :returns control_block: 1-d array, M2 block id of each control sample.
+    :returns treatment_block: 1-d array, M1 block id of each treatment sample.
+    :returns block_key: B x E matrix, key of each block.
+    """
+    key = np.concatenate([np.asarray(control_key), np.asarray(treatment_key)])
+    block_key, block = np.unique(key, axis=0, return_inverse=True)
+    block = block.ravel()  # numpy 2.0.0 returns inverse in key's shape
+    return block[:len(control_key)], block[len(control_key):], block_key
+
+
+def match_block(control_std, treatment_std, k=1, independent=True,
+                method="greedy", radius=None, stratify_order=None,
+                block_size=None):
+    """Match treatment samples of one block against control samples of the
+    same block.
+
+    :returns selected_control_index_for_each_treatment: M1 x k matrix of
+      control sample index in ``control_std``, padded with -1.
+    :returns distances: M1 x k matrix, padded with inf.
+    """
+    result = np.full((len(treatment_std), k), -1, dtype=np.intp)
+    distances = np.full((len(treatment_std), k), np.inf)
+    if len(control_std) == 0:  # nothing to match
+        return result, distances
+
+    if stratify_order:
+        searcher = StratifiedSearcher(control_std, stratify_order, block_size)
+    else:
+        searcher = KNNSearcher(control_std)
+    matched = select_matching(
+        searcher, treatment_std, k, independent, method, radius)
+    result[:, :matched.k] = matched.to_padded()
+    distances[:, :matched.k] = matched.padded_distances()
+    return result, distances
+
+
+#--- Worker ---
+_worker_shared = None
+
+
+def _init_worker(name, shape, dtype):
+    global _worker_shared
+    _worker_shared = SharedArray(shape, dtype, name)
+
+
+def _worker_match_block(lower, upper, treatment_std, *args):
+    return match_block(
+        _worker_shared.array[lower:upper], treatment_std, *args)
+
+
+def block_matching(control_std, treatment_std, control_block, treatment_block,
+                   k=1, independent=True, method="greedy", radius=None,
+                   stratify_order=None, block_size=None, n_jobs=None):
+    """Match each block of treatment samples against the control samples of
+    the same block, see :func:`exact_blocks`.
+
+    Control samples are sorted by block, so each block is a contiguous
+    slice. With ``n_jobs``, the sorted control data is put in shared memory,
+    and blocks are matched by a process pool, largest block first.
+
+    :param control_std: standardized control data, M2 x N matrix.
+    :param treatment_std: standardized treatment data, M1 x N matrix.
+    :param control_block: 1-d array, M2 block id of each control sample.
+    :param treatment_block: 1-d array, M1 block id of each treatment sample.
+    :param n_jobs: see :func:`~ctmatching.core.psm`.
+
+    Other parameters are the same as :func:`~ctmatching.core.psm`.
+
+    :returns result: :class:`~ctmatching.result.MatchResult`. With
+      independent matching or ``radius``, a treatment sample whose block
+      runs out of control samples gets less than k (or no) matches.
+
+    :raises InputError: if a block has less than k control samples per
+      treatment sample, for non repeat matching without ``radius``.
+    """
+    n_block = max(control_block.max(initial=-1),
+                  treatment_block.max(initial=-1)) + 1
+    # stable, so ties in a block are still broken by control sample index
+    control_order = np.argsort(control_block, kind="mergesort")
+    bounds = np.searchsorted(
+        control_block[control_order], np.arange(n_block + 1))
+    treatment_order = np.argsort(treatment_block, kind="mergesort")
+    treatment_bounds = np.searchsorted(
+        treatment_block[treatment_order], np.arange(n_block + 1))
+
+    tasks = list()
+    for block in range(n_block):
+        treatment_index = treatment_order[
+            treatment_bounds[block]:treatment_bounds[block + 1]]
+        if len(treatment_index) == 0:
+            continue
+        n_control = bounds[block + 1] - bounds[block]
+        if (not independent and radius is None and
+                k * len(treatment_index) > n_control):
+            raise InputError(
+                ("There's no enough samples in control group to "
+                 "perform non repeat matching in exact match block %s. Use "
+                 "independent matching or a caliper instead.") % block)
+        tasks.append((block, treatment_index))
+    # largest block first, for load balance
+    tasks.sort(key=lambda task: -len(task[1]) * (
+        bounds[task[0] + 1] - bounds[task[0]]))
+
+    args = (k, independent, method, radius, stratify_order, block_size)
+    parallel = n_jobs is not None and n_jobs != 1 and len(tasks) > 1
+    if parallel:
+        from concurrent.futures import ProcessPoolExecutor
+
+        if n_jobs < 1:
+            n_jobs = os.cpu_count() or 1
+        shared = SharedArray(control_std.shape, control_std.dtype)
+        try:
+            np.take(control_std, control_order, axis=0, out=shared.array)
+            with ProcessPoolExecutor(
+                max_workers=n_jobs,
+                initializer=_init_worker,
+                initargs=(shared.name, shared.array.shape,
+                          shared.array.dtype.str),
+            ) as executor:
+                futures = [
+                    executor.submit(
+                        _worker_match_block, bounds[block], bounds[block + 1],
+                        treatment_std[treatment_index], *args)
+                    for block, treatment_index in tasks
+                ]
+                results = [future.result() for future in futures]
+        finally:
+            shared.unlink()
+    else:
+        control_std = control_std[control_order]
+        results = [
+            match_block(control_std[bounds[block]:bounds[block + 1]],
+                        treatment_std[treatment_index], *args)
+            for block, treatment_index in tasks
+        ]
+
+    selected_control_index = np.full(
+        (len(treatment_std), k), -1, dtype=index_dtype(len(control_std)))
+    distances = np.full((len(treatment_std), k), np.inf)
+    for (block, treatment_index), (result, distance) in zip(tasks, results):
+        # block local index to control sample index
+        is_matched = result >= 0
+        result[is_matched] = control_order[bounds[block] + result[is_matched]]
+        selected_control_index[treatment_index] = result
+        distances[treatment_index] = distance
+
+    return MatchResult.from_padded(selected_control_index, distances)
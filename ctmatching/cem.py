@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Coarsened exact matching (CEM).
+
+Each used column is cut into bins, so every sample gets a tuple of integer
+bin codes, packed into one integer. Samples with the same packed code form a
+stratum, and a treatment sample only matches control samples of its own
+stratum. There's no distance at all, the packed codes are grouped by a hash
+table (``pandas.factorize``), so it runs in linear time and scales to
+control groups of any size::
+
+    >>> from ctmatching.cem import cem, cem_weights
+    >>> result = cem(control, treatment, use_col=[2, 3, 4, 5, 6, 7], k=3)
+    >>> control_weight, treatment_weight = cem_weights(
+    ...     control, treatment, use_col=[2, 3, 4, 5, 6, 7])
+"""
+
+try:
+    from .exc import InputError
+    from .core import load_array, iter_chunks, exam_input, index_dtype
+    from .result import MatchResult
+except:
+    from ctmatching.exc import InputError
+    from ctmatching.core import load_array, iter_chunks, exam_input, index_dtype
+    from ctmatching.result import MatchResult
+
+import pandas as pd
+import numpy as np
+
+
+def auto_cuts(control, treatment, use_col=None, n_bins=None, chunk_size=None):
+    """Equal width cut points of each used column, over the range of both
+    groups.
+
+    :param n_bins: (default None, Sturges' rule ``ceil(log2(M1 + M2)) + 1``)
+      number of bins of each column, or a list of it for each used column.
+
+    :returns cuts: list of 1-d array, inner cut points of each used column.
+    """
+    lower, upper = np.inf, -np.inf
+    for data in (control, treatment):
+        for chunk in iter_chunks(data, use_col, chunk_size):
+            lower = np.minimum(lower, chunk.min(axis=0))
+            upper = np.maximum(upper, chunk.max(axis=0))
+
+    sturges = int(np.ceil(np.log2(len(control) + len(treatment)))) + 1
+    if not isinstance(n_bins, (list, tuple)):
+        n_bins = [n_bins] * len(lower)
+    return [np.linspace(low, up, (n or sturges) + 1)[1:-1]
+            for low, up, n in zip(lower, upper, n_bins)]
+
+
+def coarsen(data, cuts, use_col=None, chunk_size=None):
+    """Replace each used column by its bin code, and pack bin codes of a
+    sample into one integer, chunk by chunk, see
+    :func:`~ctmatching.core.iter_chunks`.
+
+    :param cuts: list of 1-d array, inner cut points of each used column.
+      ``len(cut) + 1`` bins, bin ``i`` is ``cut[i - 1] <= x < cut[i]``.
+
+    :returns code: 1-d int64 array, packed bin code of each sample. Samples
+      have the same code, if and only if they are in the same bin of every
+      column.
+    """
+    n_bins = np.array([len(cut) + 1 for cut in cuts], dtype=np.int64)
+    if np.log2(n_bins.astype(float)).sum() >= 63:
+        raise InputError("too many bins to pack bin codes in int64!")
+    # mixed radix, last column is the lowest digit
+    radix = np.append(np.cumprod(n_bins[::-1])[::-1][1:], 1)
+
+    code = np.empty(len(data), dtype=np.int64)
+    lower = 0
+    for chunk in iter_chunks(data, use_col, chunk_size):
+        chunk_code = np.zeros(len(chunk), dtype=np.int64)
+        for column, cut, digit in zip(chunk.T, cuts, radix):
+            chunk_code += np.searchsorted(cut, column, side="right") * digit
+        code[lower:lower + len(chunk)] = chunk_code
+        lower += len(chunk)
+    return code
+
+
+def _strata(control, treatment, use_col=None, cuts=None, chunk_size=None):
+    """Stratum id of each control and treatment sample.
+    """
+    control = load_array(control)
+    treatment = load_array(treatment)
+    if use_col:
+        use_col = [int(i) for i in use_col]
+        exam_input(control[:1, use_col], treatment[:1, use_col])
+        n_features = len(use_col)
+    else:
+        exam_input(control, treatment)
+        n_features = control.shape[1]
+
+    if cuts is None or isinstance(cuts, int):
+        cuts = auto_cuts(control, treatment, use_col, cuts, chunk_size)
+    else:
+        if len(cuts) != n_features:
+            raise InputError("cuts has to have one entry per used column!")
+        is_auto = [cut is None or isinstance(cut, int) for cut in cuts]
+        if any(is_auto):
+            default_cuts = auto_cuts(
+                control, treatment, use_col,
+                [cut if auto else None for cut, auto in zip(cuts, is_auto)],
+                chunk_size,
+            )
+        cuts = [
+            default_cuts[i] if auto else np.sort(np.asarray(cut, dtype=float))
+            for i, (cut, auto) in enumerate(zip(cuts, is_auto))
+        ]
+
+    code = np.concatenate([
+        coarsen(control, cuts, use_col, chunk_size),
+        coarsen(treatment, cuts, use_col, chunk_size),
+    ])
+    # hash join on packed code, stratum id is the order of first appearance
+    stratum, _ = pd.factorize(code)
+    return stratum[:len(control)], stratum[len(control):]
+
+
+def _stable_argsort(stratum, n_stratum):
+    """Stable argsort of stratum id. numpy uses radix sort for 16 bits
+    integer, which is linear time.
+    """
+    if n_stratum <= np.iinfo(np.uint16).max + 1:
+        stratum = stratum.astype(np.uint16)
+    return np.argsort(stratum, kind="stable")
+
+
+def cem(control, treatment, use_col=None, cuts=None, k=1, independent=True,
+        chunk_size=None):
+    """Coarsened exact matching, an alternative of
+    :func:`~ctmatching.core.psm` with the same return value.
+
+    Control samples of a stratum are all equally good for its treatment
+    samples, so they're given in control sample index order. With
+    ``independent=True``, every treatment sample of a stratum gets the first
+    k control samples of it. Otherwise, in treatment input order, each
+    treatment sample gets the next k not yet taken control samples of its
+    stratum. A treatment sample gets less than k (or no) matches, if its
+    stratum runs out of control samples, padded with -1.
+
+    Matches are exact on the coarsened data, so all distances are 0.
+
+    :param control: control group sample data, see
+      :func:`~ctmatching.core.psm`.
+    :param treatment: treatment group sample data, see
+      :func:`~ctmatching.core.psm`.
+    :param use_col: see :func:`~ctmatching.core.psm`.
+    :param cuts: (default None, automatic) how to cut each used column into
+      bins. An int: number of equal width bins for all used columns. A list
+      with one entry per used column, each one of: None (automatic), an int
+      (number of equal width bins) or a list of inner cut points. Automatic
+      is Sturges' rule, see :func:`auto_cuts`.
+    :param k: see :func:`~ctmatching.core.psm`.
+    :param independent: see :func:`~ctmatching.core.psm`.
+    :param chunk_size: see :func:`~ctmatching.core.psm`.
+
+    :returns: :class:`~ctmatching.result.MatchResult`, distances are all 0.
+    """
+    control_stratum, treatment_stratum = _strata(
+        control, treatment, use_col, cuts, chunk_size)
+    n_stratum = max(control_stratum.max(initial=-1),
+                    treatment_stratum.max(initial=-1)) + 1
+
+    # control samples sorted by stratum, index order in a stratum
+    control_order = _stable_argsort(control_stratum, n_stratum)
+    start = np.searchsorted(
+        control_stratum[control_order], np.arange(n_stratum))
+    count = np.bincount(control_stratum, minlength=n_stratum)
+
+    if independent:
+        offset = np.zeros(len(treatment_stratum), dtype=np.intp)
+    else:
+        # rank of each treatment sample in its stratum, in input order
+        treatment_order = _stable_argsort(treatment_stratum, n_stratum)
+        sorted_stratum = treatment_stratum[treatment_order]
+        first = np.searchsorted(sorted_stratum, np.arange(n_stratum))
+        rank = np.empty(len(treatment_stratum), dtype=np.intp)
+        rank[treatment_order] = \
+            np.arange(len(treatment_stratum)) - first[sorted_stratum]
+        offset = rank * k
+
+    position = offset[:, None] + np.arange(k)
+    is_matched = position < count[treatment_stratum][:, None]
+    selected_control_index = np.full(
+        position.shape, -1, dtype=index_dtype(len(control_stratum)))
+    selected_control_index[is_matched] = control_order[
+        (start[treatment_stratum][:, None] + position)[is_matched]]
+
+    return MatchResult.from_padded(
+        selected_control_index, np.zeros(position.shape))
+
+
+def cem_weights(control, treatment, use_col=None, cuts=None, chunk_size=None):
+    """Standard CEM weights, for using all matched samples of every stratum
+    instead of k control samples per treatment sample.
+
+    A stratum is matched if it has both control and treatment samples. A
+    matched treatment sample has weight 1. A matched control sample in
+    stratum s has weight ``(m_C / m_T) * (m_T(s) / m_C(s))``, where m_C, m_T
+    are the numbers of matched control, treatment samples, and m_C(s),
+    m_T(s) are those in stratum s. Unmatched samples have weight 0.
+
+    Parameters are the same as :func:`cem`.
+
+    :returns control_weight: 1-d array, M2 weight.
+    :returns treatment_weight: 1-d array, M1 weight.
+    """
+    control_stratum, treatment_stratum = _strata(
+        control, treatment, use_col, cuts, chunk_size)
+    n_stratum = max(control_stratum.max(initial=-1),
+                    treatment_stratum.max(initial=-1)) + 1
+    control_count = np.bincount(control_stratum, minlength=n_stratum)
+    treatment_count = np.bincount(treatment_stratum, minlength=n_stratum)
+    is_matched = (control_count > 0) & (treatment_count > 0)
+
+    n_matched_control = control_count[is_matched].sum()
+    n_matched_treatment = treatment_count[is_matched].sum()
+    stratum_weight = np.zeros(n_stratum)
+    if n_matched_control:
+        stratum_weight[is_matched] = (
+            (n_matched_control / float(n_matched_treatment)) *
+            treatment_count[is_matched] / control_count[is_matched])
+
+    control_weight = stratum_weight[control_stratum]
+    treatment_weight = is_matched[treatment_stratum].astype(float)
+    return control_weight, treatment_weight
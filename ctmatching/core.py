@@ -5,18 +5,37 @@
 Control, treatment matching algorithm main module. (Propensity score matching)
 """
 
+import heapq
+import logging
+import tempfile
+import time
+
 try:
+    from . import profiling
     from .exc import InputError, NotEnoughControlSampleError
-    from .orderedset import OrderedSet
+    from .propensity import propensity_score, PropensitySearcher
+    from .result import MatchResult
 except:
+    from ctmatching import profiling
     from ctmatching.exc import InputError, NotEnoughControlSampleError
-    from ctmatching.orderedset import OrderedSet
+    from ctmatching.propensity import propensity_score, PropensitySearcher
+    from ctmatching.result import MatchResult
 
+from scipy import sparse
+from scipy.linalg import solve_triangular
 from sklearn import preprocessing
-from sklearn.neighbors import DistanceMetric
-from sklearn.neighbors import NearestNeighbors
+try:
+    from sklearn.metrics import DistanceMetric
+except ImportError:  # pragma: no cover, scikit-learn < 1.0
+    from sklearn.neighbors import DistanceMetric
+from sklearn.neighbors import KDTree
 import numpy as np
-import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+#: default number of elements per block, (2 ** 24 float64 is 128 MB), see
+#: :class:`StratifiedSearcher` and :func:`iter_chunks`.
+BLOCK_ELEMENTS = 2 ** 24
 
 
 def normalize(train, test):
@@ -32,6 +51,186 @@ def normalize(train, test):
     return train, test
 
 
+def load_array(data):
+    """Load 2-d ndarray like data without copying it.
+
+    - path of ``.npy`` file: memory mapped, read only.
+    - ``numpy.ndarray`` (including ``numpy.memmap``): returned as it is.
+    - others (list of list, ...): converted to ``numpy.ndarray``.
+    """
+    if isinstance(data, str):
+        return np.load(data, mmap_mode="r")
+    if not isinstance(data, np.ndarray):
+        return np.array(data)
+    return data
+
+
+def iter_chunks(data, use_col=None, chunk_size=None):
+    """Iterate over chunks of rows of data, as float array of the used
+    columns only. Only one chunk is copied into memory at a time, so it works
+    on memory mapped data of any size.
+
+    :param data: 2-d ndarray, or ``numpy.memmap``.
+    :param use_col: (default None, use all) list of column index.
+    :param chunk_size: (default None, automatic) number of rows per chunk. By
+      default, each chunk has about :data:`BLOCK_ELEMENTS` elements.
+    """
+    if chunk_size is None:
+        chunk_size = max(1, BLOCK_ELEMENTS // max(1, data.shape[1]))
+    for lower in range(0, len(data), chunk_size):
+        chunk = data[lower:lower + chunk_size]
+        if use_col:
+            chunk = chunk[:, use_col]
+        yield chunk.astype(float)
+
+
+def column_stats(data, use_col=None, chunk_size=None):
+    """Calculate mean and standard deviation of each used column in one pass
+    over chunks, see :func:`iter_chunks`. Like 
+    ``sklearn.preprocessing.StandardScaler``, the standard deviation of a 
+    constant column is 1.
+
+    :returns mean: 1-d array.
+    :returns scale: 1-d array, standard deviation.
+    """
+    n, mean, m2 = 0, 0.0, 0.0
+    for chunk in iter_chunks(data, use_col, chunk_size):
+        # combine with the chunk's mean and sum of squared deviation
+        chunk_n = len(chunk)
+        chunk_mean = chunk.mean(axis=0)
+        chunk_m2 = ((chunk - chunk_mean) ** 2).sum(axis=0)
+        delta = chunk_mean - mean
+        total = n + chunk_n
+        mean = mean + delta * chunk_n / total
+        m2 = m2 + chunk_m2 + delta ** 2 * n * chunk_n / total
+        n = total
+
+    scale = np.sqrt(m2 / n)
+    scale[scale == 0] = 1.0
+    return mean, scale
+
+
+def standardize(data, mean, scale, use_col=None, chunk_size=None, out=None,
+                matrix=None):
+    """Standardize used columns of data chunk by chunk, see 
+    :func:`iter_chunks`. Peak memory is the output plus one chunk, and with a
+    ``numpy.memmap`` output, just one chunk.
+
+    :param mean: 1-d array, mean of each used column.
+    :param scale: 1-d array, standard deviation of each used column.
+    :param out: (default None, new array) preallocated M x N float array or
+      ``numpy.memmap`` to write into.
+    :param matrix: (default None, no transform) N x N' matrix, standardized
+      data is multiplied by it, see :func:`metric_matrix`.
+
+    :returns out: standardized data.
+    """
+    if out is None:
+        n_features = len(mean) if matrix is None else matrix.shape[1]
+        out = np.empty((len(data), n_features))
+    lower = 0
+    for chunk in iter_chunks(data, use_col, chunk_size):
+        chunk = (chunk - mean) / scale
+        if matrix is not None:
+            chunk = chunk.dot(matrix)
+        out[lower:lower + len(chunk)] = chunk
+        lower += len(chunk)
+    return out
+
+
+def column_scatter(data, use_col=None, chunk_size=None):
+    """Same as :func:`column_stats`, but the scatter matrix (sum of outer
+    products of deviation from mean) of used columns instead of standard
+    deviation.
+
+    :returns n: number of rows.
+    :returns mean: 1-d array.
+    :returns scatter: N x N matrix.
+    """
+    n, mean, scatter = 0, 0.0, 0.0
+    for chunk in iter_chunks(data, use_col, chunk_size):
+        chunk_n = len(chunk)
+        chunk_mean = chunk.mean(axis=0)
+        deviation = chunk - chunk_mean
+        delta = chunk_mean - mean
+        total = n + chunk_n
+        mean = mean + delta * chunk_n / total
+        scatter = scatter + deviation.T.dot(deviation) + \
+            np.outer(delta, delta) * n * chunk_n / total
+        n = total
+    return n, mean, scatter
+
+
+def pooled_covariance(control, treatment, use_col=None, chunk_size=None):
+    """Pooled within group covariance matrix of used columns, chunk by
+    chunk, see :func:`iter_chunks`.
+
+    :returns cov: N x N matrix.
+    """
+    n_control, _, control_scatter = column_scatter(control, use_col, chunk_size)
+    n_treatment, _, treatment_scatter = column_scatter(
+        treatment, use_col, chunk_size)
+    return (control_scatter + treatment_scatter) / \
+        max(1, n_control + n_treatment - 2)
+
+
+def metric_matrix(cov, scale, stratify_order=None, metric="euclidean"):
+    """Linear transform of standardized data, so that euclidean distance of
+    transformed data is the distance in given metric. Then the fast KD-tree
+    and blocked distance matrix of euclidean distance are used for any
+    metric.
+
+    For "mahalanobis", with ``cov = L * L.T`` (Cholesky decomposition),
+    ``x * inv(L).T`` is whitened data, its euclidean distance is
+    ``sqrt((x - y) * inv(cov) * (x - y).T)``.
+
+    :param cov: N x N covariance matrix of used columns, see
+      :func:`pooled_covariance`.
+    :param scale: 1-d array, standard deviation used to standardize, see
+      :func:`column_stats`.
+    :param stratify_order: (default None, all columns as one) see
+      :func:`psm`.
+    :param metric: see :func:`psm`.
+
+    :returns matrix: N x N' matrix, see :func:`standardize`.
+    :returns stratify_order: stratify order of transformed data, each rule
+      is a range of columns, or None if given stratify_order is None.
+
+    :raises InputError: if covariance matrix of a stratify rule with
+      "mahalanobis" is singular, such as having a constant column.
+    """
+    cov_std = cov / np.outer(scale, scale)
+    if stratify_order:
+        rules = [list(chunk) for chunk in stratify_order]
+    else:
+        rules = [list(range(len(scale)))]
+    if isinstance(metric, str):
+        metric = [metric] * len(rules)
+
+    matrix = np.zeros((len(scale), sum(len(rule) for rule in rules)))
+    new_stratify_order = list()
+    lower = 0
+    for rule, rule_metric in zip(rules, metric):
+        upper = lower + len(rule)
+        if rule_metric == "mahalanobis":
+            try:
+                lower_triangle = np.linalg.cholesky(cov_std[np.ix_(rule, rule)])
+            except np.linalg.LinAlgError:
+                raise InputError(
+                    "covariance matrix of columns %s is singular, can't "
+                    "use mahalanobis metric!" % rule)
+            matrix[rule, lower:upper] = solve_triangular(
+                lower_triangle, np.eye(len(rule)), lower=True).T
+        else:
+            matrix[rule, range(lower, upper)] = 1.0
+        new_stratify_order.append(list(range(lower, upper)))
+        lower = upper
+
+    if stratify_order:
+        return matrix, new_stratify_order
+    return matrix, None
+
+
 def dist(X, Y):
     """Calculate X, Y distance matrix.
 
@@ -69,7 +268,200 @@ def exam_input(control, treatment, stratify_order=None):
 
 
 #--- Matching ---
-def stratified_matching(control, treatment, stratify_order):
+class StratifiedSearcher(object):
+    """Top-k stratified nearest neighbor search engine over standardized 
+    control samples.
+
+    A lower priority stratify rule only matters for breaking ties of the
+    higher priority ones, so the search is lazy:
+
+    1. Treatment samples are processed block by block. For each block, only
+       the distance matrix of the first stratify rule is computed.
+    2. For each treatment sample, find the k-th smallest first distance, and
+       keep only the control samples not farther than it (the candidates).
+    3. Compute the next stratify rule's distance for the candidates only,
+       sort them by first distance, then second, ..., and keep the ones that
+       still can be in the top k, which are the first k and everyone tied
+       with the k-th. Repeat over the remaining stratify rules.
+
+    On data like re78, where the first stratify rule is a single integer
+    column, the candidates are a tiny fraction of the control group. Peak
+    memory is ``block_size`` x M2, no matter how many treatment samples
+    there are.
+
+    :param control_std: standardized control data, M2 x N matrix.
+    :param stratify_order: list of list of column index, see :func:`psm`.
+    :param block_size: (default None, automatic) number of treatment samples
+      processed at once. By default, it's chosen so that each block has about
+      :data:`BLOCK_ELEMENTS` distance matrix elements.
+    """
+
+    def __init__(self, control_std, stratify_order, block_size=None):
+        self.control_std = control_std
+        self.n_control = len(control_std)
+        self.stratify_order = stratify_order
+        if block_size is None:
+            block_size = max(1, BLOCK_ELEMENTS // self.n_control)
+        self.block_size = block_size
+
+    def _refine(self, treatment_sample, first_distance, k, radius=None):
+        """Lazily rank the candidates of one treatment sample by the 
+        remaining stratify rules.
+
+        With ``radius``, the candidates are the control samples whose first
+        distance is within radius (the overall distance can't be smaller),
+        they are all refined, then the ones out of radius are dropped.
+
+        :returns distance_list: list of distance array, one for each stratify
+          rule, of the (at most) k nearest control samples.
+        :returns index: the (at most) k nearest control samples' index, sorted.
+        """
+        if radius is None:
+            threshold = np.partition(first_distance, k - 1)[k - 1]
+        else:
+            threshold = radius
+        candidate = np.flatnonzero(first_distance <= threshold)
+        distance_list = [first_distance[candidate], ]
+        profiling.count(
+            "distance_evaluations",
+            len(candidate) * (len(self.stratify_order) - 1))
+        if len(candidate) == 0:
+            return distance_list * len(self.stratify_order), candidate
+
+        for stratify_index in self.stratify_order[1:]:
+            distance_list.append(dist(
+                treatment_sample[None, stratify_index],
+                self.control_std[candidate][:, stratify_index],
+            )[0])
+
+            # numpy.lexsort use the last key as primary key
+            order = np.lexsort(distance_list[::-1])
+            if radius is None and len(order) > k:
+                kth = order[k - 1]
+                tail = order[k:]
+                is_tied = np.ones(len(tail), dtype=bool)
+                for distance in distance_list:
+                    is_tied &= distance[tail] == distance[kth]
+                order = np.concatenate([order[:k], tail[is_tied]])
+                candidate = candidate[order]
+                distance_list = [distance[order] for distance in distance_list]
+
+        if radius is not None:
+            is_within = sum(distance ** 2 for distance in distance_list) \
+                <= radius ** 2
+            candidate = candidate[is_within]
+            distance_list = [distance[is_within] for distance in distance_list]
+
+        # control sample index as the last tie breaker
+        order = np.lexsort([candidate, ] + distance_list[::-1])[:k]
+        return [distance[order] for distance in distance_list], candidate[order]
+
+    def _rank_all(self, treatment_block):
+        """Rank all control samples for a block of treatment samples, in one
+        batched ``numpy.lexsort``.
+        """
+        profiling.count(
+            "distance_evaluations",
+            len(treatment_block) * self.n_control * len(self.stratify_order))
+        distmatrix_list = list()
+        for stratify_index in self.stratify_order:
+            distmatrix_list.append(dist(
+                treatment_block[:, stratify_index],
+                self.control_std[:, stratify_index],
+            ))
+        # numpy.lexsort use the last key as primary key, it is stable, so ties
+        # are broken by control sample index
+        nn_index = np.lexsort(distmatrix_list[::-1], axis=-1)
+        distance_list = [np.take_along_axis(distmatrix, nn_index, axis=1)
+                         for distmatrix in distmatrix_list]
+        return distance_list, nn_index
+
+    def query(self, treatment_std, k, radius=None):
+        """Find the k nearest control samples for each treatment sample, by 
+        mean of stratification. Ties are broken by control sample index.
+
+        :param treatment_std: standardized treatment data, M1 x N matrix.
+        :param k: number of neighbors, capped by number of control samples.
+        :param radius: (default None, no limit) only control samples within
+          this overall distance are returned, the rest is padded with -1.
+
+        :returns distances: M1 x k matrix, euclidean distance over all
+          stratify rules, ``sqrt(d1 ** 2 + d2 ** 2 + ...)``. inf for padding.
+        :returns nn_index: M1 x k matrix of control sample index. -1 for 
+          padding.
+        """
+        distance_list, nn_index = self.query_rules(treatment_std, k, radius)
+        return np.sqrt(sum(distance ** 2 for distance in distance_list)), \
+            nn_index
+
+    def query_rules(self, treatment_std, k, radius=None):
+        """Same as :meth:`query`, but with the distance of each stratify
+        rule, which are the sort keys of the neighbors.
+
+        :returns distance_list: list of M1 x k matrix, one for each stratify
+          rule. inf for padding.
+        :returns nn_index: M1 x k matrix of control sample index. -1 for
+          padding.
+        """
+        k = min(k, self.n_control)
+        n_treatment = len(treatment_std)
+        distance_list = [np.full((n_treatment, k), np.inf)
+                         for _ in self.stratify_order]
+        nn_index = np.full((n_treatment, k), -1, dtype=np.intp)
+
+        first_stratify_index = self.stratify_order[0]
+        for lower in range(0, n_treatment, self.block_size):
+            upper = min(lower + self.block_size, n_treatment)
+            start = time.time()
+            if k == self.n_control and radius is None:
+                # full ranking, nothing to be lazy about
+                block_distance_list, nn_index[lower:upper] = \
+                    self._rank_all(treatment_std[lower:upper])
+                for distances, block_distances in zip(
+                        distance_list, block_distance_list):
+                    distances[lower:upper] = block_distances
+                profiling.block(
+                    "stratified_query", upper - lower, time.time() - start)
+                continue
+
+            profiling.count(
+                "distance_evaluations", (upper - lower) * self.n_control)
+            first_distmatrix = dist(
+                treatment_std[lower:upper, first_stratify_index],
+                self.control_std[:, first_stratify_index],
+            )
+            for i, first_distance in zip(range(lower, upper), first_distmatrix):
+                row_distance_list, index = self._refine(
+                    treatment_std[i], first_distance, k, radius)
+                nn_index[i, :len(index)] = index
+                for distances, row_distances in zip(
+                        distance_list, row_distance_list):
+                    distances[i, :len(index)] = row_distances
+            del first_distmatrix
+            profiling.block(
+                "stratified_query", upper - lower, time.time() - start)
+
+        return distance_list, nn_index
+
+    def distance(self, treatment_std, nn_index):
+        """Overall distance over all stratify rules between each treatment
+        sample and given control samples, same as in :meth:`query`.
+
+        :param treatment_std: standardized treatment data, M1 x N matrix.
+        :param nn_index: M1 x k matrix of control sample index.
+
+        :returns distances: M1 x k matrix.
+        """
+        squared = 0.0
+        for stratify_index in self.stratify_order:
+            diff = treatment_std[:, None, stratify_index] - \
+                self.control_std[nn_index][:, :, stratify_index]
+            squared = squared + (diff ** 2).sum(axis=2)
+        return np.sqrt(squared)
+
+
+def stratified_matching(control, treatment, stratify_order, k=None,
+                        block_size=None):
     """Calculate the order of matched control samples. Conponent function of 
     :func:`psm`. 
 
@@ -82,62 +474,207 @@ def stratified_matching(control, treatment, stratify_order):
         stratify_order = [[0], [1,2,3], [4]]
 
     1. construct 3 distance matrix for 3 stratify rules, each matrix size is 
-    100 * 1000
+    block_size * 1000
 
-        - select first column of treatment
+        - select first column of treatment block
         - select first column of control
         - compute distance matrix
         - repeat this over three order
 
-    2. construct a 1000 * 3 matrix, each column is the distance array against 
-    control then sort them by first column, then second column, finally third 
-    column. now first row index should be the nearest sample in control group 
-    by mean of stratification. append the row index to "indices" matrix.
+    2. stack the 3 distance matrix into a 3 * block_size * 1000 tensor, then
+    sort each row by first distance matrix, then second, finally third, in
+    one batched ``numpy.lexsort``. now first column of each row should be the
+    nearest sample in control group by mean of stratification. The sort is
+    stable, ties are broken by control sample index. keep first k column.
+
+    3. repeat this over all treatment blocks.
 
     :param stratify_order:
-    :returns nn_index: knn index, M1 X M2 matrix. M1 is number of treatment, M2
-      is number of control.
+    :param k: (default None, rank entire control group) number of nearest
+      neighbors to find for each treatment sample.
+    :param block_size: (default None, automatic) number of treatment samples
+      processed at once, see :class:`StratifiedSearcher`.
+
+    :returns nn_index: knn index, M1 X k matrix. M1 is number of treatment, k
+      is number of neighbors (M2, number of control, if k is None).
     """
     exam_input(control, treatment, stratify_order)
     treatment_std, control_std = normalize(treatment, control)
 
-    distmatrix_list = list()
-    nn_index = list()
-
-    for stratify_index in stratify_order:
-        sub_control = control_std[:, stratify_index]
-        sub_treatment = treatment_std[:, stratify_index]
-        distmatrix = dist(sub_treatment, sub_control)
-        distmatrix_list.append(distmatrix)
+    if k is None:
+        k = len(control_std)
+    searcher = StratifiedSearcher(control_std, stratify_order, block_size)
+    _, nn_index = searcher.query(treatment_std, k)
+    return nn_index
 
-    for chunk in zip(*distmatrix_list):
-        df = pd.DataFrame(np.array(chunk).T)
-        nn_index.append(
-            df.sort(columns=list(range(len(stratify_order)))).index.values)
 
-    nn_index = np.array(nn_index)
+class KNNSearcher(object):
+    """Top-k nearest neighbor search engine over standardized control samples.
 
-    return nn_index
+    The KD-tree is built once, and each :meth:`query` only ranks the ``k``
+    nearest control samples, so the result is M1 x k instead of M1 x M2.
+    If a treatment sample needs more neighbors later (for example non repeat
+    matching runs out of free control samples), just query those rows again
+    with a larger ``k``.
 
+    :param control_std: standardized control data, M2 x N matrix.
+    :param tree: (default None, build a new one) a ``sklearn.neighbors.KDTree``
+      already built on ``control_std``.
+    """
 
-def non_stratified_matching(control, treatment):
+    def __init__(self, control_std, tree=None):
+        self.control_std = control_std
+        self.n_control = len(control_std)
+        if tree is None:
+            tree = KDTree(control_std)
+        self.tree = tree
+
+    def query(self, treatment_std, k, radius=None):
+        """Find the k nearest control samples for each treatment sample.
+
+        With ``radius``, the tree first counts control samples within radius
+        of each treatment sample. Treatment samples with at least k of them
+        get a regular k nearest neighbor query, the others get a radius
+        bounded query, and the ones with nothing in radius are not searched
+        at all.
+
+        :param treatment_std: standardized treatment data, M1 x N matrix.
+        :param k: number of neighbors, capped by number of control samples.
+        :param radius: (default None, no limit) only control samples within
+          this distance are returned, the rest is padded with -1.
+
+        :returns distances: M1 x k matrix, nearest first. inf for padding.
+        :returns nn_index: M1 x k matrix of control sample index. -1 for
+          padding.
+        """
+        k = min(k, self.n_control)
+        n_calls = self.tree.get_n_calls()
+        try:
+            return self._query(treatment_std, k, radius)
+        finally:
+            profiling.count(
+                "distance_evaluations", self.tree.get_n_calls() - n_calls)
+
+    def _query(self, treatment_std, k, radius=None):
+        if radius is None:
+            distances, nn_index = self.tree.query(treatment_std, k=k)
+            return distances, nn_index
+
+        n_treatment = len(treatment_std)
+        distances = np.full((n_treatment, k), np.inf)
+        nn_index = np.full((n_treatment, k), -1, dtype=np.intp)
+
+        count = self.tree.query_radius(treatment_std, radius, count_only=True)
+        is_dense = count >= k
+        if is_dense.any():
+            distances[is_dense], nn_index[is_dense] = self.tree.query(
+                treatment_std[is_dense], k=k)
+
+        is_sparse = (count > 0) & (~is_dense)
+        if is_sparse.any():
+            sparse_nn_index, sparse_distances = self.tree.query_radius(
+                treatment_std[is_sparse], radius,
+                return_distance=True, sort_results=True,
+            )
+            for i, distance, indice in zip(
+                    np.flatnonzero(is_sparse), sparse_distances, sparse_nn_index):
+                distances[i, :len(indice)] = distance
+                nn_index[i, :len(indice)] = indice
+
+        return distances, nn_index
+
+    def distance(self, treatment_std, nn_index):
+        """Distance between each treatment sample and given control samples.
+
+        :param treatment_std: standardized treatment data, M1 x N matrix.
+        :param nn_index: M1 x k matrix of control sample index.
+
+        :returns distances: M1 x k matrix.
+        """
+        diff = treatment_std[:, None, :] - self.control_std[nn_index]
+        return np.sqrt((diff ** 2).sum(axis=2))
+
+
+def non_stratified_matching(control, treatment, k=None):
     """Find index of KNN-neighbor of control sample for treatment group.
 
-    :returns nn_index: knn index, M1 X M2 matrix. M1 is number of treatment, M2
-      is number of control.
+    :param k: (default None, rank entire control group) number of nearest
+      neighbors to find for each treatment sample.
+
+    :returns nn_index: knn index, M1 X k matrix. M1 is number of treatment, k
+      is number of neighbors (M2, number of control, if k is None).
 
     Conponent function of :func:`psm`. 
     """
     exam_input(control, treatment)
     treatment_std, control_std = normalize(treatment, control)
 
-    nbrs = NearestNeighbors(
-        n_neighbors=len(control_std), algorithm="kd_tree").fit(control_std)
-    _, nn_index = nbrs.kneighbors(treatment_std)
+    if k is None:
+        k = len(control_std)
+    _, nn_index = KNNSearcher(control_std).query(treatment_std, k)
     return nn_index
 
 
 #--- Selection ---
+def index_dtype(num_of_control):
+    """Smallest integer dtype for control sample index, int32 unless there
+    are more than 2 ** 31 - 1 control samples.
+    """
+    if num_of_control <= np.iinfo(np.int32).max:
+        return np.int32
+    else:
+        return np.int64
+
+
+def take_free(indice, taken, k):
+    """Take the first k control samples in ``indice`` that has not been 
+    taken, and mark them as taken.
+
+    ``indice`` is scanned in growing chunks, so a full ranking of control 
+    samples costs about k operations when there is no collision.
+
+    :param indice: 1-d array, control sample index, nearest first. May be
+      padded with -1 at the end.
+    :param taken: 1-d boolean array, taken mask of all control samples.
+
+    :returns selected: at most k control sample index, 1-d array.
+    """
+    return indice[_take_free_position(indice, taken, k)]
+
+
+def _take_free_position(indice, taken, k):
+    """Same as :func:`take_free`, but returns the position of selected
+    control samples in ``indice``, so their distances can be taken too.
+    """
+    # fast path, no collision
+    selected = indice[:k]
+    if len(selected) == k and selected[-1] >= 0 and not taken[selected].any():
+        taken[selected] = True
+        return np.arange(k)
+
+    position_list = list()
+    counter = 0
+    lower, size = 0, 2 * k
+    while counter < k and lower < len(indice):
+        chunk = indice[lower:lower + size]
+        valid = np.flatnonzero(chunk >= 0)
+        is_taken = taken[chunk[valid]]
+        position = valid[~is_taken][:k - counter]
+        if profiling.is_active():
+            # taken ones before the last selected one
+            n_scanned = len(valid) if len(position) < k - counter else \
+                np.flatnonzero(~is_taken)[k - counter - 1] + 1
+            profiling.count("conflicts_skipped", n_scanned - len(position))
+        taken[chunk[position]] = True
+        position_list.append(position + lower)
+        counter += len(position)
+        lower, size = lower + size, 2 * size
+
+    if len(position_list) == 1:
+        return position_list[0]
+    return np.concatenate(position_list + [np.arange(0), ])
+
+
 def non_repeat_index_matching(nn_indices, k=1):
     """All treatment samples match against different samples from control group.
 
@@ -149,6 +686,9 @@ def non_repeat_index_matching(nn_indices, k=1):
     Because treatment_sample1 already took control_25, so treatment_sample2 has
     to take control2 and control_34 (second nearest, third nearest).
 
+    Taken control samples are tracked with a boolean mask, selected ones are
+    written to a preallocated ordered buffer, see :func:`take_free`.
+
     :returns selected_control_index: all control sample been selected for 
       entire treatment group.
     :returns selected_control_index_for_each_treatment: selected control sample
@@ -165,26 +705,340 @@ def non_repeat_index_matching(nn_indices, k=1):
              "perform non repeat matching. Use independent "
              "matching instead."))
 
-    # initial all selected control group sample indices
-    selected_control_index = OrderedSet(list())
-    selected_control_index_for_each_treatment = list()
-    for indice in nn_indices:  # for indice that tr1 -> [4, 11, 6, 7, ...]
-        counter = 0
-        selected = list()
-        for ind in indice:
-            if ind not in selected_control_index:  # if has not been selected
-                selected_control_index.add(ind)
-                selected.append(ind)
-                counter += 1
-                # if already selected k control sample, then stop
-                if counter == k:
+    taken = np.zeros(num_of_control, dtype=bool)
+    selected_control_index = np.full(
+        (num_of_treatment, k), -1, dtype=index_dtype(num_of_control))
+    for i, indice in enumerate(nn_indices):  # for indice that tr1 -> [4, 11, 6, 7, ...]
+        selected_control_index[i] = take_free(indice, taken, k)
+
+    selected_control_index_for_each_treatment = selected_control_index
+    selected_control_index = selected_control_index[selected_control_index >= 0]
+
+    return selected_control_index, selected_control_index_for_each_treatment
+
+
+def lazy_non_repeat_index_matching(searcher, treatment_std, k=1, window=None,
+                                   radius=None, taken=None,
+                                   return_distance=False):
+    """Same as :func:`non_repeat_index_matching`, but doesn't need the full
+    ranking of control samples for each treatment sample.
+
+    It starts with a small candidate window of nearest neighbors for each
+    treatment sample. When a treatment sample used up its window because
+    the control samples are already taken by previous treatment samples, 
+    the ``searcher`` is asked for a window twice as large for this 
+    treatment sample only. So memory and compute scale with the number of
+    collisions, instead of M1 x M2.
+
+    :param searcher: :class:`KNNSearcher` or :class:`StratifiedSearcher`.
+    :param treatment_std: standardized treatment data, M1 x N matrix.
+    :param window: (default None, 4 * k) initial number of neighbors fetched
+      for each treatment sample.
+    :param radius: (default None, no limit) only match control samples
+      within this distance, a treatment sample may get less than k matches.
+    :param taken: (default None, nothing taken) M2 boolean array of control
+      samples already taken, updated in place. Pass the same one to match
+      treatment samples batch by batch, then a treatment sample may get less
+      than k matches when control samples run out.
+    :param return_distance: (default False) also return the distances of
+      selected control samples, taken from the neighbor query.
+
+    :returns selected_control_index: all control sample been selected for 
+      entire treatment group.
+    :returns selected_control_index_for_each_treatment: selected control sample
+      for each treatment sample, padded with -1 if less than k.
+    :returns selected_distances: only if ``return_distance``, M1 x k matrix,
+      distance of each selected control sample, padded with inf.
+
+    Conponent function of :func:`psm`.
+    """
+    num_of_control = searcher.n_control
+    num_of_treatment = len(treatment_std)
+
+    if taken is None:
+        if radius is None and k * num_of_treatment > num_of_control:
+            raise InputError(
+                ("There's no enough samples in control group to "
+                 "perform non repeat matching. Use independent "
+                 "matching instead."))
+        taken = np.zeros(num_of_control, dtype=bool)
+
+    if window is None:
+        window = 4 * k
+    with profiling.stage("query"):
+        window_distances, nn_indices = searcher.query(
+            treatment_std, window, radius)
+    profiling.count("neighbors_visited", nn_indices.size)
+
+    selected_control_index = np.full(
+        (num_of_treatment, k), -1, dtype=index_dtype(num_of_control))
+    selected_distances = np.full((num_of_treatment, k), np.inf)
+    n_expansions, n_visited = 0, 0
+    with profiling.stage("selection"):
+        for i, (distances, indice) in enumerate(
+                zip(window_distances, nn_indices)):
+            position = _take_free_position(indice, taken, k)
+            selected, distance = indice[position], distances[position]
+            while len(selected) < k:
+                # no more control sample within radius
+                if indice[-1] < 0 or len(indice) == num_of_control:
                     break
-        selected_control_index_for_each_treatment.append(selected)
+                # window used up, fetch a larger one. neighbors already
+                # visited are all taken now, so it's safe to scan again from
+                # the start
+                more_distances, more_nn_indices = searcher.query(
+                    treatment_std[i:i + 1], 2 * len(indice), radius)
+                distances, indice = more_distances[0], more_nn_indices[0]
+                n_expansions += 1
+                n_visited += len(indice)
+                position = _take_free_position(
+                    indice, taken, k - len(selected))
+                selected = np.concatenate([selected, indice[position]])
+                distance = np.concatenate([distance, distances[position]])
+            selected_control_index[i, :len(selected)] = selected
+            selected_distances[i, :len(selected)] = distance
+    profiling.count("window_expansions", n_expansions)
+    profiling.count("neighbors_visited", n_visited)
+
+    selected_control_index_for_each_treatment = selected_control_index
+    selected_control_index = selected_control_index[selected_control_index >= 0]
+
+    if return_distance:
+        return (selected_control_index,
+                selected_control_index_for_each_treatment, selected_distances)
+    return selected_control_index, selected_control_index_for_each_treatment
+
+
+def global_greedy_index_matching(searcher, treatment_std, k=1, window=None,
+                                 radius=None, return_distance=False):
+    """All treatment samples match against different samples from control 
+    group, globally nearest pair first.
+
+    Unlike :func:`non_repeat_index_matching`, which goes through treatment
+    samples in input order, the closest (treatment, control) pair among all
+    treatment samples is matched first, then the next closest, ... With a
+    stratified search engine, "closest" is the same lexicographic order of
+    the stratify rules' distances as in :class:`StratifiedSearcher`, ties
+    are broken by treatment sample, then control sample index. A heap 
+    keeps the next candidate of each treatment sample. When the popped
+    control sample is already taken, the treatment sample's next candidate 
+    is pushed back. When its candidate window is used up, the ``searcher``
+    is asked for a window twice as large. Time is 
+    O((M1 * k + conflicts) * log(M1)).
+
+    :param searcher: :class:`KNNSearcher` or :class:`StratifiedSearcher`.
+    :param treatment_std: standardized treatment data, M1 x N matrix.
+    :param window: (default None, 2 * k) initial number of neighbors fetched
+      for each treatment sample.
+    :param radius: (default None, no limit) only match control samples
+      within this distance, a treatment sample may get less than k matches.
+    :param return_distance: (default False) also return the distances of
+      selected control samples, taken from the neighbor query.
+
+    :returns selected_control_index: all control sample been selected for 
+      entire treatment group.
+    :returns selected_control_index_for_each_treatment: selected control sample
+      for each treatment sample, nearest first, padded with -1 if less than k.
+    :returns selected_distances: only if ``return_distance``, M1 x k matrix,
+      distance of each selected control sample, padded with inf.
+
+    Conponent function of :func:`psm`.
+    """
+    num_of_control = searcher.n_control
+    num_of_treatment = len(treatment_std)
+    # ParallelSearcher wraps another search engine
+    is_stratified = bool(getattr(
+        getattr(searcher, "searcher", searcher), "stratify_order", None))
+
+    def query(treatment_std, window):
+        """Neighbors and their sort keys, M1 x window x R array of the
+        stratify rules' distances, or of the distance (R = 1).
+        """
+        if is_stratified:
+            distance_list, nn_indices = searcher.query_rules(
+                treatment_std, window, radius)
+            keys = np.stack(distance_list, axis=-1)
+        else:
+            distances, nn_indices = searcher.query(
+                treatment_std, window, radius)
+            keys = distances[:, :, None]
+        return keys, nn_indices
+
+    def key_distance(key):
+        """Overall distance of a sort key, same as ``searcher.query``.
+        """
+        if is_stratified:
+            return np.sqrt(sum(d ** 2 for d in key))
+        return key[0]
+
+    if radius is None and k * num_of_treatment > num_of_control:
+        raise InputError(
+            ("There's no enough samples in control group to "
+             "perform non repeat matching. Use independent "
+             "matching instead."))
+
+    if window is None:
+        window = 2 * k
+    with profiling.stage("query"):
+        keys, nn_indices = query(treatment_std, window)
+    profiling.count("neighbors_visited", nn_indices.size)
+    # candidate windows of treatment samples that fetched a larger one,
+    # {treatment sample: (keys, nn_indice)}, the others are rows of the arrays
+    expanded = dict()
+
+    taken = np.zeros(num_of_control, dtype=bool)
+    selected_control_index = np.full(
+        (num_of_treatment, k), -1, dtype=index_dtype(num_of_control))
+    selected_distances = np.full((num_of_treatment, k), np.inf)
+    counter = np.zeros(num_of_treatment, dtype=np.intp)
+
+    # (sort key, treatment sample, position in its candidate window), a
+    # tuple is only made for the candidate in the heap
+    heap = [(tuple(key), i, 0) for i, key in enumerate(keys[:, 0].tolist())]
+    heapq.heapify(heap)
+    n_conflicts, n_expansions, n_visited = 0, 0, 0
+    with profiling.stage("selection"):
+        while heap:
+            key, i, position = heapq.heappop(heap)
+            row_keys, indice = expanded.get(i, (keys[i], nn_indices[i]))
+            ind = indice[position]
+            if ind < 0:  # no more control sample within radius
+                continue
+            if not taken[ind]:
+                taken[ind] = True
+                selected_control_index[i, counter[i]] = ind
+                selected_distances[i, counter[i]] = key_distance(key)
+                counter[i] += 1
+                if counter[i] == k:
+                    continue
+            else:
+                n_conflicts += 1
+
+            position += 1
+            if position == num_of_control:
+                continue
+            if position == len(indice):
+                # window used up, fetch a larger one
+                more_keys, more_nn_indices = query(
+                    treatment_std[i:i + 1], 2 * position)
+                row_keys, indice = more_keys[0], more_nn_indices[0]
+                expanded[i] = (row_keys, indice)
+                n_expansions += 1
+                n_visited += len(indice)
+            heapq.heappush(
+                heap, (tuple(row_keys[position].tolist()), i, position))
+    profiling.count("conflicts_skipped", n_conflicts)
+    profiling.count("window_expansions", n_expansions)
+    profiling.count("neighbors_visited", n_visited)
+
+    selected_control_index_for_each_treatment = selected_control_index
+    selected_control_index = selected_control_index[selected_control_index >= 0]
+
+    if return_distance:
+        return (selected_control_index,
+                selected_control_index_for_each_treatment, selected_distances)
+    return selected_control_index, selected_control_index_for_each_treatment
+
+
+def optimal_index_matching(searcher, treatment_std, k=1, n_candidates=None,
+                           return_distance=False):
+    """All treatment samples match against different samples from control
+    group, and the total distance of all matched pairs is minimal.
+
+    Unlike :func:`non_repeat_index_matching`, the result doesn't depend on 
+    the order of treatment samples. It's solved as a minimum weight full
+    matching on a sparse bipartite graph:
+
+    - each treatment sample is repeated k times, as k rows.
+    - each row is connected to the treatment sample's ``n_candidates``
+      nearest control samples, plus the ones the greedy
+      :func:`lazy_non_repeat_index_matching` selected. So a full matching
+      always exists, and it is never worse than the greedy one.
+
+    The total distance of both the optimal and greedy matching is logged at
+    INFO level.
+
+    :param searcher: :class:`KNNSearcher` or
+      :class:`~ctmatching.propensity.PropensitySearcher`.
+    :param treatment_std: standardized treatment data, M1 x N matrix.
+    :param n_candidates: (default None, 4 * k) number of nearest neighbors
+      of each treatment sample in the candidate graph. Larger is closer to 
+      the global optimum, but slower.
+    :param return_distance: (default False) also return the distances of
+      selected control samples.
 
-    selected_control_index = np.array(list(selected_control_index))
-    selected_control_index_for_each_treatment = np.array(
-        selected_control_index_for_each_treatment)
+    :returns selected_control_index: all control sample been selected for 
+      entire treatment group.
+    :returns selected_control_index_for_each_treatment: selected control sample
+      for each treatment sample, nearest first.
+    :returns selected_distances: only if ``return_distance``, M1 x k matrix,
+      distance of each selected control sample.
 
+    Conponent function of :func:`psm`.
+    """
+    # scipy 1.6+, only needed here
+    from scipy.sparse.csgraph import min_weight_full_bipartite_matching
+
+    with profiling.stage("greedy"):
+        _, greedy_nn_index, greedy_distances = lazy_non_repeat_index_matching(
+            searcher, treatment_std, k, return_distance=True)
+
+    if n_candidates is None:
+        n_candidates = 4 * k
+    with profiling.stage("query"):
+        distances, nn_index = searcher.query(treatment_std, n_candidates)
+    profiling.count("neighbors_visited", nn_index.size)
+
+    # candidate graph edges, (treatment, control, distance), deduplicated
+    num_of_treatment = len(treatment_std)
+    num_of_control = searcher.n_control
+    treatment_index = np.repeat(
+        np.arange(num_of_treatment), nn_index.shape[1] + k)
+    control_index = np.hstack([nn_index, greedy_nn_index]).ravel()
+    edge_distance = np.hstack([distances, greedy_distances]).ravel()
+    _, unique_edge = np.unique(
+        treatment_index.astype(np.int64) * num_of_control + control_index,
+        return_index=True,
+    )
+    treatment_index = treatment_index[unique_edge]
+    control_index = control_index[unique_edge]
+    edge_distance = edge_distance[unique_edge]
+
+    # repeat each treatment sample k times, only keep candidate controls as
+    # columns, and shift the weight by 1 because zero weight is not allowed
+    candidate_control, column = np.unique(control_index, return_inverse=True)
+    row = (treatment_index[:, None] * k + np.arange(k)).ravel()
+    column = np.repeat(column, k)
+    weight = np.repeat(edge_distance, k) + 1.0
+    biadjacency = sparse.csr_matrix(
+        (weight, (row, column)),
+        shape=(num_of_treatment * k, len(candidate_control)),
+    )
+
+    with profiling.stage("assignment"):
+        _, col_ind = min_weight_full_bipartite_matching(biadjacency)
+    selected = candidate_control[col_ind].reshape(num_of_treatment, k)
+    selected_distances = searcher.distance(treatment_std, selected)
+
+    # nearest first for each treatment sample
+    order = np.argsort(selected_distances, axis=1, kind="mergesort")
+    selected_control_index = np.take_along_axis(selected, order, axis=1) \
+        .astype(index_dtype(num_of_control))
+    selected_distances = np.take_along_axis(selected_distances, order, axis=1)
+
+    optimal_total = selected_distances.sum()
+    greedy_total = greedy_distances.sum()
+    logger.info(
+        "optimal matching total distance %.6f, greedy %.6f, gap %.6f",
+        optimal_total, greedy_total, greedy_total - optimal_total,
+    )
+
+    selected_control_index_for_each_treatment = selected_control_index
+    selected_control_index = selected_control_index[selected_control_index >= 0]
+
+    if return_distance:
+        return (selected_control_index,
+                selected_control_index_for_each_treatment, selected_distances)
     return selected_control_index, selected_control_index_for_each_treatment
 
 
@@ -196,26 +1050,74 @@ def independent_index_matching(nn_indices, k=1):
     :returns selected_control_index: all control sample been selected for 
       entire treatment group.
     :returns selected_control_index_for_each_treatment: selected control sample
-      for each treatment sample.
+      for each treatment sample. -1 in ``nn_indices`` (no neighbor within
+      radius) is kept as padding.
 
     Conponent function of :func:`psm`. 
     """
     selected_control_index_for_each_treatment = nn_indices[:, list(range(k))]
-    selected_control_index = list()
-    for indice in selected_control_index_for_each_treatment:
-        for ind in indice:
-            selected_control_index.append(ind)
-    selected_control_index = np.array(selected_control_index)
+    selected_control_index = selected_control_index_for_each_treatment[
+        selected_control_index_for_each_treatment >= 0]
 
     return selected_control_index, selected_control_index_for_each_treatment
 
 
-def psm(control, treatment, use_col=None, stratify_order=None, independent=True, k=1):
+def select_matching(searcher, treatment_std, k=1, independent=True,
+                    method="greedy", radius=None):
+    """Select matched control samples for each treatment sample, with one of
+    the selection functions.
+
+    :param searcher: :class:`KNNSearcher`, :class:`StratifiedSearcher`,
+      :class:`~ctmatching.propensity.PropensitySearcher` or
+      :class:`~ctmatching.parallel.ParallelSearcher`.
+    :param treatment_std: standardized treatment data, M1 x N matrix.
+    :param independent: see :func:`psm`.
+    :param method: see :func:`psm`.
+    :param radius: see ``caliper`` in :func:`psm`.
+
+    :returns: :class:`~ctmatching.result.MatchResult`, with the distance of
+      each match, as the selection function found it.
+
+    Conponent function of :func:`psm`.
+    """
+    if method not in ("greedy", "global_greedy", "optimal"):
+        raise InputError(
+            "method has to be one of 'greedy', 'global_greedy', 'optimal'!")
+    # ParallelSearcher wraps another search engine, StratifiedSearcher and
+    # a stratified ShardedSearcher have stratify_order
+    if method == "optimal" and getattr(
+            getattr(searcher, "searcher", searcher), "stratify_order", None):
+        raise InputError(
+            "optimal matching doesn't support stratify_order!")
+    if method == "optimal" and radius is not None:
+        raise InputError("optimal matching doesn't support caliper!")
+
+    if independent:
+        with profiling.stage("query"):
+            distances, nn_index = searcher.query(treatment_std, k, radius)
+        profiling.count("neighbors_visited", nn_index.size)
+    elif method == "global_greedy":
+        _, nn_index, distances = global_greedy_index_matching(
+            searcher, treatment_std, k, radius=radius, return_distance=True)
+    elif method == "optimal":
+        _, nn_index, distances = optimal_index_matching(
+            searcher, treatment_std, k, return_distance=True)
+    else:
+        _, nn_index, distances = lazy_non_repeat_index_matching(
+            searcher, treatment_std, k, radius=radius, return_distance=True)
+    return MatchResult.from_padded(
+        nn_index, distances, index_dtype(searcher.n_control))
+
+
+def psm(control, treatment, use_col=None, stratify_order=None, independent=True, k=1,
+        block_size=None, method="greedy", propensity=None, caliper=None,
+        chunk_size=None, n_jobs=None, exact_cols=None, metric="euclidean",
+        profile=None, shard_size=None):
     """Propensity score matching main function.
 
     If you want to know the inside of the psm algorithm, check 
-    :func:`stratified_matching`, :func:`non_stratified_matching`,
-    :func:`non_repeat_index_matching`, :func:`independent_index_matching`.
+    :class:`StratifiedSearcher`, :class:`KNNSearcher`,
+    :func:`lazy_non_repeat_index_matching`, :func:`independent_index_matching`.
     otherwise, just read the parameters' definition.
 
     Suppose we have m1 control samples, m2 treatment samples. Sample is 
@@ -237,6 +1139,13 @@ def psm(control, treatment, use_col=None, stratify_order=None, independent=True,
          [tm1_1, tm1_2, ..., tm1_n],]
 
     :type treatment: numpy.ndarray
+
+    Both control and treatment can also be a ``numpy.memmap``, or path of a
+    ``.npy`` file (which is memory mapped). They are never copied as a 
+    whole, only the used columns are standardized chunk by chunk, see 
+    :func:`standardize`. Standardized memory mapped control data is written
+    to a temporary file, so peak memory stays about one chunk.
+
     :param use_col: (default None, use all) list of column index. Example::
 
         [0, 1, 4, 6, 7, 9] # use first, second, fifth, ... columns
@@ -261,10 +1170,91 @@ def psm(control, treatment, use_col=None, stratify_order=None, independent=True,
     :param k: (default 1) Number of samples selected from control group.
     :type k: int
 
-    :returns selected_control_index: all control sample been selected for 
-      entire treatment group.
-    :returns selected_control_index_for_each_treatment: selected control sample
-      for each treatment sample.
+    :param method: (default "greedy") how to select control samples when
+      ``independent=False``. "greedy": treatment samples take their nearest
+      not yet taken control samples one by one, in input order, see
+      :func:`lazy_non_repeat_index_matching`. "global_greedy": globally 
+      nearest (treatment, control) pair first, see
+      :func:`global_greedy_index_matching`. "optimal": minimize total
+      distance of all matched pairs, see :func:`optimal_index_matching`, 
+      not available with ``stratify_order``.
+    :type method: str
+
+    :param propensity: (default None, match on all features) "logit" or
+      "probability", estimate propensity score with a logistic regression of
+      treatment on features, then match on the 1-d score (or its logit)
+      instead, see :mod:`ctmatching.propensity`. Not available with 
+      ``stratify_order``.
+    :type propensity: str
+
+    :param caliper: (default None, no limit) maximum distance of a matched
+      pair, in standardized distance unit (overall distance over all stratify
+      rules for stratified matching), or in propensity score (logit) unit
+      with ``propensity``. Control samples out of caliper are never ranked,
+      except with ``propensity``, where the 2k nearest scores are ranked
+      first and the ones out of caliper masked afterwards. A treatment
+      sample may get less than k, or no match at all, then its row in
+      selected_control_index_for_each_treatment is padded with -1.
+      Not available with ``method="optimal"``.
+    :type caliper: float
+
+    :param block_size: (default None, automatic) number of treatment samples
+      processed at once in stratified matching, peak memory is about
+      block_size * m1 float. See
+      :class:`StratifiedSearcher`.
+    :type block_size: int
+
+    :param chunk_size: (default None, automatic) number of rows standardized
+      at once, see :func:`iter_chunks`.
+    :type chunk_size: int
+
+    :param n_jobs: (default None, one CPU core) number of worker processes
+      for neighbor search, -1 to use all CPU cores. Standardized control data
+      is put in shared memory, see :mod:`ctmatching.parallel`. Selection
+      still runs in one process, so the result is the same as ``n_jobs=1``.
+      Ignored with ``propensity``, searching a 1-d score is already cheap.
+    :type n_jobs: int
+
+    :param exact_cols: (default None, no exact match) list of column index
+      that must match exactly, like ``black`` or ``married`` in re78. Samples
+      are partitioned into blocks by values of those columns, and each block
+      is matched on its own, on ``use_col`` (which doesn't need to include
+      ``exact_cols``). With independent matching or ``caliper``, a
+      treatment sample gets less than k (or no) matches when its block runs
+      out of control samples, padded with -1. Non repeat matching without
+      ``caliper`` raises :class:`~ctmatching.exc.InputError` instead, when
+      a block has less than k control samples per treatment sample. With
+      ``n_jobs``, blocks are matched in parallel.
+      See :mod:`ctmatching.blocking`. Not available with ``propensity``.
+    :type exact_cols: list
+
+    :param metric: (default "euclidean") "euclidean" or "mahalanobis", for
+      all columns, or a list of it, one for each rule in ``stratify_order``.
+      Mahalanobis distance uses the pooled within group covariance of both
+      groups. It's done by whitening the data once, see
+      :func:`metric_matrix`, so the same fast euclidean search engines are
+      used. Not available with ``propensity``.
+    :type metric: str or list
+
+    :param profile: (default None, no profiling) True, to log wall time and
+      peak memory of each stage, and hot path counters, as events of the
+      ``ctmatching.profiling`` logger. A callable, to be called with each
+      event dict too. Or a :class:`~ctmatching.profiling.Profiler`, to read
+      all of them as a dict afterwards.
+    :type profile: bool, callable or Profiler
+
+    :param shard_size: (default None, no sharding) number of control samples
+      per shard, for control groups larger than memory. Standardized control
+      data is written to a temporary file, each shard of it is searched on
+      its own, and the per shard top-k candidates are merged, see
+      :mod:`ctmatching.sharding`. The result is the same as without
+      sharding, except for the order of tied neighbors. Not available with
+      ``n_jobs`` or ``exact_cols``, ignored with ``propensity``.
+    :type shard_size: int
+
+    :returns: :class:`~ctmatching.result.MatchResult`, with distance of
+      each match, which unpacks into selected_control_index and
+      selected_control_index_for_each_treatment, as in older versions.
 
     selected_control_index: selected control sample index. Example (k = 3)::
 
@@ -284,45 +1274,269 @@ def psm(control, treatment, use_col=None, stratify_order=None, independent=True,
     :raises NotEnoughControlSampleError: if don't have sufficient data for 
       independent index matching.
     """
-    if not isinstance(control, np.ndarray):
-        control = np.array(control)
-    if not isinstance(treatment, np.ndarray):
-        treatment = np.array(treatment)
+    args = (control, treatment, use_col, stratify_order, independent, k,
+            block_size, method, propensity, caliper, chunk_size, n_jobs,
+            exact_cols, metric, shard_size)
+    profiler = profiling.get_profiler(profile)
+    if profiler is None:
+        return _psm(*args)
+
+    with profiler:
+        with profiler.stage("psm"):
+            result = _psm(*args)
+    logger.info("psm profile: %s", profiler.to_dict())
+    return result
+
+
+def _psm(control, treatment, use_col, stratify_order, independent, k,
+         block_size, method, propensity, caliper, chunk_size, n_jobs,
+         exact_cols, metric, shard_size):
+    """:func:`psm` without profiler setup.
+    """
+    control = load_array(control)
+    treatment = load_array(treatment)
 
     # select useful columns
     if use_col:
-        control_used = control[:, use_col].astype(float)
-        treatment_used = treatment[:, use_col].astype(float)
-    else:
-        control_used, treatment_used = control, treatment
-
-    # knn-match
-    if stratify_order:
-        nn_index = stratified_matching(
-            control_used, treatment_used, stratify_order)
+        exam_input(control[:1, use_col], treatment[:1, use_col], stratify_order)
     else:
-        nn_index = non_stratified_matching(control_used, treatment_used)
-
-    # select paired
-    if independent:
-        (
-            selected_control_index,
-            selected_control_index_for_each_treatment,
-        ) = independent_index_matching(nn_index, k)
+        exam_input(control, treatment, stratify_order)
+    if propensity not in (None, "logit", "probability"):
+        raise InputError(
+            "propensity has to be one of None, 'logit', 'probability'!")
+    if propensity and stratify_order:
+        raise InputError(
+            "propensity score matching doesn't support stratify_order!")
+    if exact_cols:
+        if propensity:
+            raise InputError(
+                "propensity score matching doesn't support exact_cols!")
+        exact_cols = [int(i) for i in exact_cols]
+        if max(exact_cols) >= control.shape[1] or min(exact_cols) < 0:
+            raise InputError("exact_cols out of range!")
+    metrics = [metric] if isinstance(metric, str) else list(metric)
+    if not set(metrics) <= {"euclidean", "mahalanobis"}:
+        raise InputError(
+            "metric has to be 'euclidean' or 'mahalanobis'!")
+    if not isinstance(metric, str) and \
+            len(metrics) != len(stratify_order or []):
+        raise InputError(
+            "metric list needs one metric for each rule in stratify_order!")
+    if propensity and "mahalanobis" in metrics:
+        raise InputError(
+            "propensity score matching doesn't support mahalanobis metric!")
+    if shard_size is not None:
+        if shard_size < 1:
+            raise InputError("shard_size has to be a positive integer!")
+        if exact_cols or (n_jobs is not None and n_jobs != 1):
+            raise InputError(
+                "shard_size doesn't support n_jobs or exact_cols!")
+    sharded = shard_size is not None and not propensity
+
+    # standardize with treatment group's mean and variance
+    with profiling.stage("column_stats"):
+        mean, scale = column_stats(treatment, use_col, chunk_size)
+    matrix = None
+    if "mahalanobis" in metrics:
+        with profiling.stage("covariance"):
+            cov = pooled_covariance(control, treatment, use_col, chunk_size)
+            matrix, stratify_order = metric_matrix(
+                cov, scale, stratify_order, metric)
+    n_features = len(mean) if matrix is None else matrix.shape[1]
+    with profiling.stage("standardize"):
+        treatment_std = standardize(
+            treatment, mean, scale, use_col, chunk_size, matrix=matrix)
+    parallel = (n_jobs is not None and n_jobs != 1 and
+                not propensity and not exact_cols)
+    shared = None
+    if parallel:
+        from ctmatching.parallel import SharedArray
+        shared = SharedArray((len(control), n_features))
+        out = shared.array
+    elif sharded or isinstance(control, np.memmap):
+        # the mapping stays valid after the file is closed
+        with tempfile.TemporaryFile() as temporary_file:
+            out = np.memmap(
+                temporary_file, dtype=float, mode="w+",
+                shape=(len(control), n_features),
+            )
     else:
-        (
-            selected_control_index,
-            selected_control_index_for_each_treatment,
-        ) = non_repeat_index_matching(nn_index, k)
-
-    return selected_control_index, selected_control_index_for_each_treatment
+        out = None
+    # ParallelSearcher.close releases shared memory too, this is for errors
+    # before it exists
+    try:
+        with profiling.stage("standardize"):
+            control_std = standardize(
+                control, mean, scale, use_col, chunk_size, out, matrix)
+
+        if exact_cols:
+            from ctmatching.blocking import exact_blocks, block_matching
+            with profiling.stage("exact_blocks"):
+                control_block, treatment_block, _ = exact_blocks(
+                    control[:, exact_cols], treatment[:, exact_cols])
+            with profiling.stage("block_matching"):
+                return block_matching(
+                    control_std, treatment_std, control_block, treatment_block,
+                    k, independent, method, caliper, stratify_order, block_size,
+                    n_jobs,
+                )
+
+        # knn-match
+        if propensity:
+            with profiling.stage("propensity_score"):
+                control_score, treatment_score = propensity_score(
+                    control_std, treatment_std, logit=(propensity == "logit"))
+            treatment_std = treatment_score  # match on 1-d score from now on
+        with profiling.stage("build_searcher"):
+            if propensity:
+                searcher = PropensitySearcher(control_score)
+            elif sharded:
+                from ctmatching.sharding import ShardedSearcher
+                searcher = ShardedSearcher(
+                    [control_std[lower:lower + shard_size]
+                     for lower in range(0, len(control_std), shard_size)],
+                    stratify_order, block_size,
+                )
+            elif stratify_order:
+                searcher = StratifiedSearcher(
+                    control_std, stratify_order, block_size)
+            else:
+                searcher = KNNSearcher(control_std)
+
+        # select paired
+        if parallel:
+            from ctmatching.parallel import ParallelSearcher
+            with ParallelSearcher(searcher, n_jobs, shared) as searcher:
+                return select_matching(
+                    searcher, treatment_std, k, independent, method, caliper)
+        return select_matching(
+            searcher, treatment_std, k, independent, method, caliper)
+    finally:
+        if shared is not None:
+            shared.unlink()
 
 
 def grouper(control, treatment, selected_control_index_for_each_treatment):
     """Generate treatment sample and matched control samples pair.
+
+    :param selected_control_index_for_each_treatment: M1 x k matrix, or a
+      :class:`~ctmatching.result.MatchResult`.
     """
-    control, treatment = np.array(control), np.array(treatment)
+    if isinstance(selected_control_index_for_each_treatment, MatchResult):
+        selected_control_index_for_each_treatment = \
+            selected_control_index_for_each_treatment \
+            .selected_control_index_for_each_treatment
+    control, treatment = load_array(control), load_array(treatment)
     for treatment_sample, index in zip(
             treatment, selected_control_index_for_each_treatment):
-        control_samples = control[index]
+        index = np.asarray(index)
+        control_samples = control[index[index >= 0]]  # -1 means no match
         yield treatment_sample, control_samples
+
+
+def _gather(data, index, use_col, dtype):
+    """Rows ``index`` of used columns of data, only those rows are read.
+    """
+    if use_col:
+        rows = data[np.ix_(index, use_col)]
+    else:
+        rows = data[index]
+    if dtype is not None:
+        rows = rows.astype(dtype, copy=False)
+    return rows
+
+
+def iter_batch_grouper(control, treatment,
+                       selected_control_index_for_each_treatment,
+                       use_col=None, chunk_size=None, dtype=float,
+                       fill=np.nan):
+    """Batched :func:`grouper`, iterate over chunks of treatment samples,
+    with their matched control samples as one 3-d block. Only one chunk is
+    copied into memory at a time, so it works on memory mapped data of any
+    size.
+
+    :param control: 2-d ndarray like data, ``numpy.memmap`` or path of
+      ``.npy`` file, see :func:`load_array`.
+    :param treatment: same as ``control``.
+    :param selected_control_index_for_each_treatment: M1 x k matrix, or a
+      :class:`~ctmatching.result.MatchResult`.
+    :param use_col: (default None, all columns) list of column index to
+      return.
+    :param chunk_size: (default None, automatic) number of treatment samples
+      per chunk. By default, each control block has about
+      :data:`BLOCK_ELEMENTS` elements.
+    :param dtype: (default float) dtype of the returned blocks, None to keep
+      the dtype of data.
+    :param fill: (default nan) value of the padding, where a treatment
+      sample has less than k matches.
+
+    :returns: iterator of ``(treatment_chunk, control_block)``, where
+      ``treatment_chunk`` is a C x n matrix of a chunk of C treatment
+      samples, and ``control_block[i, j]`` is the j-th matched control
+      sample of ``treatment_chunk[i]``, a C x k x n array.
+    """
+    if isinstance(selected_control_index_for_each_treatment, MatchResult):
+        selected_control_index_for_each_treatment = \
+            selected_control_index_for_each_treatment \
+            .selected_control_index_for_each_treatment
+    selected = np.asarray(selected_control_index_for_each_treatment)
+    control, treatment = load_array(control), load_array(treatment)
+    if selected.ndim != 2 or len(selected) != len(treatment):
+        raise InputError(
+            "selected_control_index_for_each_treatment has to be a M1 x k "
+            "matrix!")
+    if use_col:
+        use_col = [int(i) for i in use_col]
+    n_features = len(use_col) if use_col else control.shape[1]
+    if chunk_size is None:
+        chunk_size = max(
+            1, BLOCK_ELEMENTS // max(1, selected.shape[1] * n_features))
+
+    # at least one chunk, so the block shape is known without treatment
+    for lower in range(0, max(1, len(treatment)), chunk_size):
+        index = selected[lower:lower + chunk_size]
+        is_matched = index >= 0  # -1 means no match
+        rows = _gather(control, index[is_matched], use_col, dtype)
+        control_block = np.full(index.shape + (n_features,), fill,
+                                dtype=rows.dtype)
+        control_block[is_matched] = rows
+        treatment_chunk = _gather(
+            treatment, np.arange(lower, lower + len(index)), use_col, dtype)
+        yield treatment_chunk, control_block
+
+
+def batch_grouper(control, treatment,
+                  selected_control_index_for_each_treatment, use_col=None,
+                  chunk_size=None, dtype=float, fill=np.nan, out=None):
+    """Matched control samples of all treatment samples as one M1 x k x n
+    block, ``block[i, j]`` is the j-th matched control sample of treatment
+    sample i, so it lines up with ``treatment[:, None, :]``::
+
+        >>> result = psm(control, treatment, use_col=use_col, k=3)
+        >>> block = batch_grouper(control, treatment, result, use_col=use_col)
+        >>> difference = np.nanmean(block, axis=1) - treatment[:, use_col]
+
+    :param out: (default None, new array) preallocated M1 x k x n array or
+      ``numpy.memmap`` to write into, chunk by chunk. Peak memory is then one
+      chunk, see :func:`iter_batch_grouper`.
+
+    Other parameters are the same as :func:`iter_batch_grouper`.
+
+    :returns block: M1 x k x n array, padded with ``fill``.
+    """
+    chunks = iter_batch_grouper(
+        control, treatment, selected_control_index_for_each_treatment,
+        use_col, chunk_size, dtype, fill)
+    if out is None:
+        blocks = [control_block for _, control_block in chunks]
+        return blocks[0] if len(blocks) == 1 else np.concatenate(blocks)
+
+    lower = 0
+    for _, control_block in chunks:
+        if out.shape[1:] != control_block.shape[1:]:
+            raise InputError("out has to be a M1 x k x n array!")
+        out[lower:lower + len(control_block)] = control_block
+        lower += len(control_block)
+    if lower != len(out):
+        raise InputError("out has to be a M1 x k x n array!")
+    return out
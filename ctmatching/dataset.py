@@ -13,12 +13,29 @@ About re78 data:
 Full description of this data: http://users.nber.org/~rdehejia/data/nswdata2.html.
 If this link is not available, try this:
 https://github.com/MacHu-GWU/ctmatching-project/blob/master/ctmatching/testdata/re78-readme.html
+
+re78 is too small for anything about performance, :func:`make_synthetic`
+generates data sets like it of any size. :func:`load_table` loads a csv file
+of any size into float arrays ready for :func:`~ctmatching.core.psm`.
 """
 
 import os
+
+try:
+    from .exc import InputError
+    from .core import BLOCK_ELEMENTS
+except:
+    from ctmatching.exc import InputError
+    from ctmatching.core import BLOCK_ELEMENTS
+
+import pandas as pd
 import numpy as np
 
 
+#: path of re78 csv file
+RE78_PATH = os.path.join(os.path.dirname(__file__), "testdata", "re78.txt")
+
+
 def load_re78():
     """re78 dataset loader.
 
@@ -30,10 +47,14 @@ def load_re78():
         429
         >>> len(treat)
         185
+
+    Rows are lists, with the string ``ID`` column. For float arrays, use
+    :func:`load_table`::
+
+        >>> control, treat, control_id, treat_id = load_table(
+        ...     RE78_PATH, "treat", id_col="ID")
     """
-    abspath = os.path.join(os.path.dirname(__file__), "testdata", "re78.txt")
-    
-    with open(abspath, "rb") as f:
+    with open(RE78_PATH, "rb") as f:
         lines = f.read().decode("utf-8").split("\n")
 
     columns = lines[0].strip().split(",")
@@ -57,6 +78,245 @@ def load_re78():
     return control, treatment
 
 
+def make_synthetic(n_control, n_treatment, n_features=6, n_binary=2,
+                   overlap=0.5, seed=None, path=None, chunk_size=None):
+    """Generate a synthetic control and treatment group, with mixed
+    covariates like re78.
+
+    Each sample has a hidden confounder ``z ~ Normal(mu, 1)``, ``mu`` is 0
+    for control group and ``3 * (1 - overlap)`` for treatment group. Every
+    covariate depends on ``z`` with a random loading:
+
+    - first ``n_binary`` columns are binary, like ``black`` or ``married``,
+      ``Bernoulli(sigmoid(a + b * z))``.
+    - half of the rest are integer counts, like ``age`` or ``educ``,
+      ``Poisson(exp(a + b * z))``.
+    - the others are skewed continuous, like earnings ``re74``,
+      ``exp(Normal(a + b * z, 1))``.
+
+    Rows are generated chunk by chunk, each chunk with its own random
+    stream derived from ``seed``. With ``path``, chunks are written straight
+    into memory mapped ``.npy`` files, so peak memory is one chunk, no matter
+    how many rows.
+
+    :param n_control: number of control samples.
+    :param n_treatment: number of treatment samples.
+    :param n_features: (default 6) number of columns.
+    :param n_binary: (default 2) number of binary columns.
+    :param overlap: (default 0.5) from 0 to 1, 1 means both groups have the
+      same distribution (no confounding), 0 means very little common
+      support.
+    :param seed: (default None, random) seed, same seed and chunk_size
+      generate the same data, in memory or on disk.
+    :param path: (default None, in memory) directory to write
+      ``control.npy`` and ``treatment.npy`` into, created if not exists.
+    :param chunk_size: (default None, automatic) number of rows generated at
+      once, see :func:`~ctmatching.core.iter_chunks`.
+
+    :returns control: M2 x N float array, ``numpy.memmap`` with ``path``.
+    :returns treatment: M1 x N float array, ``numpy.memmap`` with ``path``.
+    """
+    if not 0 <= n_binary <= n_features:
+        raise InputError("n_binary has to be between 0 and n_features!")
+    if not 0 <= overlap <= 1:
+        raise InputError("overlap has to be between 0 and 1!")
+    if chunk_size is None:
+        chunk_size = max(1, BLOCK_ELEMENTS // n_features)
+
+    seed_sequence = np.random.SeedSequence(seed)
+    loading_seed, control_seed, treatment_seed = seed_sequence.spawn(3)
+
+    # intercept and loading on z of each column
+    rng = np.random.default_rng(loading_seed)
+    n_integer = (n_features - n_binary) // 2
+    intercept = np.concatenate([
+        rng.normal(0.0, 1.0, n_binary),
+        rng.uniform(1.0, 3.0, n_integer),
+        rng.uniform(6.0, 9.0, n_features - n_binary - n_integer),
+    ])
+    loading = rng.uniform(0.2, 0.8, n_features) * \
+        rng.choice([-1.0, 1.0], n_features)
+    is_binary = np.arange(n_features) < n_binary
+    is_integer = (~is_binary) & (np.arange(n_features) < n_binary + n_integer)
+    is_continuous = ~(is_binary | is_integer)
+
+    def generate(rng, n_rows, mu):
+        z = rng.normal(mu, 1.0, (n_rows, 1))
+        linear = intercept + loading * z
+        chunk = np.empty((n_rows, n_features))
+        chunk[:, is_binary] = rng.random(
+            (n_rows, is_binary.sum())) < 1 / (1 + np.exp(-linear[:, is_binary]))
+        chunk[:, is_integer] = rng.poisson(np.exp(linear[:, is_integer]))
+        chunk[:, is_continuous] = np.exp(
+            rng.normal(linear[:, is_continuous], 1.0))
+        return chunk
+
+    if path is not None and not os.path.exists(path):
+        os.makedirs(path)
+
+    result = list()
+    for name, n_rows, mu, group_seed in [
+        ("control", n_control, 0.0, control_seed),
+        ("treatment", n_treatment, 3.0 * (1 - overlap), treatment_seed),
+    ]:
+        shape = (n_rows, n_features)
+        if path is None:
+            data = np.empty(shape)
+        else:
+            data = np.lib.format.open_memmap(
+                os.path.join(path, "%s.npy" % name), mode="w+", shape=shape)
+        n_chunks = (n_rows + chunk_size - 1) // chunk_size
+        for chunk_seed, lower in zip(group_seed.spawn(n_chunks),
+                                     range(0, n_rows, chunk_size)):
+            upper = min(lower + chunk_size, n_rows)
+            data[lower:upper] = generate(
+                np.random.default_rng(chunk_seed), upper - lower, mu)
+        if path is not None:
+            data.flush()
+        result.append(data)
+
+    return tuple(result)
+
+
+def load_table(path, treat_col, feature_cols=None, dtype=float, id_col=None,
+               chunk_size=None, out_dir=None, **kwargs):
+    """Load a csv file into control and treatment group, with the C parser
+    of ``pandas.read_csv``.
+
+    With ``chunk_size``, the file is read chunk by chunk. With ``out_dir``,
+    the file is read twice, first to count rows of each group, then chunks
+    are written straight into memory mapped ``.npy`` files (``control.npy``,
+    ``treatment.npy``, ``control_id.npy``, ``treatment_id.npy``), so files
+    bigger than memory can be loaded, and passed to
+    :func:`~ctmatching.core.psm` as they are.
+
+    :param path: csv file path.
+    :param treat_col: name or position of treatment flag column, non zero
+      means treatment.
+    :param feature_cols: (default None, all other columns) list of name or
+      position of feature columns.
+    :param dtype: (default float) dtype of feature arrays.
+    :param id_col: (default None, no id) name or position of sample id
+      column, loaded as string.
+    :param chunk_size: (default None, read at once; 1,000,000 with
+      ``out_dir``) number of rows read at once.
+    :param out_dir: (default None, in memory) directory to write ``.npy``
+      files into, created if not exists.
+    :param kwargs: other arguments of ``pandas.read_csv``, like ``sep``.
+
+    :returns control: M2 x N C-contiguous array of feature columns.
+    :returns treatment: M1 x N C-contiguous array of feature columns.
+    :returns control_id: 1-d string array, M2 sample id, None without
+      ``id_col``.
+    :returns treatment_id: 1-d string array, M1 sample id, None without
+      ``id_col``.
+
+    :raises InputError: if a column is not in the file.
+    """
+    columns = list(pd.read_csv(path, nrows=0, **kwargs).columns)
+
+    def resolve(col):
+        if isinstance(col, (int, np.integer)):
+            if not 0 <= col < len(columns):
+                raise InputError("column %s is out of range!" % col)
+            return columns[col]
+        if col not in columns:
+            raise InputError("column %r is not in %s!" % (col, path))
+        return col
+
+    treat_col = resolve(treat_col)
+    if id_col is not None:
+        id_col = resolve(id_col)
+    if feature_cols is None:
+        feature_cols = [col for col in columns if col not in (treat_col, id_col)]
+    else:
+        feature_cols = [resolve(col) for col in feature_cols]
+    column_dtype = dict.fromkeys(feature_cols, dtype)
+    if id_col is not None:
+        column_dtype[id_col] = str
+
+    def read(usecols):
+        if out_dir is not None and chunk_size is None:
+            size = 1000000
+        else:
+            size = chunk_size
+        reader = pd.read_csv(
+            path, usecols=usecols, dtype=column_dtype, chunksize=size,
+            **kwargs)
+        return [reader] if size is None else reader
+
+    def split(frame):
+        is_treated = frame[treat_col].to_numpy() != 0
+        # ndarray from a DataFrame is column major
+        features = np.ascontiguousarray(
+            frame[feature_cols].to_numpy(dtype=dtype))
+        if id_col is None:
+            ids = None
+        else:
+            ids = frame[id_col].to_numpy().astype(str)
+        return is_treated, features, ids
+
+    groups = [("control", np.logical_not), ("treatment", np.asarray)]
+    flag_cols = [treat_col] + ([] if id_col is None else [id_col])
+    usecols = feature_cols + flag_cols
+
+    if out_dir is None:
+        result = {"control": [], "treatment": [],
+                  "control_id": [], "treatment_id": []}
+        for frame in read(usecols):
+            is_treated, features, ids = split(frame)
+            for name, select in groups:
+                result[name].append(features[select(is_treated)])
+                if ids is not None:
+                    result[name + "_id"].append(ids[select(is_treated)])
+        return tuple(
+            np.concatenate(result[name]) if result[name] else None
+            for name in ["control", "treatment", "control_id", "treatment_id"]
+        )
+
+    # first pass, count rows and length of id
+    count = {"control": 0, "treatment": 0}
+    id_length = 1
+    for frame in read(flag_cols):
+        n_treated = int((frame[treat_col].to_numpy() != 0).sum())
+        count["treatment"] += n_treated
+        count["control"] += len(frame) - n_treated
+        if id_col is not None and len(frame):
+            id_length = max(id_length, int(frame[id_col].str.len().max()))
+
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    arrays = dict()
+    for name, _ in groups:
+        arrays[name] = np.lib.format.open_memmap(
+            os.path.join(out_dir, "%s.npy" % name), mode="w+", dtype=dtype,
+            shape=(count[name], len(feature_cols)))
+        if id_col is not None:
+            arrays[name + "_id"] = np.lib.format.open_memmap(
+                os.path.join(out_dir, "%s_id.npy" % name), mode="w+",
+                dtype="U%s" % id_length, shape=(count[name],))
+
+    # second pass, write chunks
+    position = {"control": 0, "treatment": 0}
+    for frame in read(usecols):
+        is_treated, features, ids = split(frame)
+        for name, select in groups:
+            is_selected = select(is_treated)
+            lower = position[name]
+            upper = lower + int(is_selected.sum())
+            arrays[name][lower:upper] = features[is_selected]
+            if ids is not None:
+                arrays[name + "_id"][lower:upper] = ids[is_selected]
+            position[name] = upper
+
+    for array in arrays.values():
+        array.flush()
+    return tuple(
+        arrays.get(name)
+        for name in ["control", "treatment", "control_id", "treatment_id"]
+    )
+
+
 if __name__ == "__main__":
     control, treatment = load_re78()
     assert len(control) == 429
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Reusable control group index.
+
+:func:`~ctmatching.core.psm` refits the scaler and rebuilds the search tree
+on every call. When the same control group is matched against many
+treatment groups (for example a new treatment cohort every day), fit a
+:class:`ControlIndex` once, save it to disk, and only run the query side for
+each treatment group::
+
+    >>> from ctmatching import ControlIndex
+    >>> index = ControlIndex.fit(control, use_col=[2, 3, 4, 5, 6, 7])
+    >>> index.save("control-index")
+    >>> index = ControlIndex.load("control-index") # memory mapped
+    >>> selected_control_index, selected_control_index_for_each_treatment = \\
+    ...     index.match(treatment, k=3, independent=False)
+
+When treatment samples come from a stream, match them batch by batch with
+:func:`psm_iter`::
+
+    >>> for treatment_row_id, control_ids, distances in psm_iter(
+    ...         index, treatment_batches, k=3, independent=False):
+    ...     ...
+"""
+
+import json
+import os
+import pickle
+
+try:
+    from .exc import InputError
+    from .core import (
+        load_array, column_stats, standardize, exam_input,
+        KNNSearcher, StratifiedSearcher, select_matching,
+        lazy_non_repeat_index_matching,
+    )
+except:
+    from ctmatching.exc import InputError
+    from ctmatching.core import (
+        load_array, column_stats, standardize, exam_input,
+        KNNSearcher, StratifiedSearcher, select_matching,
+        lazy_non_repeat_index_matching,
+    )
+
+import sklearn
+from sklearn.neighbors import KDTree
+import numpy as np
+
+
+class ControlIndex(object):
+    """Standardized control group with its scaler statistics and search
+    engine, ready to be matched against any treatment group.
+
+    Unlike :func:`~ctmatching.core.psm`, which standardizes both groups with
+    the treatment group's mean and variance, the control group's mean and
+    variance are used, because the treatment group is unknown at fit time.
+
+    Use :meth:`fit` or :meth:`load` to create one.
+
+    :param mean: 1-d array, mean of each used column of control group.
+    :param scale: 1-d array, standard deviation of each used column of
+      control group (1 for constant column).
+    :param searcher: :class:`~ctmatching.core.KNNSearcher` or
+      :class:`~ctmatching.core.StratifiedSearcher` over standardized control
+      group.
+    :param use_col: see :func:`~ctmatching.core.psm`.
+    :param stratify_order: see :func:`~ctmatching.core.psm`.
+    """
+
+    def __init__(self, mean, scale, searcher,
+                 use_col=None, stratify_order=None):
+        self.mean = mean
+        self.scale = scale
+        self.searcher = searcher
+        self.use_col = use_col
+        self.stratify_order = stratify_order
+
+    @classmethod
+    def fit(cls, control, use_col=None, stratify_order=None, block_size=None,
+            chunk_size=None):
+        """Fit scaler statistics on control group and build the search engine.
+
+        :param control: control group sample data, ``numpy.memmap`` or path
+          of ``.npy`` file, see :func:`~ctmatching.core.psm`.
+        :param use_col: see :func:`~ctmatching.core.psm`.
+        :param stratify_order: see :func:`~ctmatching.core.psm`.
+        :param block_size: see :func:`~ctmatching.core.psm`.
+        :param chunk_size: see :func:`~ctmatching.core.psm`.
+        """
+        control = load_array(control)
+
+        if use_col:
+            use_col = [int(i) for i in use_col]
+            exam_input(control[:1, use_col], control[:1, use_col],
+                       stratify_order)
+        else:
+            exam_input(control, control, stratify_order)
+
+        mean, scale = column_stats(control, use_col, chunk_size)
+        control_std = standardize(control, mean, scale, use_col, chunk_size)
+
+        if stratify_order:
+            stratify_order = [[int(i) for i in chunk] for chunk in stratify_order]
+            searcher = StratifiedSearcher(
+                control_std, stratify_order, block_size)
+        else:
+            searcher = KNNSearcher(control_std)
+        return cls(mean, scale, searcher, use_col, stratify_order)
+
+    def transform(self, treatment):
+        """Select used columns of treatment group and standardize it with
+        control group's scaler statistics.
+
+        :param treatment: treatment group sample data, see
+          :func:`~ctmatching.core.psm`.
+        """
+        treatment = load_array(treatment)
+        if self.use_col:
+            n_features = len(self.use_col)
+        else:
+            n_features = treatment.shape[1]
+        if n_features != len(self.mean):
+            raise InputError(
+                "control sample and treatment sample are different in size!")
+        return standardize(treatment, self.mean, self.scale, self.use_col)
+
+    def match(self, treatment, k=1, independent=True, method="greedy",
+              caliper=None):
+        """Match treatment group against the control group. Only the query
+        side runs, nothing of the control group is refitted.
+
+        :param treatment: treatment group sample data, see
+          :func:`~ctmatching.core.psm`.
+        :param k: see :func:`~ctmatching.core.psm`.
+        :param independent: see :func:`~ctmatching.core.psm`.
+        :param method: see :func:`~ctmatching.core.psm`.
+        :param caliper: see :func:`~ctmatching.core.psm`.
+
+        :returns selected_control_index: see :func:`~ctmatching.core.psm`.
+        :returns selected_control_index_for_each_treatment: see
+          :func:`~ctmatching.core.psm`.
+        """
+        treatment_std = self.transform(treatment)
+        return select_matching(
+            self.searcher, treatment_std, k, independent, method, caliper)
+
+    #--- Persistence ---
+    def save(self, path):
+        """Save to a directory. Arrays are saved as ``.npy`` files, so they
+        can be memory mapped by :meth:`load`.
+
+        :param path: directory path, created if not exists.
+        """
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        # KD-tree needs C-contiguous array
+        control_std = np.ascontiguousarray(self.searcher.control_std)
+        np.save(os.path.join(path, "mean.npy"), self.mean)
+        np.save(os.path.join(path, "scale.npy"), self.scale)
+        np.save(os.path.join(path, "control_std.npy"), control_std)
+
+        meta = {
+            "use_col": self.use_col,
+            "stratify_order": self.stratify_order,
+            "block_size": getattr(self.searcher, "block_size", None),
+            "sklearn_version": sklearn.__version__,
+            "tree_arrays": dict(),
+        }
+
+        if isinstance(self.searcher, KNNSearcher):
+            # arrays of the tree are saved as .npy, the rest is pickled
+            state = list(self.searcher.tree.__getstate__())
+            for i, item in enumerate(state):
+                if isinstance(item, np.ndarray):
+                    if item.shape == control_std.shape and \
+                            np.array_equal(item, control_std):
+                        filename = "control_std.npy"
+                    else:
+                        filename = "tree_%s.npy" % i
+                        np.save(os.path.join(path, filename), item)
+                    meta["tree_arrays"][str(i)] = filename
+                    state[i] = None
+            with open(os.path.join(path, "tree_state.pickle"), "wb") as f:
+                pickle.dump(state, f, protocol=2)
+
+        with open(os.path.join(path, "meta.json"), "wb") as f:
+            f.write(json.dumps(meta, indent=4).encode("utf-8"))
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """Load from a directory created by :meth:`save`. Arrays are memory
+        mapped, so it takes milliseconds no matter how large the control
+        group is.
+
+        If the index was saved with a different scikit-learn version, the
+        KD-tree is rebuilt.
+
+        :param path: directory path.
+        :param mmap_mode: (default "r") see ``numpy.load``, None to load
+          everything into memory.
+        """
+        with open(os.path.join(path, "meta.json"), "rb") as f:
+            meta = json.loads(f.read().decode("utf-8"))
+
+        def load_array(filename):
+            return np.load(os.path.join(path, filename), mmap_mode=mmap_mode)
+
+        mean = load_array("mean.npy")
+        scale = load_array("scale.npy")
+        control_std = load_array("control_std.npy")
+
+        if meta["stratify_order"]:
+            searcher = StratifiedSearcher(
+                control_std, meta["stratify_order"], meta["block_size"])
+        else:
+            tree = None
+            if meta["sklearn_version"] == sklearn.__version__:
+                with open(os.path.join(path, "tree_state.pickle"), "rb") as f:
+                    state = pickle.load(f)
+                for i, filename in meta["tree_arrays"].items():
+                    state[int(i)] = load_array(filename)
+                tree = KDTree.__new__(KDTree)
+                tree.__setstate__(tuple(state))
+            searcher = KNNSearcher(control_std, tree)
+
+        return cls(mean, scale, searcher,
+                   meta["use_col"], meta["stratify_order"])
+
+
+def psm_iter(control_index, treatment_iterable, k=1, independent=True,
+             caliper=None):
+    """Match treatment samples as they arrive, batch by batch.
+
+    Each batch is standardized and matched against the control group as
+    soon as it's taken from ``treatment_iterable``. With
+    ``independent=False``, control samples taken by earlier batches stay
+    taken, the selection is the same as
+    :func:`~ctmatching.core.lazy_non_repeat_index_matching` over the whole
+    stream in arrival order. Memory is one batch plus one boolean per
+    control sample, no matter how long the stream is.
+
+    :param control_index: :class:`ControlIndex`.
+    :param treatment_iterable: iterable of treatment batches, each is a
+      2-d array (or one 1-d row) of treatment sample data, see
+      :func:`~ctmatching.core.psm`.
+    :param k: see :func:`~ctmatching.core.psm`.
+    :param independent: see :func:`~ctmatching.core.psm`. Without
+      ``caliper``, a treatment sample may still get less than k matches,
+      when the control group is used up.
+    :param caliper: see :func:`~ctmatching.core.psm`.
+
+    :returns: generator of ``(treatment_row_id, control_ids, distances)``
+      for each treatment sample. ``treatment_row_id`` counts rows from the
+      start of the stream, ``control_ids`` is the 1-d array of matched
+      control sample index, nearest first for independent matching,
+      ``distances`` is the standardized distance of each of them.
+    """
+    searcher = control_index.searcher
+    taken = np.zeros(searcher.n_control, dtype=bool)
+    row_id = 0
+    for batch in treatment_iterable:
+        treatment_std = control_index.transform(np.atleast_2d(batch))
+        if independent:
+            distances, nn_index = searcher.query(treatment_std, k, caliper)
+        else:
+            _, nn_index, distances = lazy_non_repeat_index_matching(
+                searcher, treatment_std, k, radius=caliper, taken=taken,
+                return_distance=True)
+
+        for indice, distance in zip(nn_index, distances):
+            is_matched = indice >= 0
+            yield row_id, indice[is_matched], distance[is_matched]
+            row_id += 1
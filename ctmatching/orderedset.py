@@ -69,10 +69,13 @@ class, method, func, exception
 """
 
 from __future__ import print_function
-import collections
+try:
+    from collections.abc import MutableSet
+except ImportError:  # pragma: no cover, Python2
+    from collections import MutableSet
 
 
-class OrderedSet(collections.MutableSet):
+class OrderedSet(MutableSet):
 
     """A light weight OrderedSet data type pure Python implementation.
     """
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Parallel neighbor search across CPU cores.
+
+The standardized control data is put into ``multiprocessing.shared_memory``
+once, each worker process attaches to it (nothing is pickled) and builds its
+own search engine over it. Treatment samples are split across workers.
+
+Only the neighbor search runs in parallel. Non repeat selection runs in the
+main process over the candidates gathered from all workers, in treatment
+input order, so the result is exactly the same as running on one core.
+"""
+
+import os
+
+try:
+    from .core import KNNSearcher, StratifiedSearcher
+except:
+    from ctmatching.core import KNNSearcher, StratifiedSearcher
+
+import numpy as np
+
+
+class SharedArray(object):
+    """A ``numpy.ndarray`` in ``multiprocessing.shared_memory``.
+
+    :param shape: shape of the array.
+    :param dtype: (default float) dtype of the array.
+    :param name: (default None, create a new one) name of an existing shared
+      memory block to attach to.
+    """
+
+    def __init__(self, shape, dtype=float, name=None):
+        from multiprocessing import shared_memory
+
+        dtype = np.dtype(dtype)
+        nbytes = max(1, int(np.prod(shape)) * dtype.itemsize)
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        else:
+            try:  # Python3.13+
+                self.shm = shared_memory.SharedMemory(name=name, track=False)
+            except TypeError:
+                from multiprocessing import resource_tracker
+                # worker processes share the creator's resource tracker,
+                # where registering the same name again does nothing. Only
+                # a process with its own tracker has to unregister, or its
+                # tracker unlinks the block when the process exits
+                has_tracker = getattr(
+                    resource_tracker._resource_tracker, "_fd", None) \
+                    is not None
+                self.shm = shared_memory.SharedMemory(name=name)
+                if not has_tracker:
+                    resource_tracker.unregister(
+                        self.shm._name, "shared_memory")
+        self.array = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf)
+        self._unlinked = False
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def close(self):
+        """Release the array and detach from the shared memory block.
+        """
+        self.array = None
+        self.shm.close()
+
+    def unlink(self):
+        """Release the shared memory block, only call it from the creator.
+        Calling it again does nothing.
+        """
+        if self._unlinked:
+            return
+        self.close()
+        self.shm.unlink()
+        self._unlinked = True
+
+
+#--- Worker ---
+_worker_shared = None
+_worker_searcher = None
+
+
+def _init_worker(name, shape, dtype, stratify_order, block_size):
+    """Attach to shared control data and build the search engine, once per
+    worker process.
+    """
+    global _worker_shared, _worker_searcher
+    _worker_shared = SharedArray(shape, dtype, name)
+    if stratify_order:
+        _worker_searcher = StratifiedSearcher(
+            _worker_shared.array, stratify_order, block_size)
+    else:
+        _worker_searcher = KNNSearcher(_worker_shared.array)
+
+
+def _worker_query(treatment_std, k, radius):
+    return _worker_searcher.query(treatment_std, k, radius)
+
+
+def _worker_query_rules(treatment_std, k, radius):
+    return _worker_searcher.query_rules(treatment_std, k, radius)
+
+
+class ParallelSearcher(object):
+    """Split the neighbor search of a :class:`~ctmatching.core.KNNSearcher`
+    or :class:`~ctmatching.core.StratifiedSearcher` across a process pool.
+
+    Same interface as the wrapped search engine, so it works with all
+    selection functions in :mod:`ctmatching.core`. Small queries, like
+    fetching more neighbors for one treatment sample, run in the main
+    process.
+
+    Use it as a context manager, or call :meth:`close` when done::
+
+        >>> with ParallelSearcher(searcher, n_jobs=32) as parallel_searcher:
+        ...     _, nn_index = parallel_searcher.query(treatment_std, k=3)
+
+    :param searcher: :class:`~ctmatching.core.KNNSearcher` or
+      :class:`~ctmatching.core.StratifiedSearcher`.
+    :param n_jobs: (default -1, all CPU cores) number of worker processes.
+    :param shared: (default None, copy control data into a new one) a
+      :class:`SharedArray` that ``searcher.control_std`` is already in. It's
+      unlinked by :meth:`close`.
+    :param min_rows: (default 256) queries with less treatment samples run in
+      the main process.
+    """
+
+    def __init__(self, searcher, n_jobs=-1, shared=None, min_rows=256):
+        from concurrent.futures import ProcessPoolExecutor
+
+        if n_jobs is None or n_jobs < 1:
+            n_jobs = os.cpu_count() or 1
+        self.searcher = searcher
+        self.n_control = searcher.n_control
+        self.n_jobs = n_jobs
+        self.min_rows = min_rows
+
+        control_std = searcher.control_std
+        if shared is None:
+            shared = SharedArray(control_std.shape, control_std.dtype)
+            shared.array[:] = control_std
+        self.shared = shared
+
+        if isinstance(searcher, StratifiedSearcher):
+            stratify_order, block_size = \
+                searcher.stratify_order, searcher.block_size
+        else:
+            stratify_order, block_size = None, None
+        self.executor = ProcessPoolExecutor(
+            max_workers=n_jobs,
+            initializer=_init_worker,
+            initargs=(shared.name, shared.array.shape, shared.array.dtype.str,
+                      stratify_order, block_size),
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Shut down worker processes and release shared memory.
+        """
+        self.executor.shutdown()
+        self.shared.unlink()
+
+    def query(self, treatment_std, k, radius=None):
+        """Same as the wrapped search engine's ``query``. Treatment samples are
+        split into ``4 * n_jobs`` chunks and queried in parallel.
+        """
+        if len(treatment_std) < self.min_rows:
+            return self.searcher.query(treatment_std, k, radius)
+
+        results = self._map(_worker_query, treatment_std, k, radius)
+        distances = np.concatenate([result[0] for result in results])
+        nn_index = np.concatenate([result[1] for result in results])
+        return distances, nn_index
+
+    def query_rules(self, treatment_std, k, radius=None):
+        """Same as the wrapped
+        :meth:`~ctmatching.core.StratifiedSearcher.query_rules`, in parallel.
+        """
+        if len(treatment_std) < self.min_rows:
+            return self.searcher.query_rules(treatment_std, k, radius)
+
+        results = self._map(_worker_query_rules, treatment_std, k, radius)
+        distance_list = [
+            np.concatenate([result[0][i] for result in results])
+            for i in range(len(results[0][0]))
+        ]
+        nn_index = np.concatenate([result[1] for result in results])
+        return distance_list, nn_index
+
+    def _map(self, function, treatment_std, k, radius):
+        """Split treatment samples into ``4 * n_jobs`` chunks and call
+        function on them in parallel.
+        """
+        n_chunks = min(4 * self.n_jobs, len(treatment_std))
+        chunks = np.array_split(np.asarray(treatment_std), n_chunks)
+        return list(self.executor.map(
+            function, chunks, [k] * n_chunks, [radius] * n_chunks))
+
+    def distance(self, treatment_std, nn_index):
+        """Same as the wrapped search engine's ``distance``.
+        """
+        return self.searcher.distance(treatment_std, nn_index)
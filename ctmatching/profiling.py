@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Opt-in instrumentation of :func:`~ctmatching.core.psm`.
+
+A :class:`Profiler` records wall time and peak memory (with
+``tracemalloc``, numpy arrays included) of each stage, hot path counters,
+and throughput of each block of stratified search. Every finished stage
+and block is also a log event of the ``ctmatching.profiling`` logger, and
+is passed to an optional callback::
+
+    >>> from ctmatching.profiling import Profiler
+    >>> profiler = Profiler()
+    >>> psm(control, treatment, k=3, independent=False, profile=profiler)
+    >>> profiler.to_dict()
+    {'stages': [{'stage': 'column_stats', 'time': 0.01, 'peak_memory': ...},
+                ...],
+     'counters': {'distance_evaluations': ..., 'neighbors_visited': ...,
+                  'conflicts_skipped': ..., 'window_expansions': ...},
+     'blocks': [...]}
+
+Counters:
+
+- ``distance_evaluations``: distances computed by search engines.
+- ``neighbors_visited``: candidate neighbors fetched by selection.
+- ``conflicts_skipped``: candidates skipped because they're already taken,
+  in non repeat matching.
+- ``window_expansions``: extra queries for a larger candidate window.
+
+When no profiler is active, instrumented code only checks one global
+variable. Worker processes of ``n_jobs`` are not profiled.
+"""
+
+import logging
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    from .exc import InputError
+except:
+    from ctmatching.exc import InputError
+
+logger = logging.getLogger(__name__)
+
+_active = None
+
+
+class Profiler(object):
+    """Collect per stage wall time, peak memory and counters, see
+    module documentation.
+
+    :param callback: (default None) called with each event dict, when a
+      stage or block finishes.
+    :param trace_memory: (default True) record peak memory of each stage
+      with ``tracemalloc``, which makes memory allocation a bit slower.
+    """
+
+    def __init__(self, callback=None, trace_memory=True):
+        self.callback = callback
+        self.trace_memory = trace_memory
+        self.stages = list()
+        self.counters = dict()
+        self.blocks = list()
+        self._stack = list()
+        self._previous = None
+        self._started_tracemalloc = False
+
+    def __enter__(self):
+        global _active
+        self._previous, _active = _active, self
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        return self
+
+    def __exit__(self, *exc_info):
+        global _active
+        _active = self._previous
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    def _emit(self, event):
+        logger.info("%s", event, extra={"ctmatching_event": event})
+        if self.callback is not None:
+            self.callback(event)
+
+    @contextmanager
+    def stage(self, name):
+        """Measure a stage, stages can be nested.
+        """
+        tracing = self.trace_memory and tracemalloc.is_tracing()
+        if tracing:
+            # parent stage's peak so far is kept in its frame
+            if self._stack:
+                self._stack[-1][1] = max(
+                    self._stack[-1][1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+        frame = [name, 0]
+        self._stack.append(frame)
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            self._stack.pop()
+            event = {"stage": name, "time": elapsed}
+            if tracing:
+                peak = max(frame[1], tracemalloc.get_traced_memory()[1])
+                # memory allocated above what was there at start
+                event["peak_memory"] = max(0, peak - baseline)
+                if self._stack:
+                    self._stack[-1][1] = max(self._stack[-1][1], peak)
+                tracemalloc.reset_peak()
+            self.stages.append(event)
+            self._emit(event)
+
+    def count(self, name, n=1):
+        """Add n to a counter.
+        """
+        self.counters[name] = self.counters.get(name, 0) + int(n)
+
+    def block(self, name, rows, elapsed):
+        """Record throughput of one block of rows.
+        """
+        event = {
+            "block": name, "rows": int(rows), "time": elapsed,
+            "rows_per_second": rows / elapsed if elapsed > 0 else float("inf"),
+        }
+        self.blocks.append(event)
+        self._emit(event)
+
+    def to_dict(self):
+        """All records as a dict of ``stages``, ``counters`` and ``blocks``.
+        """
+        return {
+            "stages": list(self.stages),
+            "counters": dict(self.counters),
+            "blocks": list(self.blocks),
+        }
+
+
+def is_active():
+    """Whether a profiler is active.
+    """
+    return _active is not None
+
+
+def count(name, n=1):
+    """Add n to a counter of the active profiler, if any.
+    """
+    if _active is not None:
+        _active.count(name, n)
+
+
+def block(name, rows, elapsed):
+    """Record throughput of one block with the active profiler, if any.
+    """
+    if _active is not None:
+        _active.block(name, rows, elapsed)
+
+
+@contextmanager
+def stage(name):
+    """Measure a stage with the active profiler, if any.
+    """
+    if _active is None:
+        yield
+    else:
+        with _active.stage(name):
+            yield
+
+
+def get_profiler(profile):
+    """Profiler for the ``profile`` argument of :func:`~ctmatching.core.psm`,
+    None for no profiling.
+
+    :param profile: None or False, True (log events only), a callable (the
+      callback) or a :class:`Profiler`.
+    """
+    if profile is None or profile is False:
+        return None
+    if isinstance(profile, Profiler):
+        return profile
+    if profile is True:
+        return Profiler()
+    if callable(profile):
+        return Profiler(callback=profile)
+    raise InputError("profile has to be a bool, a callable or a Profiler!")
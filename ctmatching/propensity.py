@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Estimated propensity score matching.
+
+Instead of matching in the full standardized feature space, a logistic
+regression of treatment on the features is fitted, and samples are matched
+on the 1-d propensity score (or its logit). In 1-d, the k nearest control
+samples of a treatment sample are always next to it in the sorted control
+scores, so matching only needs a sort and a binary search.
+"""
+
+try:
+    from . import profiling
+except:
+    from ctmatching import profiling
+
+from sklearn.linear_model import LogisticRegression
+import numpy as np
+
+
+def propensity_score(control, treatment, logit=True):
+    """Estimate propensity score, the probability of being treated, with a
+    logistic regression of treatment on features.
+
+    :param control: 2-d ndarray like data, M2 x N matrix.
+    :param treatment: 2-d ndarray like data, M1 x N matrix.
+    :param logit: (default True) if True, return the logit of the propensity
+      score, ``log(p / (1 - p))``, which is linear in features. Otherwise,
+      return the probability.
+
+    :returns control_score: 1-d array, M2 propensity score.
+    :returns treatment_score: 1-d array, M1 propensity score.
+    """
+    X = np.vstack([control, treatment])
+    y = np.concatenate([np.zeros(len(control)), np.ones(len(treatment))])
+    # almost no regularization, it's a model of the data, not a predictor
+    model = LogisticRegression(C=1e6, max_iter=1000).fit(X, y)
+
+    if logit:
+        score = model.decision_function(X)
+    else:
+        score = model.predict_proba(X)[:, 1]
+    return score[:len(control)], score[len(control):]
+
+
+class PropensitySearcher(object):
+    """Top-k nearest neighbor search engine over 1-d propensity score.
+
+    Control scores are sorted once. For each treatment score, its position
+    in sorted control scores is found by binary search, the k nearest
+    control samples must be in the 2k sorted control samples around it
+    (k on the left, k on the right), so only those are ranked. If the control
+    samples on the window's edge have tied scores, the window is expanded
+    to the whole run of ties, so ties are always broken by control sample
+    index. Time is O((M1 + M2) * log(M2)), memory is M1 x 2k.
+
+    Same interface as :class:`~ctmatching.core.KNNSearcher`, so it works
+    with all selection functions in :mod:`ctmatching.core`.
+
+    :param control_score: 1-d array, M2 propensity score.
+    """
+
+    def __init__(self, control_score):
+        control_score = np.asarray(control_score, dtype=float).ravel()
+        self.n_control = len(control_score)
+        self.control_score = control_score
+        # stable, so ties are broken by control sample index
+        self.sorted_index = np.argsort(control_score, kind="mergesort")
+        self.sorted_score = control_score[self.sorted_index]
+
+    def query(self, treatment_score, k, radius=None):
+        """Find the k nearest control samples for each treatment sample.
+        Ties are broken by control sample index.
+
+        :param treatment_score: 1-d array, M1 propensity score.
+        :param k: number of neighbors, capped by number of control samples.
+        :param radius: (default None, no limit) only control samples within
+          this score difference are returned, the rest is padded with -1.
+
+        :returns distances: M1 x k matrix, absolute score difference,
+          nearest first. inf for padding.
+        :returns nn_index: M1 x k matrix of control sample index. -1 for
+          padding.
+        """
+        treatment_score = np.asarray(treatment_score, dtype=float).ravel()
+        k = min(k, self.n_control)
+        width = min(2 * k, self.n_control)
+
+        profiling.count("distance_evaluations", len(treatment_score) * width)
+        position = np.searchsorted(self.sorted_score, treatment_score)
+        lower = np.clip(position - k, 0, self.n_control - width)
+        upper = lower + width
+        distances, nn_index = self._rank(
+            treatment_score, lower[:, None] + np.arange(width), k)
+
+        # expand the window to the whole run of tied scores on its edges
+        run_lower = np.searchsorted(
+            self.sorted_score, self.sorted_score[lower], "left")
+        run_upper = np.searchsorted(
+            self.sorted_score, self.sorted_score[upper - 1], "right")
+        for i in np.flatnonzero((run_lower < lower) | (run_upper > upper)):
+            distances[i], nn_index[i] = self._rank(
+                treatment_score[i:i + 1],
+                np.arange(run_lower[i], run_upper[i])[None, :], k)
+
+        if radius is not None:
+            is_out = distances > radius
+            distances[is_out] = np.inf
+            nn_index[is_out] = -1
+        return distances, nn_index
+
+    def _rank(self, treatment_score, window, k):
+        """Rank control samples in the window of sorted control scores, keep
+        the k nearest.
+        """
+        candidate = self.sorted_index[window]
+        distances = np.abs(self.sorted_score[window] - treatment_score[:, None])
+        # numpy.lexsort use the last key as primary key
+        order = np.lexsort([candidate, distances], axis=-1)[:, :k]
+        distances = np.take_along_axis(distances, order, axis=1)
+        nn_index = np.take_along_axis(candidate, order, axis=1)
+        return distances, nn_index
+
+    def distance(self, treatment_score, nn_index):
+        """Score difference between each treatment sample and given control
+        samples.
+
+        :param treatment_score: 1-d array, M1 propensity score.
+        :param nn_index: M1 x k matrix of control sample index.
+
+        :returns distances: M1 x k matrix.
+        """
+        treatment_score = np.asarray(treatment_score, dtype=float).ravel()
+        return np.abs(self.control_score[nn_index] - treatment_score[:, None])
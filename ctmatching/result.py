@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Compact matching result.
+"""
+
+import numpy as np
+
+
+class MatchResult(object):
+    """Matched control samples and distances of each treatment sample, in
+    CSR (compressed sparse row) layout: matches of treatment sample ``i``
+    are ``indices[indptr[i]:indptr[i + 1]]``, nearest first, and their
+    distances are at the same positions of ``distances``. Treatment samples
+    may have less than k matches, no padding is stored.
+
+    For backward compatibility, it unpacks like the 2-tuple
+    :func:`~ctmatching.core.psm` used to return::
+
+        >>> selected_control_index, selected_control_index_for_each_treatment = \\
+        ...     psm(control, treatment, k=3)
+        >>> result = psm(control, treatment, k=3)
+        >>> control_ids, distances = result.row(0) # views, no copy
+        >>> result.save("result.npz")
+
+    :param indptr: 1-d int array, M1 + 1 row pointers.
+    :param indices: 1-d int array, matched control sample index.
+    :param distances: 1-d float array, distance of each match.
+    :param k: number of matches asked for each treatment sample.
+    """
+
+    def __init__(self, indptr, indices, distances, k):
+        self.indptr = indptr
+        self.indices = indices
+        self.distances = distances
+        self.k = k
+        self._padded = None
+
+    @classmethod
+    def from_padded(cls, nn_index, distances, dtype=None):
+        """Create from M1 x k matrices padded with -1 (and anything in
+        ``distances`` for padding).
+
+        :param dtype: (default None, same as ``nn_index``) int dtype of
+          ``indices``, see :func:`~ctmatching.core.index_dtype`.
+        """
+        nn_index = np.asarray(nn_index)
+        if dtype is not None:
+            nn_index = nn_index.astype(dtype, copy=False)
+        is_matched = nn_index >= 0
+        n_matched = is_matched.sum(axis=1)
+        indptr_dtype = np.int32 if is_matched.sum() < 2 ** 31 else np.int64
+        indptr = np.zeros(len(nn_index) + 1, dtype=indptr_dtype)
+        np.cumsum(n_matched, out=indptr[1:])
+        return cls(indptr, nn_index[is_matched],
+                   np.asarray(distances, dtype=float)[is_matched],
+                   nn_index.shape[1])
+
+    @property
+    def n_treatment(self):
+        return len(self.indptr) - 1
+
+    @property
+    def n_matched(self):
+        """1-d array, number of matches of each treatment sample.
+        """
+        return np.diff(self.indptr)
+
+    def row(self, i):
+        """Matches of treatment sample i, as views.
+
+        :returns control_ids: 1-d array of control sample index.
+        :returns distances: 1-d array.
+        """
+        lower, upper = self.indptr[i], self.indptr[i + 1]
+        return self.indices[lower:upper], self.distances[lower:upper]
+
+    #--- legacy 2-tuple ---
+    @property
+    def selected_control_index(self):
+        """All selected control sample, see :func:`~ctmatching.core.psm`.
+        """
+        return self.indices
+
+    @property
+    def selected_control_index_for_each_treatment(self):
+        """M1 x k matrix padded with -1, see :func:`~ctmatching.core.psm`.
+        """
+        if self._padded is None:
+            self._padded = self.to_padded()
+        return self._padded
+
+    def _pad(self, values, fill):
+        padded = np.full((self.n_treatment, self.k), fill, dtype=values.dtype)
+        n_matched = self.n_matched
+        position = np.arange(len(values)) - \
+            np.repeat(self.indptr[:-1], n_matched)
+        padded[np.repeat(np.arange(self.n_treatment), n_matched),
+               position] = values
+        return padded
+
+    def to_padded(self, fill=-1):
+        """Matches as M1 x k matrix, padded with ``fill``.
+        """
+        return self._pad(self.indices, fill)
+
+    def padded_distances(self, fill=np.inf):
+        """Distances as M1 x k matrix, padded with ``fill``.
+        """
+        return self._pad(self.distances, fill)
+
+    def __len__(self):
+        return 2
+
+    def __iter__(self):
+        yield self.selected_control_index
+        yield self.selected_control_index_for_each_treatment
+
+    def __getitem__(self, item):
+        return (self.selected_control_index,
+                self.selected_control_index_for_each_treatment)[item]
+
+    #--- Persistence ---
+    def save(self, path):
+        """Save to an uncompressed ``.npz`` file.
+        """
+        np.savez(path, indptr=self.indptr, indices=self.indices,
+                 distances=self.distances, k=self.k)
+
+    @classmethod
+    def load(cls, path):
+        """Load from a ``.npz`` file created by :meth:`save`.
+        """
+        with np.load(path) as data:
+            return cls(data["indptr"], data["indices"], data["distances"],
+                       int(data["k"]))
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Out-of-core neighbor search over a sharded control group.
+
+The standardized control data is split into shards, contiguous ranges of
+control samples, usually memory mapped files. Each shard has its own search
+engine, and is queried independently for the top-k candidates of every
+treatment sample. The per shard top-k lists are merged one shard at a time
+into the global top-k, so memory is M1 x 2k candidates plus one shard's
+working set, and a stratified search ranks ``block_size`` x shard size
+distances at once, instead of ``block_size`` x M2.
+
+Selection runs over the merged candidates, like with any other search
+engine, so non repeat matching never takes a control sample twice, across
+shards as well. With ``shard_size``, :func:`~ctmatching.core.psm` writes the
+standardized control data to a temporary file and uses it::
+
+    >>> psm(control, treatment, use_col=use_col, k=3, independent=False,
+    ...     shard_size=10 ** 7)
+
+The mean and scale used for standardizing come from the treatment group
+only. With ``metric="mahalanobis"``, the pooled within group covariance
+also takes every control sample, in one chunked pass before sharding. Both
+are fixed before the first shard is written, so every shard is
+standardized the same way.
+"""
+
+import time
+
+try:
+    from . import profiling
+    from .core import load_array, KNNSearcher, StratifiedSearcher
+except:
+    from ctmatching import profiling
+    from ctmatching.core import load_array, KNNSearcher, StratifiedSearcher
+
+import numpy as np
+
+
+class ShardedSearcher(object):
+    """Top-k (stratified) nearest neighbor search engine over shards of
+    standardized control samples. Control sample index is global, the
+    samples of ``shards[1]`` come after the ones of ``shards[0]``, ...
+
+    The search engine of a shard is built the first time it's queried, and
+    kept for later queries (window expansions of non repeat matching). A
+    KD-tree doesn't copy memory mapped data, it only keeps its own index, 8
+    bytes per control sample.
+
+    :param shards: list of standardized control data, each one is a
+      M2_i x N matrix, ``numpy.memmap`` or path of ``.npy`` file.
+    :param stratify_order: (default None, normal nearest neighbor) see
+      :func:`~ctmatching.core.psm`.
+    :param block_size: see :class:`~ctmatching.core.StratifiedSearcher`.
+    """
+
+    def __init__(self, shards, stratify_order=None, block_size=None):
+        self.shards = [load_array(shard) for shard in shards]
+        self.stratify_order = stratify_order
+        self.block_size = block_size
+        self.offsets = np.cumsum([0] + [len(shard) for shard in self.shards])
+        self.n_control = int(self.offsets[-1])
+        self._searchers = [None] * len(self.shards)
+
+    def _searcher(self, i):
+        if self._searchers[i] is None:
+            if self.stratify_order:
+                self._searchers[i] = StratifiedSearcher(
+                    self.shards[i], self.stratify_order, self.block_size)
+            else:
+                self._searchers[i] = KNNSearcher(self.shards[i])
+        return self._searchers[i]
+
+    def query(self, treatment_std, k, radius=None):
+        """Find the k nearest control samples for each treatment sample, over
+        all shards. Same as :meth:`~ctmatching.core.KNNSearcher.query` or
+        :meth:`~ctmatching.core.StratifiedSearcher.query`, ties are broken by
+        control sample index.
+
+        :returns distances: M1 x k matrix, nearest first. inf for padding.
+        :returns nn_index: M1 x k matrix of control sample index. -1 for
+          padding.
+        """
+        distances, _, nn_index = self._query(treatment_std, k, radius)
+        return distances, nn_index
+
+    def query_rules(self, treatment_std, k, radius=None):
+        """Same as :meth:`~ctmatching.core.StratifiedSearcher.query_rules`,
+        over all shards. Only for stratified search.
+        """
+        _, keys, nn_index = self._query(treatment_std, k, radius)
+        return keys, nn_index
+
+    def _query(self, treatment_std, k, radius=None):
+        """:returns distances, sort keys (the distance of each stratify rule,
+        or the overall distance), nn_index.
+        """
+        k = min(k, self.n_control)
+        n_treatment = len(treatment_std)
+        distances = np.full((n_treatment, 0), np.inf)
+        nn_index = np.full((n_treatment, 0), -1, dtype=np.intp)
+        keys = [distances] * max(1, len(self.stratify_order or []))
+
+        for i, shard in enumerate(self.shards):
+            if len(shard) == 0:
+                continue
+            start = time.time()
+            searcher = self._searcher(i)
+            if self.stratify_order:
+                shard_keys, shard_nn_index = searcher.query_rules(
+                    treatment_std, k, radius)
+                shard_distances = np.sqrt(
+                    sum(key ** 2 for key in shard_keys))
+            else:
+                shard_distances, shard_nn_index = searcher.query(
+                    treatment_std, k, radius)
+                shard_keys = [shard_distances]
+            shard_nn_index = np.where(
+                shard_nn_index < 0, -1, shard_nn_index + self.offsets[i])
+
+            # merge the running top-k with the shard's top-k
+            distances = np.hstack([distances, shard_distances])
+            nn_index = np.hstack([nn_index, shard_nn_index])
+            keys = [np.hstack(pair) for pair in zip(keys, shard_keys)]
+            # padding sorts last
+            tie_breaker = np.where(nn_index < 0, self.n_control, nn_index)
+            # numpy.lexsort use the last key as primary key
+            order = np.lexsort([tie_breaker] + keys[::-1], axis=-1)[:, :k]
+            distances = np.take_along_axis(distances, order, axis=1)
+            nn_index = np.take_along_axis(nn_index, order, axis=1)
+            keys = [np.take_along_axis(key, order, axis=1) for key in keys]
+            profiling.block("shard_query", n_treatment, time.time() - start)
+
+        return distances, keys, nn_index
+
+    def take(self, index):
+        """Standardized control samples by global index, only those samples
+        are read from their shards.
+
+        :param index: int array of control sample index, any shape.
+
+        :returns: array of shape ``index.shape + (N,)``.
+        """
+        index = np.asarray(index)
+        rows = np.empty(index.shape + (self.shards[0].shape[1],))
+        for i, shard in enumerate(self.shards):
+            lower, upper = self.offsets[i], self.offsets[i + 1]
+            is_in_shard = (index >= lower) & (index < upper)
+            if is_in_shard.any():
+                rows[is_in_shard] = shard[index[is_in_shard] - lower]
+        return rows
+
+    def distance(self, treatment_std, nn_index):
+        """Distance between each treatment sample and given control samples,
+        same as in :meth:`query`.
+
+        :param treatment_std: standardized treatment data, M1 x N matrix.
+        :param nn_index: M1 x k matrix of control sample index.
+
+        :returns distances: M1 x k matrix.
+        """
+        diff = treatment_std[:, None, :] - self.take(nn_index)
+        if not self.stratify_order:
+            return np.sqrt((diff ** 2).sum(axis=2))
+        squared = 0.0
+        for stratify_index in self.stratify_order:
+            squared = squared + (diff[:, :, stratify_index] ** 2).sum(axis=2)
+        return np.sqrt(squared)
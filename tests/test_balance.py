@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+import numpy as np
+from ctmatching.dataset import load_re78
+from ctmatching.balance import matching_weights, balance
+from ctmatching.exc import InputError
+from ctmatching import psm, MatchResult
+
+
+def ecdf(data, weight, grid):
+    return np.array([weight[data <= x].sum() for x in grid]) / weight.sum()
+
+
+def test_balance(tmpdir):
+    rng = np.random.RandomState(0)
+    # integer valued, so the eCDF grid is exact
+    control = rng.randint(0, 20, size=(300, 3)).astype(float)
+    treatment = rng.randint(5, 25, size=(40, 3)).astype(float)
+    treatment[:, 2] = rng.randint(0, 2, size=40)  # binary column
+    control[:, 2] = rng.randint(0, 2, size=300)
+    result = psm(control, treatment, k=3, caliper=0.3)
+    assert (result.n_matched < 3).any()
+
+    control_id, control_weight, treatment_weight = matching_weights(
+        result, len(control))
+    expected = np.zeros(len(control))
+    for i in range(len(treatment)):
+        for j in result.row(i)[0]:
+            expected[j] += 1.0 / result.n_matched[i]
+    np.testing.assert_allclose(control_weight, expected[control_id])
+    assert (expected[np.setdiff1d(np.arange(len(control)), control_id)]
+            == 0).all()
+    np.testing.assert_array_equal(treatment_weight, result.n_matched > 0)
+
+    table = balance(control, treatment, result, n_bins=20)
+    assert list(table.index) == [0, 1, 2]
+    scale = np.sqrt((treatment.var(axis=0) + control.var(axis=0)) / 2)
+    for when, c_weight, t_weight in [
+        ("before", np.ones(len(control)), np.ones(len(treatment))),
+        ("after", expected, treatment_weight),
+    ]:
+        c_mean = np.average(control, axis=0, weights=c_weight)
+        t_mean = np.average(treatment, axis=0, weights=t_weight)
+        c_var = np.average((control - c_mean) ** 2, axis=0, weights=c_weight)
+        t_var = np.average((treatment - t_mean) ** 2, axis=0,
+                           weights=t_weight)
+        np.testing.assert_allclose(
+            table["smd_" + when], (t_mean - c_mean) / scale, atol=1e-12)
+        np.testing.assert_allclose(
+            table["variance_ratio_" + when], t_var / c_var)
+
+        for column in range(3):
+            grid = np.linspace(treatment[:, column].min(),
+                               treatment[:, column].max(), 21)
+            difference = np.abs(
+                ecdf(treatment[:, column], t_weight, grid) -
+                ecdf(control[:, column], c_weight, grid))
+            assert table["ecdf_mean_" + when][column] == \
+                pytest.approx(difference.mean())
+            assert table["ecdf_max_" + when][column] == \
+                pytest.approx(difference.max())
+
+    # chunked and memory mapped, same result
+    path = str(tmpdir.join("control.npy"))
+    np.save(path, control)
+    chunked = balance(path, treatment, result.to_padded(), n_bins=20,
+                      chunk_size=7)
+    np.testing.assert_allclose(chunked.values, table.values, atol=1e-12)
+
+
+def test_balance_re78():
+    control, treatment = load_re78()
+    use_col = [2, 3, 4, 5, 6, 7]
+    result = psm(control, treatment, use_col, k=2)
+    table = balance(control, treatment, result, use_col)
+    assert list(table.index) == use_col
+    assert (table["smd_after"].abs() < table["smd_before"].abs()).mean() > 0.5
+
+    with pytest.raises(InputError):
+        balance(control, treatment, result.to_padded()[:10], use_col)
+    with pytest.raises(InputError):
+        balance(control, treatment,
+                MatchResult.from_padded([[len(control)]] * len(treatment),
+                                        [[0.0]] * len(treatment)),
+                use_col)
+
+
+if __name__ == "__main__":
+    import os
+    pytest.main([os.path.basename(__file__), "--tb=native", "-s", ])
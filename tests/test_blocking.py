@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+import numpy as np
+from ctmatching.dataset import load_re78
+from ctmatching.exc import InputError
+from ctmatching.core import psm
+from ctmatching.blocking import exact_blocks
+
+
+def test_exact_blocks():
+    control_key = np.array([[0, 1], [1, 1], [0, 1], [2, 2]])
+    treatment_key = np.array([[1, 1], [0, 1], [3, 3]])
+    control_block, treatment_block, block_key = exact_blocks(
+        control_key, treatment_key)
+    np.testing.assert_array_equal(block_key[control_block], control_key)
+    np.testing.assert_array_equal(block_key[treatment_block], treatment_key)
+    assert len(block_key) == 4
+
+
+def test_psm():
+    control, treatment = np.array(load_re78()[0]), np.array(load_re78()[1])
+    use_col = [2, 3, 7]
+    exact_cols = [4, 5, 6]  # black, hispan, married
+
+    (
+        selected_control_index,
+        selected_control_index_for_each_treatment,
+    ) = psm(control, treatment, use_col, k=2, exact_cols=exact_cols)
+    assert selected_control_index_for_each_treatment.shape == (185, 2)
+    for treatment_sample, index in zip(
+            treatment, selected_control_index_for_each_treatment):
+        index = index[index >= 0]
+        is_same_block = (
+            control[:, exact_cols] == treatment_sample[exact_cols]).all(axis=1)
+        assert is_same_block[index].all()
+        assert len(index) == min(2, is_same_block.sum())
+
+    # same as stratified matching with exact match columns first
+    expected = psm(control, treatment, use_col + exact_cols, k=2,
+                   stratify_order=[[3], [4], [5], [0, 1, 2]])[1]
+    result = psm(control, treatment, use_col, k=2, exact_cols=exact_cols,
+                 stratify_order=[[0, 1, 2]])[1]
+    has_block = (expected >= 0).all(axis=1)
+    np.testing.assert_array_equal(result[has_block], expected[has_block])
+
+    for independent, method, caliper in [
+        (True, "greedy", None),
+        (False, "greedy", 1.0),
+        (False, "global_greedy", 1.0),
+    ]:
+        expected = psm(control, treatment, use_col, independent=independent,
+                       k=2, method=method, caliper=caliper,
+                       exact_cols=exact_cols)
+        result = psm(control, treatment, use_col, independent=independent,
+                     k=2, method=method, caliper=caliper,
+                     exact_cols=exact_cols, n_jobs=2)
+        np.testing.assert_array_equal(result[1], expected[1])
+        selected_control_index = result[0]
+        if not independent:
+            assert len(selected_control_index) == \
+                len(set(selected_control_index))
+
+    with pytest.raises(InputError):
+        psm(control, treatment, use_col, independent=False, k=2,
+            exact_cols=exact_cols)
+    with pytest.raises(InputError):
+        psm(control, treatment, use_col, k=2, exact_cols=[99])
+
+
+if __name__ == "__main__":
+    import os
+    pytest.main(["--tb=native", "-s", os.path.basename(__file__)])
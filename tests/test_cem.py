@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+import numpy as np
+from ctmatching.dataset import load_re78
+from ctmatching.exc import InputError
+from ctmatching.cem import auto_cuts, coarsen, cem, cem_weights
+from ctmatching.result import MatchResult
+
+
+def test_coarsen():
+    data = np.array([[0.0, 5.0], [0.5, 5.0], [1.0, 9.0], [2.0, 9.0]])
+    cuts = [np.array([1.0]), np.array([6.0, 8.0])]
+    code = coarsen(data, cuts)
+    # bin codes (0, 0), (0, 0), (1, 2), (1, 2)
+    assert code[0] == code[1]
+    assert code[2] == code[3]
+    assert code[0] != code[2]
+    np.testing.assert_array_equal(coarsen(data, cuts, chunk_size=1), code)
+
+    cuts = auto_cuts(data, data, n_bins=[2, 4])
+    np.testing.assert_allclose(cuts[0], [1.0])
+    np.testing.assert_allclose(cuts[1], [6.0, 7.0, 8.0])
+
+
+def test_cem():
+    control, treatment = load_re78()
+    control, treatment = np.array(control), np.array(treatment)
+    use_col = [2, 3, 4, 5, 6, 7]
+    cuts = [[20, 30, 40], [9, 12], None, None, None, None]
+
+    full_cuts = [np.array([20.0, 30.0, 40.0]), np.array([9.0, 12.0])] + \
+        auto_cuts(control, treatment, use_col)[2:]
+
+    def same_stratum(treatment_sample, control_samples):
+        code = coarsen(
+            np.vstack([treatment_sample, control_samples]), full_cuts, use_col)
+        return (code == code[0]).all()
+
+    for independent in [True, False]:
+        result = cem(control, treatment, use_col, cuts, k=2,
+                     independent=independent)
+        assert isinstance(result, MatchResult)
+        assert result.indices.dtype == np.int32
+        np.testing.assert_array_equal(result.distances, 0.0)
+        selected_control_index, selected_control_index_for_each_treatment = \
+            result
+        assert selected_control_index_for_each_treatment.shape == (185, 2)
+        for treatment_sample, index in zip(
+                treatment, selected_control_index_for_each_treatment):
+            index = index[index >= 0]
+            assert same_stratum(treatment_sample, control[index])
+        if not independent:
+            assert len(selected_control_index) == \
+                len(set(selected_control_index))
+
+    control_weight, treatment_weight = cem_weights(
+        control, treatment, use_col, cuts)
+    is_matched_control = control_weight > 0
+    # weighted number of control samples is number of matched ones
+    np.testing.assert_allclose(
+        control_weight.sum(), is_matched_control.sum())
+    assert set(np.unique(treatment_weight)) <= {0.0, 1.0}
+
+    with pytest.raises(InputError):
+        cem(control, treatment, use_col, cuts=[None])
+
+
+if __name__ == "__main__":
+    import os
+    pytest.main(["--tb=native", "-s", os.path.basename(__file__)])
@@ -9,12 +9,26 @@ import numpy as np
 from ctmatching.dataset import load_re78
 from ctmatching.core import (
     exam_input,
+    normalize,
+    column_stats,
+    standardize,
+    pooled_covariance,
+    metric_matrix,
+    dist,
+    KNNSearcher,
+    StratifiedSearcher,
     non_stratified_matching,
     stratified_matching,
+    take_free,
     non_repeat_index_matching,
+    lazy_non_repeat_index_matching,
+    global_greedy_index_matching,
+    optimal_index_matching,
     independent_index_matching,
     psm,
     grouper,
+    iter_batch_grouper,
+    batch_grouper,
 )
 from ctmatching.exc import InputError
 
@@ -34,10 +48,137 @@ def test_exam_input():
         exam_input(control, treatment, stratify_order)
 
 
+def test_column_stats_and_standardize():
+    data = np.random.random((100, 6)) * 10
+    data[:, 4] = 3.0  # constant column
+    use_col = [0, 2, 4, 5]
+    expected, _ = normalize(data[:, use_col], data[:, use_col])
+    for chunk_size in [1, 7, 100, None]:
+        mean, scale = column_stats(data, use_col, chunk_size)
+        np.testing.assert_allclose(mean, data[:, use_col].mean(axis=0))
+        np.testing.assert_allclose(
+            standardize(data, mean, scale, use_col, chunk_size), expected,
+            atol=1e-12)
+
+    out = np.zeros((100, 4))
+    assert standardize(data, mean, scale, use_col, out=out) is out
+
+
 def test_non_stratified_matching():
     control = np.random.random((100, 6))
     treatment = np.random.random((10, 6))
     nn_index = non_stratified_matching(control, treatment)
+    assert nn_index.shape == (10, 100)
+
+    nn_index_top3 = non_stratified_matching(control, treatment, k=3)
+    assert nn_index_top3.shape == (10, 3)
+    np.testing.assert_array_equal(nn_index_top3, nn_index[:, :3])
+
+
+def test_knn_searcher():
+    control = np.random.random((100, 6))
+    treatment = np.random.random((10, 6))
+    treatment_std, control_std = normalize(treatment, control)
+    searcher = KNNSearcher(control_std)
+
+    distances, nn_index = searcher.query(treatment_std, 5)
+    assert nn_index.shape == (10, 5)
+    assert (np.diff(distances, axis=1) >= 0).all()
+
+    # fetch more neighbors for some rows later
+    _, more_nn_index = searcher.query(treatment_std[[2, 7]], 20)
+    np.testing.assert_array_equal(more_nn_index[:, :5], nn_index[[2, 7]])
+
+    # never returns more than the whole control group
+    _, all_nn_index = searcher.query(treatment_std, 1000)
+    assert all_nn_index.shape == (10, 100)
+
+
+def test_knn_searcher_radius():
+    control = np.random.random((100, 3))
+    treatment = np.random.random((30, 3))
+    treatment_std, control_std = normalize(treatment, control)
+    searcher = KNNSearcher(control_std)
+    all_distances, all_nn_index = searcher.query(treatment_std, 100)
+
+    for radius in [0.0, 0.3, 0.6, 100.0]:
+        distances, nn_index = searcher.query(treatment_std, 5, radius)
+        assert nn_index.shape == (30, 5)
+        is_within = all_distances[:, :5] <= radius
+        np.testing.assert_array_equal(
+            nn_index, np.where(is_within, all_nn_index[:, :5], -1))
+        np.testing.assert_allclose(
+            distances, np.where(is_within, all_distances[:, :5], np.inf))
+
+
+def test_stratified_searcher_radius():
+    control = np.random.randint(0, 4, (100, 6)).astype(float)
+    treatment = np.random.randint(0, 4, (25, 6)).astype(float)
+    stratify_order = [[1], [3], [0, 2, 4], [5]]
+    treatment_std, control_std = normalize(treatment, control)
+    searcher = StratifiedSearcher(control_std, stratify_order)
+    all_distances, all_nn_index = searcher.query(treatment_std, 100)
+
+    for radius in [0.0, 1.5, 3.0, 100.0]:
+        distances, nn_index = searcher.query(treatment_std, 5, radius)
+        for i in range(len(treatment)):
+            expected = all_nn_index[i][all_distances[i] <= radius][:5]
+            assert list(nn_index[i][:len(expected)]) == list(expected)
+            assert (nn_index[i][len(expected):] == -1).all()
+            assert (distances[i][:len(expected)] <= radius).all()
+
+
+def test_stratified_matching():
+    # integer data has lots of ties in each stratum
+    control = np.random.randint(0, 4, (100, 6)).astype(float)
+    treatment = np.random.randint(0, 4, (10, 6)).astype(float)
+    stratify_order = [[1], [3], [0, 2, 4], [5]]
+    nn_index = stratified_matching(control, treatment, stratify_order)
+    assert nn_index.shape == (10, 100)
+
+    # reference: stable sort by distance of each stratum, one by one
+    treatment_std, control_std = normalize(treatment, control)
+    distmatrix_list = [
+        dist(treatment_std[:, stratify_index], control_std[:, stratify_index])
+        for stratify_index in stratify_order
+    ]
+    for i, indice in enumerate(nn_index):
+        expected = sorted(
+            range(len(control)),
+            key=lambda j: tuple(d[i, j] for d in distmatrix_list),
+        )
+        assert list(indice) == expected
+
+
+def test_stratified_searcher():
+    control = np.random.randint(0, 4, (100, 6)).astype(float)
+    treatment = np.random.randint(0, 4, (25, 6)).astype(float)
+    stratify_order = [[1], [3], [0, 2, 4], [5]]
+    treatment_std, control_std = normalize(treatment, control)
+    nn_index = stratified_matching(control, treatment, stratify_order)
+
+    # small blocks give the same top-k as ranking everything at once
+    for block_size in [1, 7, 25, 100]:
+        searcher = StratifiedSearcher(control_std, stratify_order, block_size)
+        distances, nn_index_top5 = searcher.query(treatment_std, 5)
+        np.testing.assert_array_equal(nn_index_top5, nn_index[:, :5])
+
+    expected = np.sqrt(sum(
+        ((treatment_std[:, None, stratify_index] -
+          control_std[nn_index_top5][:, :, stratify_index]) ** 2).sum(axis=2)
+        for stratify_index in stratify_order
+    ))
+    np.testing.assert_allclose(distances, expected)
+
+
+def test_take_free():
+    taken = np.zeros(10, dtype=bool)
+    taken[[4, 6]] = True
+    indice = np.array([4, 1, 6, 7, 0, 2, 3, 5, 8, 9])
+    np.testing.assert_array_equal(take_free(indice, taken, 3), [1, 7, 0])
+    np.testing.assert_array_equal(np.flatnonzero(taken), [0, 1, 4, 6, 7])
+    np.testing.assert_array_equal(take_free(indice, taken, 10), [2, 3, 5, 8, 9])
+    assert len(take_free(indice, taken, 1)) == 0
 
 
 def test_non_repeat_index_matching():
@@ -50,6 +191,139 @@ def test_non_repeat_index_matching():
     ) = non_repeat_index_matching(nn_index, k=3)
     assert len(selected_control_index) == len(set(selected_control_index))
 
+    # greedy: each treatment takes its nearest not yet taken control samples
+    taken = set()
+    for indice, selected in zip(
+            nn_index, selected_control_index_for_each_treatment):
+        expected = [ind for ind in indice if ind not in taken][:3]
+        assert list(selected) == expected
+        taken.update(expected)
+    np.testing.assert_array_equal(
+        selected_control_index,
+        np.concatenate(selected_control_index_for_each_treatment))
+
+
+def test_lazy_non_repeat_index_matching():
+    control = np.random.random((100, 6))
+    treatment = np.random.random((30, 6))
+    treatment_std, control_std = normalize(treatment, control)
+    stratify_order = [[1], [3], [0, 2, 4], [5]]
+
+    for searcher in [
+        KNNSearcher(control_std),
+        StratifiedSearcher(control_std, stratify_order),
+    ]:
+        _, nn_index = searcher.query(treatment_std, len(control))
+        expected = non_repeat_index_matching(nn_index, k=3)
+        # window of 1 forces expanding the neighbors a lot
+        for window in [1, None]:
+            (
+                selected_control_index,
+                selected_control_index_for_each_treatment,
+            ) = lazy_non_repeat_index_matching(
+                searcher, treatment_std, k=3, window=window)
+            np.testing.assert_array_equal(selected_control_index, expected[0])
+            np.testing.assert_array_equal(
+                selected_control_index_for_each_treatment, expected[1])
+
+    with pytest.raises(InputError):
+        lazy_non_repeat_index_matching(searcher, treatment_std, k=4)
+
+
+def test_global_greedy_index_matching():
+    control = np.random.random((60, 6))
+    treatment = np.random.random((15, 6))
+    treatment_std, control_std = normalize(treatment, control)
+    searcher = KNNSearcher(control_std)
+
+    # reference: repeatedly match the globally closest free pair
+    cost = dist(treatment_std, control_std)
+    expected = [list() for _ in treatment]
+    for _ in range(len(treatment) * 3):
+        i, j = np.unravel_index(np.argmin(cost), cost.shape)
+        expected[i].append(j)
+        cost[:, j] = np.inf
+        if len(expected[i]) == 3:
+            cost[i, :] = np.inf
+
+    # window of 1 forces expanding the neighbors a lot
+    for window in [1, None]:
+        (
+            selected_control_index,
+            selected_control_index_for_each_treatment,
+        ) = global_greedy_index_matching(
+            searcher, treatment_std, k=3, window=window)
+        np.testing.assert_array_equal(
+            selected_control_index_for_each_treatment, expected)
+        assert len(selected_control_index) == len(set(selected_control_index))
+
+    # stratified, closest by the stratify rules' distances in lexicographic
+    # order, integer data has lots of ties
+    from ctmatching.sharding import ShardedSearcher
+
+    stratify_order = [[1], [3], [0, 2, 4], [5]]
+    rng = np.random.RandomState(0)
+    for _ in range(5):
+        control_std = rng.randint(0, 4, size=(60, 6)).astype(float)
+        treatment_std = rng.randint(0, 4, size=(15, 6)).astype(float)
+
+        # reference: go through all pairs in order, take the free ones
+        keys = [dist(treatment_std[:, stratify_index],
+                     control_std[:, stratify_index]).ravel()
+                for stratify_index in stratify_order]
+        i_all, j_all = np.divmod(np.arange(15 * 60), 60)
+        expected = [list() for _ in treatment_std]
+        taken = np.zeros(60, dtype=bool)
+        for pair in np.lexsort([j_all, i_all] + keys[::-1]):
+            i, j = i_all[pair], j_all[pair]
+            if not taken[j] and len(expected[i]) < 3:
+                taken[j] = True
+                expected[i].append(j)
+
+        for searcher in [
+            StratifiedSearcher(control_std, stratify_order),
+            ShardedSearcher([control_std[:25], control_std[25:]],
+                            stratify_order),
+        ]:
+            for window in [1, None]:
+                _, selected_control_index_for_each_treatment = \
+                    global_greedy_index_matching(
+                        searcher, treatment_std, k=3, window=window)
+                np.testing.assert_array_equal(
+                    selected_control_index_for_each_treatment, expected)
+
+
+def test_optimal_index_matching():
+    from scipy.optimize import linear_sum_assignment
+
+    control = np.random.random((40, 6))
+    treatment = np.random.random((10, 6))
+    treatment_std, control_std = normalize(treatment, control)
+    searcher = KNNSearcher(control_std)
+    _, all_nn_index = searcher.query(treatment_std, len(control))
+    cost = searcher.distance(treatment_std, all_nn_index)
+    cost = np.take_along_axis(cost, np.argsort(all_nn_index, axis=1), axis=1)
+
+    _, greedy = lazy_non_repeat_index_matching(searcher, treatment_std, k=2)
+    greedy_total = searcher.distance(treatment_std, greedy).sum()
+
+    for n_candidates in [1, 4, 40]:
+        (
+            selected_control_index,
+            selected_control_index_for_each_treatment,
+        ) = optimal_index_matching(
+            searcher, treatment_std, k=2, n_candidates=n_candidates)
+        assert len(selected_control_index) == len(set(selected_control_index))
+        distances = searcher.distance(
+            treatment_std, selected_control_index_for_each_treatment)
+        assert (np.diff(distances, axis=1) >= 0).all()
+        assert distances.sum() <= greedy_total + 1e-9
+
+    # with the full candidate graph, it's the global optimum
+    row_ind, col_ind = linear_sum_assignment(np.repeat(cost, 2, axis=0))
+    np.testing.assert_allclose(
+        distances.sum(), cost[row_ind // 2, col_ind].sum())
+
 
 def test_independent_index_matching():
     control = np.random.random((30, 6))
@@ -62,6 +336,54 @@ def test_independent_index_matching():
     assert len(selected_control_index) > len(set(selected_control_index))
 
 
+def test_batch_grouper(tmpdir):
+    control, treatment = load_re78()
+    use_col = [2, 3, 4, 5, 6, 7]
+    result = psm(control, treatment, use_col, k=3, caliper=0.5)
+    selected = result.selected_control_index_for_each_treatment
+    assert (selected == -1).any()
+
+    block = batch_grouper(control, treatment, result, use_col=use_col)
+    assert block.shape == (len(treatment), 3, len(use_col))
+    control_used = np.array(control)[:, use_col].astype(float)
+    for row, (_, control_samples) in zip(
+            block, grouper(control_used, treatment, result)):
+        n_matched = len(control_samples)
+        np.testing.assert_array_equal(row[:n_matched], control_samples)
+        assert np.isnan(row[n_matched:]).all()
+
+    # chunked, memory mapped data and output
+    path = str(tmpdir.join("control.npy"))
+    np.save(path, control_used)
+    treatment_used = np.array(treatment)[:, use_col].astype(float)
+    chunks = list(iter_batch_grouper(path, treatment_used, selected,
+                                     chunk_size=50))
+    assert [len(chunk) for chunk, _ in chunks] == [50, 50, 50, 35]
+    np.testing.assert_array_equal(
+        np.concatenate([chunk for chunk, _ in chunks]), treatment_used)
+    np.testing.assert_array_equal(
+        np.concatenate([control_block for _, control_block in chunks]), block)
+
+    out = np.lib.format.open_memmap(
+        str(tmpdir.join("block.npy")), mode="w+", shape=block.shape)
+    assert batch_grouper(path, treatment_used, selected, chunk_size=50,
+                         out=out, fill=0) is out
+    np.testing.assert_array_equal(out, np.nan_to_num(block))
+
+    # column selection on raw data
+    block = batch_grouper(control, treatment, selected, use_col=[0],
+                          dtype=None, fill="")
+    assert block[0, 0, 0] == control[selected[0, 0]][0]
+
+    assert batch_grouper(control_used, treatment_used[:0],
+                         selected[:0]).shape == (0, 3, len(use_col))
+    with pytest.raises(InputError):
+        batch_grouper(control, treatment, selected[:10])
+    with pytest.raises(InputError):
+        batch_grouper(control_used, treatment_used, selected,
+                      out=np.empty((len(treatment), 2, len(use_col))))
+
+
 def test_psm():
     control, treatment = load_re78()
     use_col = [1, 2, 3, 4, 5, 6]
@@ -79,6 +401,132 @@ def test_psm():
         for control_sample in control_samples:
             print("    %s" % control_sample)
 
+    (
+        selected_control_index,
+        selected_control_index_for_each_treatment,
+    ) = psm(control, treatment, use_col, None, False, 2, method="optimal")
+    assert len(selected_control_index) == len(set(selected_control_index))
+
+    with pytest.raises(InputError):
+        psm(control, treatment, use_col, stratify_order, False, 2,
+            method="optimal")
+
+    # caliper, some treatment samples have no match
+    use_col = [2, 3, 4, 5, 6, 7]
+    treatment_std, control_std = normalize(
+        np.array(treatment)[:, use_col].astype(float),
+        np.array(control)[:, use_col].astype(float),
+    )
+    for stratify_order_, method in [
+        (None, "greedy"),
+        (None, "global_greedy"),
+        (stratify_order, "greedy"),
+    ]:
+        for independent in [True, False]:
+            (
+                selected_control_index,
+                selected_control_index_for_each_treatment,
+            ) = psm(control, treatment, use_col, stratify_order_, independent,
+                    3, method=method, caliper=0.5)
+            assert selected_control_index_for_each_treatment.shape == (185, 3)
+            is_matched = selected_control_index_for_each_treatment >= 0
+            assert 0 < is_matched.sum() < 185 * 3
+            np.testing.assert_array_equal(
+                selected_control_index,
+                selected_control_index_for_each_treatment[is_matched])
+            for i, j in zip(*np.nonzero(is_matched)):
+                control_sample = control_std[
+                    selected_control_index_for_each_treatment[i, j]]
+                assert np.linalg.norm(
+                    treatment_std[i] - control_sample) <= 0.5 + 1e-9
+            if not independent:
+                assert len(selected_control_index) == \
+                    len(set(selected_control_index))
+
+    with pytest.raises(InputError):
+        psm(control, treatment, use_col, None, False, 2,
+            method="optimal", caliper=0.5)
+
+
+def test_psm_memmap(tmpdir):
+    control, treatment = load_re78()
+    use_col = [2, 3, 4, 5, 6, 7]
+    control = np.array(control)[:, 1:].astype(float)
+    treatment = np.array(treatment)[:, 1:].astype(float)
+    control_path = str(tmpdir.join("control.npy"))
+    treatment_path = str(tmpdir.join("treatment.npy"))
+    np.save(control_path, control)
+    np.save(treatment_path, treatment)
+    control_memmap = np.load(control_path, mmap_mode="r")
+
+    for stratify_order in [None, [[1], [3], [0, 2, 4], [5]]]:
+        expected = psm(control, treatment, use_col, stratify_order, False, 2)
+        for control_, treatment_ in [
+            (control_path, treatment_path),
+            (control_memmap, treatment),
+        ]:
+            result = psm(control_, treatment_, use_col, stratify_order, False,
+                         2, chunk_size=50)
+            np.testing.assert_array_equal(result[0], expected[0])
+            np.testing.assert_array_equal(result[1], expected[1])
+
+    (
+        selected_control_index,
+        selected_control_index_for_each_treatment,
+    ) = psm(control, treatment, use_col, stratify_order, False, 2,
+            method="global_greedy")
+    assert len(selected_control_index) == len(set(selected_control_index))
+
+
+def test_mahalanobis():
+    from scipy.spatial.distance import cdist
+
+    control = np.random.random((300, 3)).dot([[2, 1, 0], [0, 1, 0], [0, 3, 1]])
+    treatment = np.random.random((50, 3)).dot([[2, 1, 0], [0, 1, 0], [0, 3, 1]])
+    cov = pooled_covariance(control, treatment, chunk_size=7)
+    expected = (np.cov(control.T) * 299 + np.cov(treatment.T) * 49) / 348
+    np.testing.assert_allclose(cov, expected)
+
+    # global
+    mean, scale = column_stats(treatment)
+    matrix, stratify_order = metric_matrix(cov, scale, None, "mahalanobis")
+    assert stratify_order is None
+    np.testing.assert_allclose(
+        dist(standardize(treatment, mean, scale, matrix=matrix),
+             standardize(control, mean, scale, matrix=matrix)),
+        cdist(treatment, control, "mahalanobis", VI=np.linalg.inv(cov)))
+
+    # per stratify rule, a column can be in more than one rule
+    matrix, stratify_order = metric_matrix(
+        cov, scale, [[2], [0, 1], [1, 2]],
+        ["euclidean", "mahalanobis", "mahalanobis"])
+    assert stratify_order == [[0], [1, 2], [3, 4]]
+    control_std = standardize(control, mean, scale, matrix=matrix)
+    treatment_std = standardize(treatment, mean, scale, matrix=matrix)
+    np.testing.assert_allclose(
+        dist(treatment_std[:, [0]], control_std[:, [0]]),
+        cdist(treatment[:, [2]], control[:, [2]]) / scale[2])
+    np.testing.assert_allclose(
+        dist(treatment_std[:, [3, 4]], control_std[:, [3, 4]]),
+        cdist(treatment[:, [1, 2]], control[:, [1, 2]], "mahalanobis",
+              VI=np.linalg.inv(cov[1:, 1:])))
+
+    _, nn_index = psm(control, treatment, k=1, metric="mahalanobis")
+    expected = cdist(treatment, control, "mahalanobis",
+                     VI=np.linalg.inv(cov)).argmin(axis=1)
+    np.testing.assert_array_equal(nn_index[:, 0], expected)
+    psm(control, treatment, stratify_order=[[0], [1, 2]], k=2,
+        independent=False, metric=["euclidean", "mahalanobis"])
+
+    # constant column, singular covariance
+    control[:, 1], treatment[:, 1] = 1.0, 1.0
+    with pytest.raises(InputError):
+        psm(control, treatment, metric="mahalanobis")
+    with pytest.raises(InputError):
+        psm(control, treatment, metric="cosine")
+    with pytest.raises(InputError):
+        psm(control, treatment, metric=["mahalanobis"])
+
 
 if __name__ == "__main__":
     import os
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+import numpy as np
+from ctmatching.exc import InputError
+from ctmatching.dataset import (
+    RE78_PATH, load_re78, make_synthetic, load_table,
+)
+
+
+def test_load_re78():
+    control, treatment = load_re78()
+    assert len(control) == 429
+    assert len(treatment) == 185
+
+
+def test_make_synthetic(tmpdir):
+    control, treatment = make_synthetic(
+        2000, 500, n_features=7, n_binary=3, seed=1, chunk_size=300)
+    assert control.shape == (2000, 7)
+    assert treatment.shape == (500, 7)
+    assert set(np.unique(control[:, :3])) <= {0.0, 1.0}
+    np.testing.assert_array_equal(control[:, 3:5], control[:, 3:5].round())
+    assert (control[:, 5:] > 0).all()
+
+    # same seed, same data, on disk too
+    path = str(tmpdir.join("synthetic"))
+    control_memmap, treatment_memmap = make_synthetic(
+        2000, 500, n_features=7, n_binary=3, seed=1, chunk_size=300,
+        path=path)
+    assert isinstance(control_memmap, np.memmap)
+    np.testing.assert_array_equal(control_memmap, control)
+    np.testing.assert_array_equal(
+        np.load(str(tmpdir.join("synthetic", "treatment.npy"))), treatment)
+
+    # less overlap, larger difference between groups
+    def difference(overlap):
+        control, treatment = make_synthetic(
+            5000, 5000, n_binary=0, overlap=overlap, seed=2)
+        return np.abs(np.log(treatment.mean(axis=0)) -
+                      np.log(control.mean(axis=0))).sum()
+
+    assert difference(0.0) > difference(0.5) > difference(1.0)
+
+    with pytest.raises(InputError):
+        make_synthetic(10, 10, n_features=2, n_binary=3)
+    with pytest.raises(InputError):
+        make_synthetic(10, 10, overlap=2.0)
+
+
+def test_load_table(tmpdir):
+    control, treatment = load_re78()
+    expected_control = np.array([record[2:] for record in control])
+    expected_treatment = np.array([record[2:] for record in treatment])
+
+    (
+        control_array, treatment_array, control_id, treatment_id,
+    ) = load_table(RE78_PATH, "treat", id_col="ID")
+    assert control_array.flags["C_CONTIGUOUS"]
+    np.testing.assert_allclose(control_array, expected_control)
+    np.testing.assert_allclose(treatment_array, expected_treatment)
+    assert list(control_id) == [record[0] for record in control]
+    assert list(treatment_id) == [record[0] for record in treatment]
+
+    # by position, chunk by chunk, on disk
+    for out_dir in [None, str(tmpdir.join("re78"))]:
+        result = load_table(RE78_PATH, 1, [2, 3, 10], dtype=np.float32,
+                            id_col=0, chunk_size=100, out_dir=out_dir)
+        assert result[0].dtype == np.float32
+        np.testing.assert_allclose(
+            result[0], expected_control[:, [0, 1, 8]], rtol=1e-6)
+        np.testing.assert_allclose(
+            result[1], expected_treatment[:, [0, 1, 8]], rtol=1e-6)
+        assert list(result[3]) == [record[0] for record in treatment]
+    assert isinstance(result[0], np.memmap)
+
+    _, _, control_id, _ = load_table(RE78_PATH, "treat", ["age", "educ"])
+    assert control_id is None
+    with pytest.raises(InputError):
+        load_table(RE78_PATH, "treated")
+
+
+if __name__ == "__main__":
+    import os
+    pytest.main(["--tb=native", "-s", os.path.basename(__file__)])
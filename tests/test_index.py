@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+import numpy as np
+from ctmatching.dataset import load_re78
+from ctmatching.core import KNNSearcher, StratifiedSearcher, select_matching
+from ctmatching.exc import InputError
+from ctmatching import ControlIndex, psm_iter
+
+
+def test_control_index(tmpdir):
+    control, treatment = load_re78()
+    use_col = [2, 3, 4, 5, 6, 7]
+    control_used = np.array(control)[:, use_col].astype(float)
+    treatment_used = np.array(treatment)[:, use_col].astype(float)
+
+    for stratify_order in [None, [[1], [3], [0, 2, 4], [5]]]:
+        index = ControlIndex.fit(control, use_col, stratify_order)
+
+        # standardized with control group's statistics
+        control_std = (control_used - control_used.mean(axis=0)) / \
+            control_used.std(axis=0)
+        treatment_std = (treatment_used - control_used.mean(axis=0)) / \
+            control_used.std(axis=0)
+        np.testing.assert_allclose(index.searcher.control_std, control_std)
+        np.testing.assert_allclose(index.transform(treatment), treatment_std)
+
+        if stratify_order:
+            searcher = StratifiedSearcher(control_std, stratify_order)
+        else:
+            searcher = KNNSearcher(control_std)
+        for independent in [True, False]:
+            expected = select_matching(searcher, treatment_std, 2, independent)
+            result = index.match(treatment, k=2, independent=independent)
+            np.testing.assert_array_equal(result[0], expected[0])
+            np.testing.assert_array_equal(result[1], expected[1])
+
+        # save, load, and get the same result
+        path = str(tmpdir.join("index-%s" % bool(stratify_order)))
+        index.save(path)
+        loaded = ControlIndex.load(path)
+        assert isinstance(loaded.searcher.control_std, np.memmap)
+        assert loaded.use_col == use_col
+        assert loaded.stratify_order == stratify_order
+        for independent in [True, False]:
+            expected = index.match(treatment, k=2, independent=independent)
+            result = loaded.match(treatment, k=2, independent=independent)
+            np.testing.assert_array_equal(result[0], expected[0])
+            np.testing.assert_array_equal(result[1], expected[1])
+
+    index = ControlIndex.fit(control_used)
+    with pytest.raises(InputError):
+        index.match(treatment_used[:, :4], k=2)
+
+
+def test_psm_iter():
+    control, treatment = load_re78()
+    use_col = [2, 3, 4, 5, 6, 7]
+    treatment = np.array(treatment)
+    batches = [treatment[i:i + 20] for i in range(0, len(treatment), 20)]
+
+    for stratify_order in [None, [[1], [3], [0, 2, 4], [5]]]:
+        index = ControlIndex.fit(control, use_col, stratify_order)
+        treatment_std = index.transform(treatment)
+        for independent in [True, False]:
+            _, expected = index.match(treatment, k=2, independent=independent)
+            result = list(psm_iter(index, batches, k=2,
+                                   independent=independent))
+            assert [row_id for row_id, _, _ in result] == list(range(185))
+            for (row_id, control_ids, distances), indice in zip(
+                    result, expected):
+                np.testing.assert_array_equal(control_ids, indice)
+                np.testing.assert_allclose(
+                    distances, index.searcher.distance(
+                        treatment_std[row_id:row_id + 1], indice[None, :])[0])
+
+    # control group runs out, later treatment samples get nothing
+    result = list(psm_iter(index, iter(treatment), k=3, independent=False))
+    n_matched = [len(control_ids) for _, control_ids, _ in result]
+    assert sum(n_matched) == 429
+    assert n_matched[0] == 3 and n_matched[-1] == 0
+
+
+if __name__ == "__main__":
+    import os
+    pytest.main(["--tb=native", "-s", os.path.basename(__file__)])
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+import numpy as np
+from ctmatching.dataset import load_re78
+from ctmatching.core import (
+    KNNSearcher, StratifiedSearcher, lazy_non_repeat_index_matching, psm,
+)
+from ctmatching.parallel import SharedArray, ParallelSearcher
+
+
+def test_shared_array():
+    shared = SharedArray((10, 3))
+    shared.array[:] = np.arange(30).reshape(10, 3)
+    attached = SharedArray((10, 3), float, shared.name)
+    np.testing.assert_array_equal(attached.array, shared.array)
+    attached.close()
+    shared.unlink()
+    shared.unlink()  # does nothing
+
+
+def test_resource_tracker():
+    # workers attaching to shared memory must not confuse the creator's
+    # resource tracker, which complains in its own process
+    import subprocess
+    import sys
+
+    code = (
+        "import numpy as np\n"
+        "from ctmatching.core import psm\n"
+        "control = np.random.random((300, 3))\n"
+        "treatment = np.random.random((50, 3))\n"
+        "psm(control, treatment, n_jobs=2)\n"
+        "psm(control, treatment, n_jobs=2, exact_cols=[0])\n"
+    )
+    process = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True)
+    assert process.returncode == 0, process.stderr
+    assert "KeyError" not in process.stderr
+    assert "leaked" not in process.stderr
+
+
+def test_parallel_searcher():
+    control = np.random.random((500, 3))
+    treatment = np.random.random((300, 3))
+    for searcher in [
+        KNNSearcher(control),
+        StratifiedSearcher(control, [[0], [1, 2]]),
+    ]:
+        distances, nn_index = searcher.query(treatment, 5)
+        with ParallelSearcher(searcher, n_jobs=2, min_rows=1) as \
+                parallel_searcher:
+            parallel_distances, parallel_nn_index = \
+                parallel_searcher.query(treatment, 5)
+            np.testing.assert_array_equal(parallel_nn_index, nn_index)
+            np.testing.assert_allclose(parallel_distances, distances)
+
+            _, nn_index = searcher.query(treatment, 5, radius=0.1)
+            _, parallel_nn_index = parallel_searcher.query(
+                treatment, 5, radius=0.1)
+            np.testing.assert_array_equal(parallel_nn_index, nn_index)
+
+            if isinstance(searcher, StratifiedSearcher):
+                distance_list, nn_index = searcher.query_rules(treatment, 5)
+                parallel_distance_list, parallel_nn_index = \
+                    parallel_searcher.query_rules(treatment, 5)
+                np.testing.assert_array_equal(parallel_nn_index, nn_index)
+                for parallel_distances, distances in zip(
+                        parallel_distance_list, distance_list):
+                    np.testing.assert_array_equal(
+                        parallel_distances, distances)
+
+            np.testing.assert_array_equal(
+                lazy_non_repeat_index_matching(
+                    parallel_searcher, treatment, k=1)[1],
+                lazy_non_repeat_index_matching(searcher, treatment, k=1)[1],
+            )
+
+
+def test_psm():
+    control, treatment = load_re78()
+    use_col = [2, 3, 4, 5, 6, 7]
+    for independent, method in [
+        (True, "greedy"),
+        (False, "greedy"),
+        (False, "global_greedy"),
+        (False, "optimal"),
+    ]:
+        expected = psm(control, treatment, use_col, independent=independent,
+                       k=2, method=method)
+        result = psm(control, treatment, use_col, independent=independent,
+                     k=2, method=method, n_jobs=2)
+        np.testing.assert_array_equal(result[1], expected[1])
+
+
+if __name__ == "__main__":
+    import os
+    pytest.main(["--tb=native", "-s", os.path.basename(__file__)])
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+
+import pytest
+import numpy as np
+from ctmatching.dataset import load_re78
+from ctmatching.core import non_repeat_index_matching, psm
+from ctmatching.profiling import Profiler
+
+
+def test_profiler():
+    profiler = Profiler()
+    with profiler:
+        with profiler.stage("outer"):
+            with profiler.stage("inner"):
+                data = np.ones(1000000)
+            del data
+            profiler.count("counter", 2)
+            profiler.count("counter")
+        # counters go to the active profiler
+        nn_indices = np.array([[0, 1, 2], [0, 1, 2], [0, 1, 2]])
+        non_repeat_index_matching(nn_indices, k=1)
+
+    result = profiler.to_dict()
+    assert [stage["stage"] for stage in result["stages"]] == ["inner", "outer"]
+    inner, outer = result["stages"]
+    assert inner["peak_memory"] >= 8000000
+    assert outer["peak_memory"] >= inner["peak_memory"]
+    assert outer["time"] >= inner["time"]
+    # second row skips control 0, third row skips 0 and 1
+    assert result["counters"] == {"counter": 3, "conflicts_skipped": 3}
+
+    # not active any more
+    non_repeat_index_matching(nn_indices, k=1)
+    assert profiler.counters["conflicts_skipped"] == 3
+
+
+def test_psm(caplog):
+    control, treatment = load_re78()
+    use_col = [2, 3, 4, 5, 6, 7]
+
+    profiler = Profiler()
+    psm(control, treatment, use_col, stratify_order=[[1], [0, 2, 3, 4, 5]],
+        independent=False, k=2, profile=profiler)
+    result = profiler.to_dict()
+    stages = [stage["stage"] for stage in result["stages"]]
+    for stage in ["column_stats", "standardize", "build_searcher", "query",
+                  "selection", "psm"]:
+        assert stage in stages
+    assert stages[-1] == "psm"
+    counters = result["counters"]
+    assert counters["distance_evaluations"] >= 185 * 429
+    assert counters["neighbors_visited"] >= 185 * 2
+    assert counters["conflicts_skipped"] > 0
+    assert sum(block["rows"] for block in result["blocks"]) >= 185
+
+    events = list()
+    with caplog.at_level(logging.INFO, logger="ctmatching"):
+        psm(control, treatment, use_col, independent=False, k=2,
+            method="global_greedy", profile=events.append)
+    assert any(event.get("stage") == "psm" for event in events)
+    assert any(getattr(record, "ctmatching_event", None) == events[0]
+               for record in caplog.records)
+    assert "psm profile" in caplog.text
+
+
+if __name__ == "__main__":
+    import os
+    pytest.main(["--tb=native", "-s", os.path.basename(__file__)])
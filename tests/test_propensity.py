@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+import numpy as np
+from ctmatching.dataset import load_re78
+from ctmatching.propensity import propensity_score, PropensitySearcher
+from ctmatching.core import lazy_non_repeat_index_matching, psm
+
+
+def test_propensity_score():
+    control = np.random.random((100, 3))
+    treatment = np.random.random((20, 3)) + 0.5
+    control_score, treatment_score = propensity_score(
+        control, treatment, logit=False)
+    assert control_score.shape == (100,)
+    assert treatment_score.shape == (20,)
+    assert ((0 <= control_score) & (control_score <= 1)).all()
+    assert treatment_score.mean() > control_score.mean()
+
+    control_logit, treatment_logit = propensity_score(control, treatment)
+    np.testing.assert_allclose(
+        1 / (1 + np.exp(-control_logit)), control_score, rtol=1e-6)
+
+
+def test_propensity_searcher():
+    # rounded score has lots of ties
+    control_score = np.random.random(200).round(2)
+    treatment_score = np.append(np.random.random(30).round(2), [-1.0, 2.0])
+    searcher = PropensitySearcher(control_score)
+
+    for k in [1, 5, 200, 1000]:
+        distances, nn_index = searcher.query(treatment_score, k)
+        assert nn_index.shape == (32, min(k, 200))
+        for t, distance, indice in zip(treatment_score, distances, nn_index):
+            expected = sorted(
+                range(200), key=lambda j: (abs(control_score[j] - t), j))
+            assert list(indice) == expected[:len(indice)]
+            np.testing.assert_allclose(
+                distance, np.abs(control_score[indice] - t))
+
+    np.testing.assert_allclose(
+        searcher.distance(treatment_score, nn_index), distances)
+
+    distances, nn_index = searcher.query(treatment_score, 5, radius=0.01)
+    _, all_nn_index = searcher.query(treatment_score, 5)
+    is_within = distances <= 0.01
+    np.testing.assert_array_equal(
+        nn_index, np.where(is_within, all_nn_index, -1))
+    assert (nn_index[-2:] == -1).all()
+
+    (
+        selected_control_index,
+        selected_control_index_for_each_treatment,
+    ) = lazy_non_repeat_index_matching(searcher, treatment_score, k=3)
+    assert len(selected_control_index) == len(set(selected_control_index))
+
+
+def test_psm():
+    control, treatment = load_re78()
+    use_col = [2, 3, 4, 5, 6, 7]
+    for propensity in ["logit", "probability"]:
+        for independent, method in [
+            (True, "greedy"),
+            (False, "greedy"),
+            (False, "global_greedy"),
+            (False, "optimal"),
+        ]:
+            (
+                selected_control_index,
+                selected_control_index_for_each_treatment,
+            ) = psm(control, treatment, use_col, independent=independent, k=2,
+                    method=method, propensity=propensity)
+            assert selected_control_index_for_each_treatment.shape == (185, 2)
+
+
+if __name__ == "__main__":
+    import os
+    pytest.main(["--tb=native", "-s", os.path.basename(__file__)])
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+import numpy as np
+from ctmatching.dataset import load_re78
+from ctmatching.core import KNNSearcher, column_stats, standardize
+from ctmatching import psm, grouper, MatchResult
+
+
+def test_padded_round_trip(tmpdir):
+    nn_index = np.array([[3, 1, -1], [-1, -1, -1], [0, 2, 4]])
+    distances = np.array([[0.5, 1.0, np.inf],
+                          [np.inf, np.inf, np.inf],
+                          [0.1, 0.2, 0.3]])
+    result = MatchResult.from_padded(nn_index, distances)
+    np.testing.assert_array_equal(result.indptr, [0, 2, 2, 5])
+    np.testing.assert_array_equal(result.n_matched, [2, 0, 3])
+    np.testing.assert_array_equal(result.to_padded(), nn_index)
+    np.testing.assert_array_equal(result.padded_distances(), distances)
+
+    # rows are views
+    control_ids, row_distances = result.row(2)
+    np.testing.assert_array_equal(control_ids, [0, 2, 4])
+    np.testing.assert_array_equal(row_distances, [0.1, 0.2, 0.3])
+    assert np.shares_memory(control_ids, result.indices)
+    assert np.shares_memory(row_distances, result.distances)
+    assert len(result.row(1)[0]) == 0
+
+    # unpacks like the legacy 2-tuple
+    selected_control_index, selected_control_index_for_each_treatment = result
+    np.testing.assert_array_equal(selected_control_index, [3, 1, 0, 2, 4])
+    np.testing.assert_array_equal(
+        selected_control_index_for_each_treatment, nn_index)
+    np.testing.assert_array_equal(result[1], nn_index)
+
+    path = str(tmpdir.join("result.npz"))
+    result.save(path)
+    loaded = MatchResult.load(path)
+    assert loaded.k == 3
+    np.testing.assert_array_equal(loaded.indptr, result.indptr)
+    np.testing.assert_array_equal(loaded.indices, result.indices)
+    np.testing.assert_array_equal(loaded.distances, result.distances)
+
+
+@pytest.mark.parametrize("kwargs", [
+    dict(independent=True),
+    dict(independent=False),
+    dict(independent=False, method="optimal"),
+    dict(independent=False, method="global_greedy"),
+    dict(independent=False, caliper=0.5),
+    dict(independent=False, stratify_order=[[0, 1], [2, 3]]),
+    dict(independent=False, method="global_greedy",
+         stratify_order=[[0, 1], [2, 3]]),
+    dict(independent=False, exact_cols=[6]),
+])
+def test_psm_distances(kwargs):
+    control, treatment = load_re78()
+    use_col = [2, 3, 7, 8]
+    result = psm(control, treatment, use_col=use_col, k=1, **kwargs)
+    assert isinstance(result, MatchResult)
+    assert result.indices.dtype == np.int32
+    assert result.to_padded().dtype == np.int32
+
+    # distances are the euclidean distances in standardized space
+    control_used = np.array(control)[:, use_col].astype(float)
+    treatment_used = np.array(treatment)[:, use_col].astype(float)
+    mean, scale = column_stats(treatment_used)
+    control_std = standardize(control_used, mean, scale)
+    treatment_std = standardize(treatment_used, mean, scale)
+    searcher = KNNSearcher(control_std)
+    nn_index = result.selected_control_index_for_each_treatment
+    expected = searcher.distance(treatment_std, np.maximum(nn_index, 0))
+    np.testing.assert_allclose(
+        result.padded_distances(), np.where(nn_index >= 0, expected, np.inf))
+
+    pairs = list(grouper(control, treatment, result))
+    assert len(pairs) == len(treatment)
+    assert len(pairs[0][1]) == result.n_matched[0]
+
+
+def test_psm_index_dtype():
+    control, treatment = load_re78()
+    use_col = [2, 3, 7, 8]
+    for kwargs in [
+        dict(independent=True, propensity="logit"),
+        dict(independent=False, propensity="logit"),
+        dict(independent=True, stratify_order=[[0, 1], [2, 3]]),
+    ]:
+        result = psm(control, treatment, use_col=use_col, k=2, **kwargs)
+        assert result.indices.dtype == np.int32
+        assert result.selected_control_index_for_each_treatment.dtype == \
+            np.int32
+
+
+if __name__ == "__main__":
+    import os
+    pytest.main([os.path.basename(__file__), "--tb=native", "-s", ])
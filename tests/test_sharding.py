@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+import numpy as np
+from ctmatching.dataset import load_re78
+from ctmatching.core import (
+    KNNSearcher, StratifiedSearcher, column_stats, standardize,
+)
+from ctmatching.sharding import ShardedSearcher
+from ctmatching.exc import InputError
+from ctmatching.profiling import Profiler
+from ctmatching import psm
+
+
+def split(data, shard_size):
+    return [data[lower:lower + shard_size]
+            for lower in range(0, len(data), shard_size)]
+
+
+def test_sharded_searcher(tmpdir):
+    rng = np.random.RandomState(0)
+    control_std = rng.randn(500, 4)
+    treatment_std = rng.randn(60, 4)
+
+    # shards on disk, one of them smaller than k
+    paths = list()
+    for i, shard in enumerate(split(control_std, 123)):
+        paths.append(str(tmpdir.join("shard-%s.npy" % i)))
+        np.save(paths[-1], shard)
+    searcher = ShardedSearcher(paths)
+    assert searcher.n_control == 500
+    expected_searcher = KNNSearcher(control_std)
+    for k, radius in [(1, None), (10, None), (10, 0.8), (500, None)]:
+        distances, nn_index = searcher.query(treatment_std, k, radius)
+        expected = expected_searcher.query(treatment_std, k, radius)
+        np.testing.assert_allclose(distances, expected[0])
+        np.testing.assert_array_equal(nn_index, expected[1])
+    np.testing.assert_allclose(
+        searcher.distance(treatment_std, nn_index[:, :5]),
+        expected_searcher.distance(treatment_std, nn_index[:, :5]))
+
+    # stratified, with lots of ties
+    control, treatment = load_re78()
+    use_col = [2, 3, 4, 5, 6, 7]
+    control = np.array(control)[:, use_col].astype(float)
+    treatment = np.array(treatment)[:, use_col].astype(float)
+    mean, scale = column_stats(treatment)
+    control_std = standardize(control, mean, scale)
+    treatment_std = standardize(treatment, mean, scale)
+    stratify_order = [[1], [3], [0, 2, 4], [5]]
+    searcher = ShardedSearcher(split(control_std, 100), stratify_order)
+    expected_searcher = StratifiedSearcher(control_std, stratify_order)
+    for k, radius in [(1, None), (5, None), (5, 1.0)]:
+        distances, nn_index = searcher.query(treatment_std, k, radius)
+        expected = expected_searcher.query(treatment_std, k, radius)
+        np.testing.assert_allclose(distances, expected[0])
+        np.testing.assert_array_equal(nn_index, expected[1])
+        np.testing.assert_allclose(
+            searcher.distance(treatment_std, np.maximum(nn_index, 0)),
+            expected_searcher.distance(
+                treatment_std, np.maximum(nn_index, 0)))
+
+
+def test_psm_shard_size():
+    control, treatment = load_re78()
+    use_col = [2, 3, 4, 5, 6, 7]
+    stratify_order = [[1], [3], [0, 2, 4], [5]]
+    for kwargs in [
+        dict(stratify_order=stratify_order, independent=True, k=3),
+        dict(stratify_order=stratify_order, independent=False, k=2),
+        dict(stratify_order=stratify_order, independent=False, k=2,
+             method="global_greedy", caliper=1.0),
+    ]:
+        expected = psm(control, treatment, use_col, **kwargs)
+        profiler = Profiler(trace_memory=False)
+        result = psm(control, treatment, use_col, shard_size=100,
+                     profile=profiler, **kwargs)
+        np.testing.assert_array_equal(
+            result.to_padded(), expected.to_padded())
+        np.testing.assert_allclose(result.distances, expected.distances)
+        assert "shard_query" in [block["block"] for block in profiler.blocks]
+
+    # continuous data, no ties
+    rng = np.random.RandomState(1)
+    control = rng.randn(2000, 5)
+    treatment = rng.randn(300, 5) + 0.3
+    for kwargs in [
+        dict(independent=True, k=3, metric="mahalanobis"),
+        dict(independent=False, k=3),
+        dict(independent=False, k=2, method="optimal"),
+    ]:
+        expected = psm(control, treatment, **kwargs)
+        result = psm(control, treatment, shard_size=300, **kwargs)
+        np.testing.assert_array_equal(
+            result.to_padded(), expected.to_padded())
+
+    with pytest.raises(InputError):
+        psm(control, treatment, shard_size=0)
+    with pytest.raises(InputError):
+        psm(control, treatment, shard_size=100, n_jobs=2)
+    with pytest.raises(InputError):
+        psm(control, treatment, shard_size=100, exact_cols=[0])
+    with pytest.raises(InputError):
+        psm(control, treatment, [0, 1, 2], [[0], [1, 2]], False,
+            method="optimal", shard_size=100)
+
+
+if __name__ == "__main__":
+    import os
+    pytest.main([os.path.basename(__file__), "--tb=native", "-s", ])